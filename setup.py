@@ -35,7 +35,16 @@ setup(
     package_dir={'vcffuse': 'vcffuse'},
     include_package_data=True,
     install_requires=[
+        'click>=7.1',
+        'intervaltree>=3.0',
+        'requests>=2.24',
+        'svgwrite>=1.4',
     ],
+    entry_points={
+        'console_scripts': [
+            'vcffuse=vcffuse.vcffuse:main',
+        ],
+    },
     license='MIT',
     zip_safe=False,
     keywords='vcffuse',
@@ -0,0 +1,183 @@
+"""
+Benchmarks of the pipeline stages and of whole runs on synthetic data (see vcffuse/SyntheticData.py).
+Needs pytest-benchmark, otherwise all of these are skipped. The number of records is set by
+VCFFUSE_BENCH_SIZES, each stage is a group, so the tables are the scaling curves:
+
+    VCFFUSE_BENCH_SIZES=1000,10000,100000,1000000 py.test test/test_benchmarks.py --benchmark-save=baseline
+    py.test test/test_benchmarks.py --benchmark-compare --benchmark-compare-fail=mean:10%
+"""
+import os
+import subprocess
+import sys
+import time
+import pytest
+from vcffuse import AnnotationIndex, AnnotationStore, EnsemblREST, EnsemblStandIn, Gallery, SyntheticData, VCFReader, \
+    VCFRecord, getFusionFromVCF, vcffuse
+
+pytest.importorskip("pytest_benchmark")
+
+SIZES = [int(size) for size in os.environ.get("VCFFUSE_BENCH_SIZES", "1000").split(",")]
+ROUNDS = int(os.environ.get("VCFFUSE_BENCH_ROUNDS", "3"))
+# the slowest imports, none of the subcommands needs them before it makes something
+RUN_ONLY_MODULES = ("requests", "svgwrite")
+# seconds each answer of the local ENSEMBL stand-in takes
+REST_LATENCY = float(os.environ.get("VCFFUSE_BENCH_REST_LATENCY", "0.005"))
+
+
+class Dataset:
+    """
+    The synthetic VCF of a size, its records, and an annotation store filled with all the gene models
+    """
+
+    def __init__(self, directory, size):
+        self.directory = directory
+        self.size = size
+        self.data = data = SyntheticData.SyntheticData(size)
+        self.vcf = data.write_vcf(os.path.join(directory, "synthetic.vcf"))
+        self.cache = os.path.join(directory, "annotation.sqlite")
+        self.store = data.fill_store(AnnotationStore.AnnotationStore(self.cache))
+        self.index = os.path.join(directory, "annotation.vfi")
+        AnnotationIndex.build_index([AnnotationIndex.annotation_from_store(self.cache)], self.index)
+        with VCFReader.open_text(self.vcf) as vcf_file:
+            self.records = list(getFusionFromVCF.read_fusion_records(vcf_file, getFusionFromVCF.SnpEffParser()))
+        self.jobs = list(getFusionFromVCF.fusion_jobs(self.records, getFusionFromVCF.BreakendPairer.BreakendPairer()))
+        self.ENS_IDs = [ENS_ID for record, _ in self.jobs for ENS_ID in getFusionFromVCF.fusion_ENS_IDs(record)]
+        # the geometry benchmarks should not measure the lookups
+        self.coords = {ENS_ID: self.store.get(ENS_ID) for ENS_ID in set(self.ENS_IDs)}
+
+    def fusions(self, kind=None):
+        """
+        The 5' and 3' exons of all the fusions (of a kind)
+        """
+        fusions = []
+        for record, mate_alt in self.jobs:
+            if kind is None or record.kind == kind:
+                fusions.extend(getFusionFromVCF.SV_handlers[record.kind](record, self.coords.__getitem__,
+                                                                         lambda fex, *args: fex, mate_alt))
+        return fusions
+
+
+@pytest.fixture(scope="module", params=SIZES)
+def size(request):
+    return request.param
+
+
+@pytest.fixture(scope="module")
+def dataset(size, tmp_path_factory):
+    return Dataset(str(tmp_path_factory.mktemp("synthetic" + str(size))), size)
+
+
+def run(benchmark, group, dataset, function, *args):
+    benchmark.group = group
+    benchmark.extra_info["records"] = dataset.size
+    return benchmark.pedantic(function, args=args, rounds=ROUNDS, iterations=1)
+
+
+def parse(vcf):
+    with VCFReader.open_text(vcf) as vcf_file:
+        return sum(1 for _ in getFusionFromVCF.read_fusion_records(vcf_file, getFusionFromVCF.SnpEffParser()))
+
+
+def lookup(cache, ENS_IDs):
+    # a new store for each round, like a new run with a warm cache
+    store = AnnotationStore.AnnotationStore(cache)
+    for ENS_ID in ENS_IDs:
+        getFusionFromVCF.get_CDS_coords(ENS_ID, rest=False, store=store)
+    return len(ENS_IDs)
+
+
+def index_lookup(path, ENS_IDs):
+    # a new map for each round, like a new run
+    index = AnnotationIndex.AnnotationIndex(path)
+    for ENS_ID in ENS_IDs:
+        getFusionFromVCF.get_CDS_coords(ENS_ID, rest=False, backends=[index])
+    index.close()
+    return len(ENS_IDs)
+
+
+def rest_lookup(server, directory, ENS_IDs, mode, workers):
+    # an empty store for each round, like a cold cache
+    store = AnnotationStore.AnnotationStore(os.path.join(directory, "rest" + str(time.monotonic()) + ".sqlite"))
+    client = EnsemblREST.EnsemblClient(server=server, rate=1e6, workers=workers)
+    if mode == "batch":
+        getFusionFromVCF.prefetch_CDS_coords(ENS_IDs, store, client=client)
+    else:
+        client.lookup_many(sorted(set(ENS_IDs)))
+    client.close()
+    store.close()
+
+
+def make_fusions(records, handler, coords):
+    return sum(len(handler(record, coords.__getitem__, lambda fex, *args: fex, mate_alt))
+               for record, mate_alt in records)
+
+
+def render(fusions, backend, directory):
+    for i, fex in enumerate(fusions):
+        if backend == "gallery":
+            Gallery.panel_svg(fex)
+        else:
+            getFusionFromVCF.makeSVG(fex, os.path.join(directory, str(i) + ".svg"), backend)
+    return len(fusions)
+
+
+def test_parse(benchmark, dataset):
+    assert run(benchmark, "parse", dataset, parse, dataset.vcf) == len(dataset.records)
+
+
+def test_lookup(benchmark, dataset):
+    assert run(benchmark, "lookup", dataset, lookup, dataset.cache, dataset.ENS_IDs) == len(dataset.ENS_IDs)
+
+
+def test_index_lookup(benchmark, dataset):
+    assert run(benchmark, "lookup", dataset, index_lookup, dataset.index, dataset.ENS_IDs) == len(dataset.ENS_IDs)
+
+
+@pytest.mark.parametrize("mode,workers", [("single", 1), ("single", 8), ("batch", 1), ("batch", 8)])
+def test_rest_lookup(benchmark, dataset, mode, workers, tmp_path):
+    with EnsemblStandIn.EnsemblStandIn(dataset.data.gene_model, latency=REST_LATENCY) as server:
+        run(benchmark, "REST lookup", dataset, rest_lookup, server.url, str(tmp_path), dataset.ENS_IDs, mode,
+            workers)
+
+
+# the fuse_* path each kind of SV goes through
+@pytest.mark.parametrize("kind,path", [(VCFRecord.DELETION, "fuse_deletion"),
+                                       (VCFRecord.TANDEM, "fuse_tandem_genes"),
+                                       (VCFRecord.INVERSION, "fuse_inversion"),
+                                       (VCFRecord.TRANSLOCATION, "fuse_translocations")])
+def test_fuse(benchmark, dataset, kind, path):
+    records = [job for job in dataset.jobs if job[0].kind == kind]
+    run(benchmark, path, dataset, make_fusions, records, getFusionFromVCF.SV_handlers[kind], dataset.coords)
+
+
+@pytest.mark.parametrize("backend", ["svgwrite", "stream", "gallery"])
+def test_render(benchmark, dataset, backend, tmp_path):
+    fusions = dataset.fusions()
+    assert run(benchmark, "render", dataset, render, fusions, backend, str(tmp_path)) == len(fusions)
+
+
+@pytest.mark.parametrize("output_mode", ["files", "gallery"])
+def test_end_to_end(benchmark, dataset, output_mode, tmp_path, monkeypatch):
+    # the pictures are written into the working directory
+    monkeypatch.chdir(tmp_path)
+    run(benchmark, "end to end", dataset, getFusionFromVCF.make_fusions, dataset.vcf, "bench.svg", False,
+        dataset.cache, False, None, 1, 1.0, 1, None, "stream", output_mode)
+
+
+@pytest.mark.parametrize("subcommand", list(vcffuse.SUBCOMMANDS))
+def test_startup(benchmark, subcommand):
+    # `vcffuse <subcommand> --help` in a new interpreter; the time is only reported, it depends on the machine
+    # too much to assert on, but the startup is kept short by not importing what only a run needs
+    benchmark.group = "startup"
+    benchmark.pedantic(subprocess.run, args=([sys.executable, "-m", "vcffuse.vcffuse", subcommand, "--help"],),
+                       kwargs={"check": True, "stdout": subprocess.DEVNULL}, rounds=ROUNDS, iterations=1)
+    script = ("import sys\n"
+              "from vcffuse.vcffuse import main\n"
+              "try:\n"
+              "    main([%r, '--help'])\n"
+              "except SystemExit:\n"
+              "    pass\n"
+              "print('loaded', *[m for m in %r if m in sys.modules])\n" % (subcommand, RUN_ONLY_MODULES))
+    output = subprocess.run([sys.executable, "-c", script], check=True, stdout=subprocess.PIPE,
+                            universal_newlines=True).stdout
+    assert "loaded" == output.splitlines()[-1]
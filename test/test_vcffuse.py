@@ -1,10 +1,14 @@
 """
 Tests for `vcffuse` module.
 """
+import json
+import os
 import pytest
-from vcffuse import CreateSVGPicture, SnpEffParser, ExonCoords, FusionMaker
+from vcffuse import CreateSVGPicture, SnpEffParser, ExonCoords, FusionMaker, AnnotationStore, EnsemblREST
 from intervaltree import Interval, IntervalTree
 
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+
 class TestVcffuse(object):
     # These are the boilerplate methods, keep them here for clarity
     @classmethod
@@ -34,16 +38,692 @@ class TestVcffuse(object):
         counter = SVG_creator.make_SVG_file(exon_intervals, "SVG_creator_test.svg", 9, "PRIME5", "PRIME3")
         assert 10 == counter
 
+    def test_SVGStream(self, tmp_path):
+        from vcffuse import getFusionFromVCF
+        fex = (IntervalTree.from_tuples([(0, 333), (401, 517), (516, 517), (1234, 1801)]),
+               IntervalTree.from_tuples([(1801, 1802), (1850, 1999), (20003, 20577)]))
+        dom = getFusionFromVCF.makeSVG(fex, str(tmp_path / "svgwrite.svg"))
+        stream = getFusionFromVCF.makeSVG(fex, str(tmp_path / "stream.svg"), backend="stream")
+        with open(dom, "rb") as dom_svg, open(stream, "rb") as stream_svg:
+            assert dom_svg.read() == stream_svg.read()
+
+    def test_Gallery(self, tmp_path):
+        from vcffuse import Gallery
+        fex = (IntervalTree.from_tuples([(0, 300), (400, 500)]), IntervalTree.from_tuples([(500, 501), (800, 900)]))
+        path = str(tmp_path / Gallery.gallery_file_name("fusions.svg"))
+        assert path.endswith("fusions.html")
+        with Gallery.GalleryWriter(path) as gallery:
+            gallery.add(Gallery.make_panel(fex, "INV_1_A_B-fusions.svg", "INV:1", "INV", "A", "B"))
+            gallery.add(Gallery.make_panel(fex, "INV_1_B_A-fusions.svg", "INV:1", "INV", "B", "A"))
+            # the same picture again is not added twice
+            gallery.add(Gallery.make_panel(fex, "INV_1_B_A-fusions.svg", "INV:1", "INV", "B", "A"))
+        assert 2 == gallery.panels
+        with open(path) as html:
+            document = html.read()
+        assert 2 == document.count("<template>") and 1 == document.count("<symbol")
+        # the 1 base long breakpoint mark is not drawn
+        assert 2 * 3 == document.count('<use href="#exon"')
+        index = json.loads(document.split('id="gallery-index">')[1].split("</script>")[0])
+        assert ["INV_1_A_B-fusions.svg"] == index["by_gene_pair"]["A-B"]
+        assert ["INV_1_A_B-fusions.svg", "INV_1_B_A-fusions.svg"] == index["by_record"]["INV:1"]
+
     def test_snpEff_parser(self):
         assert None != SnpEffParser.SnpEffParser()
 
+    def test_Annotations(self):
+        import pickle
+        ann = ("<INV>|gene_fusion|HIGH|A&B|ENSG1&ENSG2|gene_variant,"
+               "<INV>|bidirectional_gene_fusion|HIGH|C&D|ENSG3&ENSG4|gene_variant,"
+               "<INV>|inversion|HIGH|gene_fusion|ENSG5|transcript,"
+               "<INV>|gene_fusion|HIGH|E&F|ENSG6&ENSG7|gene_variant")
+        sep = SnpEffParser.SnpEffParser()
+        annotations = sep.annotations(ann)
+        assert 4 == len(annotations)
+        assert ["ENSG1&ENSG2", "ENSG6&ENSG7"] == [entry["Gene_ID"] for entry in annotations.fusions()]
+        assert ["ENSG5"] == [entry[4] for entry in annotations.select("Gene_Name", "gene_fusion")]
+        assert "A&B" == annotations.first_fusion()["Gene_Name"]
+        assert ["HIGH"] * 4 == annotations.column("Annotation_Impact")
+        assert "" == annotations.column("HGVS.p")[0]
+        assert sep.annotations(None).first_fusion() is None
+        # the layout comes from the header
+        sep.add_ann_keys("##INFO=<ID=ANN,Number=.,Type=String,Description=\"Functional annotations: "
+                         "'Annotation | Allele | Gene_ID | Gene_Name' \">")
+        assert [["ENSG1", "ENSG2"]] == [entry["Gene_ID"].split("&") for entry in
+                                        sep.annotations("gene_fusion|<DEL>|ENSG1&ENSG2|A&B").fusions()]
+        assert ["Annotation", "Allele", "Gene_ID", "Gene_Name"] == pickle.loads(pickle.dumps(sep)).ann_keys
+        assert SnpEffParser.default_parser is pickle.loads(pickle.dumps(SnpEffParser.SnpEffParser()))
+        # a dict for each entry
+        sep = SnpEffParser.SnpEffParser()
+        sep.parse_se_ann("SVTYPE=INV;ANN=" + ann, sep._ann_regex["gene_fusion"])
+        assert ["A&B", "C&D", "gene_fusion", "E&F"] == [entry["Gene_Name"] for entry in sep.ann_list]
+
     def test_ExonCoords(self):
         assert None != ExonCoords.ExonCoords.empty()
 
     def test_FusionMaker(self):
-        # assert None != FusionMaker.FusionMaker(ExonCoords.ExonCoords.empty(),
-        #                                        ExonCoords.ExonCoords.empty(),
-        #                                        1,
-        #                                        200,
-        #                                        3)
-        pass
+        p5 = ExonCoords.ExonCoords("chr1", 1, 0, "FIVE", IntervalTree.from_tuples([(100, 200), (300, 400)]))
+        p3 = ExonCoords.ExonCoords("chr1", 1, 0, "THREE", IntervalTree.from_tuples([(1000, 1100), (1200, 1300)]))
+        fusion = FusionMaker.FusionMaker(p5, p3, 350, 1050, "chr1")
+        assert 350 == fusion.prime5.breakpoint and 1050 == fusion.prime3.breakpoint
+        p5part, p3part = fusion.fuse_deletion()
+        assert IntervalTree.from_tuples([(0, 100), (200, 250)]) == p5part
+        assert IntervalTree.from_tuples([(251, 351), (301, 302), (451, 551)]) == p3part
+        # the genes themselves are not changed by cutting them
+        assert IntervalTree.from_tuples([(100, 200), (300, 400)]) == fusion.prime5.exons
+        # the same rotated with 180 degrees
+        p5part, p3part = fusion.fuse_deletion(reverse=True)
+        assert IntervalTree.from_tuples([(251, 301), (401, 501)]) == p5part
+        assert IntervalTree.from_tuples([(-50, 50), (150, 250), (199, 200)]) == p3part
+
+    def test_ExonArray(self):
+        from vcffuse.ExonArray import ExonArray, Transform
+
+        # the IntervalTree way we are replacing
+        def left_part(tree, bp):
+            tree = IntervalTree(tree)
+            if not tree.at(bp):
+                tree.add(Interval(bp - 1, bp))
+            tree.chop(bp, tree.end())
+            return tree
+
+        def right_part(tree, bp):
+            tree = tree.overlap(bp, tree.end())
+            tree.add(Interval(bp, bp + 1))
+            return IntervalTree(tree)
+
+        def turn_backwards(tree):
+            return IntervalTree(Interval(tree.end() + tree.begin() - iv.end, tree.end() - (iv.begin - tree.begin()))
+                                for iv in tree)
+
+        exons = IntervalTree.from_tuples([(10, 20), (30, 40), (40, 45), (60, 80)])
+        array = ExonArray.from_tree(exons)
+        assert exons == array.to_tree()
+        assert (10, 80) == (array.begin(), array.end())
+        assert (0, 0) == (ExonArray().begin(), ExonArray().end())
+        for bp in [0, 9, 10, 11, 19, 20, 25, 30, 40, 44, 45, 59, 79, 80, 81, 100]:
+            left = array.left_part(bp)
+            right = array.right_part(bp)
+            assert left_part(exons, bp) == left.to_tree(), bp
+            assert right_part(exons, bp) == right.to_tree(), bp
+            assert turn_backwards(left_part(exons, bp)) == left.turn_backwards().to_tree(), bp
+            assert turn_backwards(right_part(exons, bp)) == right.turn_backwards().to_tree(), bp
+            assert list(right.to_tree().items()) and sorted(right.to_tree()) == [Interval(*iv) for iv in right]
+        assert IntervalTree.from_tuples([(0, 10), (20, 30), (30, 35), (50, 70)]) == array.shift_left_to(0).to_tree()
+        # composed transforms are doing the same as the steps one by one
+        steps = [Transform.shift(5), Transform.mirror(100), Transform.shift(-7), Transform.mirror(3)]
+        composed = Transform()
+        moved = array
+        for step in steps:
+            composed = composed.then(step)
+            moved = moved.transform(step)
+        assert moved == array.transform(composed)
+        assert (moved.begin(), moved.end()) == composed.extent(array.begin(), array.end())
+
+    def test_AnnotationStore(self, tmp_path):
+        with open(os.path.join(TEST_DIR, "ENST00000343882.json"), 'r') as json_file:
+            coords = AnnotationStore.coords_from_json(json.loads(json_file.read()))
+        store_file = str(tmp_path / "annotation.sqlite")
+        store = AnnotationStore.AnnotationStore(store_file, lru_size=1)
+        assert store.get("ENST00000343882") is None
+        store.put("ENST00000343882", coords)
+        store.put_missing("ENSG00000000000")
+        assert coords[0] == "chr6"
+        assert store.get("ENST00000343882")[4] == coords[4]
+        with pytest.raises(AnnotationStore.AnnotationNotFound):
+            store.get("ENSG00000000000")
+        # a new store (like another process) sees the same rows
+        other = AnnotationStore.AnnotationStore(store_file)
+        assert other.get("ENST00000343882") == store.get("ENST00000343882")
+        assert other.is_missing("ENSG00000000000")
+
+    def test_fusion_ENS_IDs(self):
+        from vcffuse import getFusionFromVCF
+        ENS_IDs = []
+        with open(os.path.join(TEST_DIR, "collated_sanity_test.vcf"), 'r') as vcf:
+            for record in getFusionFromVCF.read_fusion_records(vcf, getFusionFromVCF.SnpEffParser()):
+                ENS_IDs.extend(getFusionFromVCF.fusion_ENS_IDs(record))
+        assert ["ENSG00000142599", "ENSG00000142583"] == ENS_IDs[:2]
+        assert "ENST00000396373" in ENS_IDs and "ENST00000626019" in ENS_IDs
+
+    def test_GTFAnnotation(self, tmp_path):
+        import gzip
+        from vcffuse import GTFAnnotation
+        with open(os.path.join(TEST_DIR, "ENST00000343882.json"), 'r') as json_file:
+            obj = json.loads(json_file.read())
+        gtf_lines = ['6\tensembl\tgene\t108559835\t108684774\t.\t+\t.\t'
+                     'gene_id "ENSG00000118689"; gene_version "18"; gene_name "FOXO3";\n',
+                     '6\tensembl\ttranscript\t108559835\t108684774\t.\t+\t.\t'
+                     'gene_id "ENSG00000118689"; transcript_id "ENST00000343882"; gene_name "FOXO3"; '
+                     'transcript_name "FOXO3-201"; tag "basic"; tag "Ensembl_canonical";\n',
+                     '6\tensembl\ttranscript\t108559835\t108560015\t.\t+\t.\t'
+                     'gene_id "ENSG00000118689"; transcript_id "ENST00000000001"; gene_name "FOXO3"; '
+                     'transcript_name "FOXO3-202";\n',
+                     '6\tensembl\texon\t108559835\t108560015\t.\t+\t.\t'
+                     'gene_id "ENSG00000118689"; transcript_id "ENST00000000001";\n']
+        for exon in obj['Exon']:
+            gtf_lines.append('6\tensembl\texon\t' + str(exon['start']) + '\t' + str(exon['end']) + '\t.\t+\t.\t'
+                             'gene_id "ENSG00000118689"; transcript_id "ENST00000343882.10";\n')
+        gtf_file = str(tmp_path / "test.gtf.gz")
+        with gzip.open(gtf_file, 'wt') as gtf:
+            gtf.writelines(gtf_lines)
+        gtf_annotation = GTFAnnotation.GTFAnnotation(gtf_file)
+        assert AnnotationStore.coords_from_json(obj) == gtf_annotation.lookup("ENST00000343882")
+        gene = gtf_annotation.lookup("ENSG00000118689")
+        assert ("chr6", 1, 0, "FOXO3") == gene[:4]
+        assert gene[4] == AnnotationStore.coords_from_json(obj)[4]
+        assert gtf_annotation.lookup("ENSG00000000000") is None
+
+    def test_TokenBucket(self):
+        import time
+        from vcffuse import EnsemblREST
+        bucket = EnsemblREST.TokenBucket(rate=50.0, capacity=1)
+        started = time.monotonic()
+        for _ in range(6):
+            bucket.acquire()
+        # the first one is free, the other five have to wait 1/50 s each
+        assert time.monotonic() - started >= 0.09
+        client = EnsemblREST.EnsemblClient(backoff=1.0)
+        assert 1.0 <= client.retry_wait(0) <= 1.5
+        assert 4.0 <= client.retry_wait(2) <= 6.0
+
+    def test_VCFReader(self, tmp_path):
+        import gzip
+        from vcffuse import VCFReader
+        with open(os.path.join(TEST_DIR, "DEL.vcf"), 'r') as vcf:
+            lines = vcf.readlines()
+        # bgzip writes a series of gzip members
+        bgzipped = str(tmp_path / "DEL.vcf.gz")
+        with open(bgzipped, 'wb') as vcf_gz:
+            for line in lines:
+                vcf_gz.write(gzip.compress(line.encode('utf-8')))
+        for vcf_name in [os.path.join(TEST_DIR, "DEL.vcf"), bgzipped]:
+            with VCFReader.open_text(vcf_name) as vcf:
+                assert lines == vcf.readlines()
+
+    def test_VCFRecord(self):
+        from vcffuse import VCFRecord
+        with open(os.path.join(TEST_DIR, "collated_sanity_test.vcf"), 'r') as vcf:
+            records = [VCFRecord.VCFRecord.parse(line) for line in vcf]
+        assert [VCFRecord.TANDEM, VCFRecord.INVERSION, VCFRecord.INVERSION, VCFRecord.INVERSION,
+                VCFRecord.TANDEM, VCFRecord.TRANSLOCATION] == [record.kind for record in records]
+        bnd = records[-1]
+        assert ("chr12", 11880137, "T]CHR15:88000021]") == (bnd.chrom, bnd.pos, bnd.alt)
+        assert "MantaBND:128962:0:1:0:0:0:1" == bnd.get("MATEID")
+        assert bnd.end is None
+        assert 9087076 == records[0].end
+        assert bnd.info["SOMATIC"] is True
+        # FILTER has to be PASS exactly, not just contain it
+        not_passing = str(bnd).replace("\tPASS\t", "\tNoPASS\t")
+        assert VCFRecord.VCFRecord.parse(not_passing) is None
+        assert VCFRecord.VCFRecord.parse("#CHROM\tPOS\tID") is None
+
+    def test_fusion_file_name(self):
+        from vcffuse import getFusionFromVCF
+        assert "MantaBND_1_9840_9841_0_0_0_1_ALK_DUSP3-fusion.svg" == \
+            getFusionFromVCF.fusion_file_name("MantaBND:1:9840:9841:0:0:0:1", "ALK", "DUSP3", "fusion.svg")
+
+    def test_BreakendPairer(self):
+        from vcffuse import BreakendPairer, VCFRecord
+
+        def breakend(chrom, pos, ID, mate_ID, alt):
+            return VCFRecord.VCFRecord.parse("\t".join([chrom, str(pos), ID, "T", alt, ".", "PASS",
+                                                        "SVTYPE=BND;MATEID=" + mate_ID + ";ANN=|gene_fusion|"]))
+        first = breakend("chr12", 11880137, "BND:1:0", "BND:1:1", "T]CHR15:88000021]")
+        second = breakend("chr15", 88000021, "BND:1:1", "BND:1:0", "T]CHR12:11880137]")
+        for records in [[first, second], [second, first]]:
+            pairer = BreakendPairer.BreakendPairer()
+            assert pairer.add(records[0]) is None
+            assert (second, first) == pairer.add(records[1])
+            assert 0 == len(pairer) and [] == pairer.flush()
+        # on sorted input a breakend is dropped once we are past its mate
+        pairer = BreakendPairer.BreakendPairer(max_distance=1000)
+        assert pairer.add(breakend("chr12", 100, "BND:2:0", "BND:2:1", "T]CHR12:5000]")) is None
+        assert pairer.add(first) is None
+        assert 1 == len(pairer)
+        assert ["BND:2:0"] == pairer.orphans
+        assert pairer.add(breakend("chr13", 1, "BND:3:0", "BND:3:1", "T]CHR12:1]")) is None
+        # chr12 is finished, so the mate of BND:3:0 can not come any more
+        assert ["BND:2:0", "BND:3:0"] == pairer.orphans
+        assert ["BND:2:0", "BND:3:0", "BND:1:0"] == pairer.flush()
+
+    def test_Metrics(self, tmp_path):
+        from vcffuse import Metrics
+        worker = Metrics.Metrics()
+        for seconds in [0.00005, 0.003, 0.003, 120.0]:
+            worker.observe("fuse", seconds)
+        worker.count("records", 2)
+        # what a pool process sends back is merged into the main registry
+        main = Metrics.Metrics()
+        main.count("records")
+        main.merge_dict(worker.take())
+        assert {} == worker.stages and {} == worker.counters
+        assert 3 == main.counters["records"]
+        fuse = main.stages["fuse"]
+        assert 4 == fuse.count and 120.0 == fuse.max
+        assert (0.0001, 1) == next(fuse.cumulative())
+        assert (float("inf"), 4) == list(fuse.cumulative())[-1]
+        main.to_prometheus(str(tmp_path / "run.prom"))
+        with open(str(tmp_path / "run.prom")) as prom:
+            lines = prom.read().splitlines()
+        assert 'vcffuse_stage_seconds_bucket{stage="fuse",le="0.005"} 3' in lines
+        assert 'vcffuse_stage_seconds_count{stage="fuse"} 4' in lines
+        assert 'vcffuse_events_total{event="records"} 3' in lines
+        main.to_json(str(tmp_path / "run.json"))
+        with open(str(tmp_path / "run.json")) as summary:
+            assert 4 == json.load(summary)["stages"]["fuse"]["count"]
+
+    def test_SyntheticData(self, tmp_path, monkeypatch):
+        from vcffuse import Metrics, SyntheticData, VCFRecord, getFusionFromVCF
+        data = SyntheticData.SyntheticData(60, huge_fraction=0.1)
+        vcf = data.write_vcf(str(tmp_path / "synthetic.vcf"))
+        data.write_gene_models(str(tmp_path))
+        positions = []
+        kinds = set()
+        with open(vcf) as vcf_file:
+            for line in vcf_file:
+                record = VCFRecord.VCFRecord.parse(line)
+                if record is not None:
+                    positions.append((int(record.chrom[3:]), record.pos))
+                    kinds.add(record.kind)
+        assert positions == sorted(positions)
+        assert {"DEL", "INV", "DUP:TANDEM", "BND"} == kinds
+        # the same seed gives the same file
+        assert list(SyntheticData.SyntheticData(60, huge_fraction=0.1).vcf_lines()) == list(data.vcf_lines())
+        assert SyntheticData.HUGE_EXONS == max(len(gene.exons) for gene in data.genes())
+        assert dict(data.gene_models()) == {ENS_ID: data.gene_model(ENS_ID) for ENS_ID, _ in data.gene_models()}
+        assert data.gene_model("ENSG00000000000") is None
+        # the driver can make a fusion of every record from the JSON gene models
+        monkeypatch.chdir(tmp_path)
+        before = dict(Metrics.registry.counters)
+        getFusionFromVCF.make_fusions(vcf, "synthetic.svg", False, str(tmp_path / "annotation.sqlite"), False, None,
+                                      1, 1.0, 1, None, "stream")
+        counters = Metrics.registry.counters
+        assert 60 == counters["records"] - before.get("records", 0)
+        assert counters.get("failed_records", 0) == before.get("failed_records", 0)
+        assert counters["pictures"] > before.get("pictures", 0)
+
+    def test_EnsemblStandIn(self):
+        from vcffuse import EnsemblREST, EnsemblStandIn
+        with open(os.path.join(TEST_DIR, "ENST00000343882.json"), 'r') as json_file:
+            expected = json.loads(json_file.read())
+        with EnsemblStandIn.EnsemblStandIn(TEST_DIR) as server:
+            client = EnsemblREST.EnsemblClient(server=server.url, rate=1000, retries=0)
+            assert expected == client.lookup("ENST00000343882")
+            assert client.lookup("ENST00000000000") is None
+            found, failed = client.lookup_batch(["ENST00000343882", "ENST00000000000"])
+            assert {"ENST00000343882": expected, "ENST00000000000": None} == found and {} == failed
+            assert {200: 2, 400: 1} == server.stats["status"]
+        # more than half of the answers are failures, but the client retries until it gets through
+        with EnsemblStandIn.EnsemblStandIn(TEST_DIR, throttle=0.3, retry_after=0, errors=0.3, seed=1) as server:
+            client = EnsemblREST.EnsemblClient(server=server.url, rate=1000, workers=4, retries=20, backoff=0.001)
+            found, failed = client.lookup_many(["ENST00000343882"] * 8)
+            assert {"ENST00000343882": expected} == found and {} == failed
+            assert server.stats["status"][429] > 0 and server.stats["status"][503] > 0
+        with EnsemblStandIn.EnsemblStandIn(TEST_DIR, errors=1.0) as server:
+            client = EnsemblREST.EnsemblClient(server=server.url, rate=1000, retries=1, backoff=0.001)
+            with pytest.raises(EnsemblREST.EnsemblLookupError):
+                client.lookup("ENST00000343882")
+
+        # a 200 that is not JSON (an HTML page of a proxy, a truncated body) is a failed lookup as well
+        class HTMLSession:
+            def request(self, method, url, **kwargs):
+                import requests
+                response = requests.Response()
+                response.status_code = 200
+                response._content = b"<html><body>Bad gateway</body>"
+                return response
+
+        client = EnsemblREST.EnsemblClient(rate=1000, retries=0)
+        client._session = HTMLSession()
+        with pytest.raises(EnsemblREST.EnsemblLookupError):
+            client.lookup("ENST00000343882")
+        assert ({}, {"ENST00000343882": "invalid JSON"}) == client.lookup_many(["ENST00000343882"])
+        assert ({}, {"ENST00000343882": "invalid JSON"}) == client.lookup_batch(["ENST00000343882"])
+
+    def test_batchFusions(self, tmp_path, monkeypatch):
+        from vcffuse import SyntheticData, batchFusions
+        data = SyntheticData.SyntheticData(30)
+        data.write_gene_models(str(tmp_path))
+        data.write_vcf(str(tmp_path / "first.vcf"))
+        data.write_vcf(str(tmp_path / "second.vcf.gz"))
+        with open(str(tmp_path / "cohort.tsv"), "w") as manifest:
+            manifest.write("# the same fusions twice\nfirst.vcf\nrelapse\tsecond.vcf.gz\n")
+        samples = batchFusions.read_manifest(str(tmp_path / "cohort.tsv"))
+        assert ["first", "relapse"] == [sample for sample, _ in samples]
+        monkeypatch.chdir(tmp_path)
+        batchFusions.make_batch("cohort.tsv", "out", False, str(tmp_path / "annotation.sqlite"), False, None,
+                                EnsemblREST.DEFAULT_SERVER, 1, 1.0, 1, None, "stream")
+        tables = {}
+        for sample in ["first", "relapse"]:
+            with open(os.path.join("out", sample + ".tsv")) as table:
+                tables[sample] = [line.split("\t")[2] for line in table if line[0] != "#"]
+        # each fusion is drawn once, and both samples refer to the same pictures
+        assert tables["first"] == tables["relapse"]
+        # "." is for the breakends we do not draw
+        assert sorted(set(tables["first"]) - {"."}) == sorted("fusions/" + name for name in os.listdir("out/fusions"))
+        with open(os.path.join("out", "fusions.tsv")) as index:
+            assert all(line.split("\t")[1] == "first,relapse" for line in index if line[0] != "#")
+
+    def test_FusionMemo(self, tmp_path):
+        from vcffuse import FusionMemo, SVGStream, getFusionFromVCF
+        fex = (IntervalTree([Interval(0, 300), Interval(400, 500)]), IntervalTree([Interval(800, 900)]))
+        for directory in [None, str(tmp_path / "memo")]:
+            memo = FusionMemo.FusionMemo(directory)
+            key = FusionMemo.digest(("DEL", "chr1", 100, "200"))
+            assert memo.get(key) is None
+            memo.put(key, [("A", "B", fex)])
+            # a new memo (like the next run) finds it on disk only
+            if directory is not None:
+                memo = FusionMemo.FusionMemo(directory)
+            assert [("A", "B", fex)] == memo.get(key)
+        # the exons made from an other annotation, or from an edited GTF, are not taken
+        gtf = tmp_path / "genes.gtf"
+        gtf.write_text("genes\n")
+
+        def annotated(*annotation):
+            return FusionMemo.FusionMemo(str(tmp_path / "annotated"),
+                                         annotation=FusionMemo.annotation_source(*annotation))
+        record_key = ("DEL", "chr1", 100, "200")
+        made = annotated(True, "https://rest.ensembl.org", str(gtf))
+        made.put(made.key(record_key), [("A", "B", fex)])
+        assert [("A", "B", fex)] == annotated(True, "https://rest.ensembl.org", str(gtf)).get(made.key(record_key))
+        rest = annotated(True, "https://rest.ensembl.org")
+        assert rest.get(rest.key(record_key)) is None
+        gtf.write_text("edited genes\n")
+        edited = annotated(True, "https://rest.ensembl.org", str(gtf))
+        assert edited.get(edited.key(record_key)) is None
+        picture = FusionMemo.picture_digest(fex)
+        first, second = str(tmp_path / "first.svg"), str(tmp_path / "second.svg")
+        assert not memo.link_picture(picture, first)
+        SVGStream.save_fusion_svg(fex, first)
+        memo.add_picture(picture, first)
+        assert FusionMemo.FusionMemo(str(tmp_path / "memo")).link_picture(picture, second)
+        # the output files and the memo are the same file
+        assert 3 == os.stat(second).st_nlink
+        # drawing an other picture over an output does not write into the memo, with either backend
+        other = (IntervalTree([Interval(0, 100)]), IntervalTree([Interval(200, 300)]))
+        for backend in ("stream", "svgwrite"):
+            getFusionFromVCF.makeSVG(other, first, backend)
+        assert 2 == os.stat(second).st_nlink
+        with open(memo.picture_path(picture)) as svg:
+            assert SVGStream.fusion_svg(fex) == svg.read()
+        # everything goes when the store is too large, but the outputs stay
+        memo = FusionMemo.FusionMemo(str(tmp_path / "memo"), max_bytes=1)
+        assert 2 == memo.evict() and 0 == memo.size()
+        assert memo.get(key) is None and not memo.link_picture(picture, str(tmp_path / "third.svg"))
+        with open(second) as svg:
+            assert SVGStream.fusion_svg(fex) == svg.read()
+
+    def test_RecordFilter(self, tmp_path):
+        from vcffuse import RecordFilter, VCFRecord
+        with open(os.path.join(TEST_DIR, "collated_sanity_test.vcf"), 'r') as vcf:
+            records = [VCFRecord.VCFRecord.parse(line) for line in vcf]
+        records = [record for record in records if record is not None]
+        bed = tmp_path / "panel.bed"
+        # only the mate of the translocation (chr15:88000021) and the END of the first tandem duplication
+        bed.write_text("track name=panel\n15\t88000000\t88000100\tNTRK3\nchr1\t9087075\t9087076\n")
+        record_filter = RecordFilter.RecordFilter.from_options(regions=str(bed))
+        assert ["MantaDUP:TANDEM:880:0:1:0:0:0", "MantaBND:128962:0:1:0:0:0:0"] == \
+            [record.id for record in record_filter.filter(records)]
+        assert (2, 4) == (record_filter.kept, record_filter.dropped)
+        # symbols and versioned IDs, in any case
+        record_filter = RecordFilter.RecordFilter.from_options(genes="ntrk3,ENSG00000147526.3")
+        assert ["MantaINV:84140:0:1:0:0:0", "MantaBND:128962:0:1:0:0:0:0"] == \
+            [record.id for record in records if record_filter.accepts(record)]
+        genes = tmp_path / "genes.txt"
+        genes.write_text("# panel\nETV6\nRELA\n")
+        record_filter = RecordFilter.RecordFilter.from_options(str(bed), str(genes))
+        assert ["MantaBND:128962:0:1:0:0:0:0"] == [record.id for record in records if record_filter.accepts(record)]
+        assert RecordFilter.RecordFilter.from_options() is None
+
+    def test_FusionTable(self, tmp_path, monkeypatch):
+        from vcffuse import FusionTable, SyntheticData, getFusionFromVCF
+        data = SyntheticData.SyntheticData(40)
+        vcf = data.write_vcf(str(tmp_path / "synthetic.vcf"))
+        data.write_gene_models(str(tmp_path))
+        monkeypatch.chdir(tmp_path)
+        tables = {}
+        for output_mode in ["files", "none"]:
+            bedpe, jsonl = output_mode + ".bedpe", output_mode + ".jsonl"
+            with FusionTable.FusionTableWriter(bedpe, jsonl) as table:
+                getFusionFromVCF.make_fusions(vcf, "synthetic.svg", False, str(tmp_path / "annotation.sqlite"), False,
+                                              None, 1, 1.0, 1, None, "stream", output_mode, table=table)
+            with open(jsonl) as rows:
+                tables[output_mode] = [json.loads(row) for row in rows]
+            with open(bedpe) as lines:
+                columns = [line.rstrip("\n").split("\t") for line in lines]
+            assert FusionTable.BEDPE_COLUMNS == [columns[0][0][1:]] + columns[0][1:]
+            assert len(tables[output_mode]) == table.rows == len(columns) - 1
+        pictures = [row.pop("picture") for row in tables["files"]]
+        assert sorted(pictures) == sorted(name for name in os.listdir(str(tmp_path)) if name.endswith(".svg"))
+        assert all(row.pop("picture") is None for row in tables["none"])
+        # the geometry is the same without the pictures
+        assert tables["files"] == tables["none"]
+        row = next(row for row in tables["none"] if row["sv_type"] == "BND")
+        # both ends of the translocation, and the genes with their strands
+        assert row["breakpoints"][0][0] != row["breakpoints"][1][0]
+        assert data.gene_model(row["prime5"]["ID"]) is not None and data.gene_model(row["prime3"]["ID"]) is not None
+        assert row["prime5"]["strand"] in (1, -1) and row["exons5"] and row["exons3"]
+
+    def test_AnnotationIndex(self, tmp_path):
+        import pickle
+        from vcffuse import AnnotationIndex, SyntheticData
+        data = SyntheticData.SyntheticData(20)
+        store = data.fill_store(AnnotationStore.AnnotationStore(str(tmp_path / "annotation.sqlite")))
+        store.put_missing("ENSG00000000001")
+        path = str(tmp_path / "annotation.vfi")
+        count = AnnotationIndex.build_index([AnnotationIndex.annotation_from_json(TEST_DIR),
+                                             AnnotationIndex.annotation_from_store(store.path)], path)
+        index = AnnotationIndex.AnnotationIndex(path)
+        assert count == len(index) == len(list(store.items())) + 1
+        for ENS_ID, _ in data.gene_models():
+            expected = store.get(ENS_ID)
+            found = index.lookup(ENS_ID + ".12")
+            assert (expected[0], expected[1], expected[3], sorted(expected[4])) == \
+                (found[0], found[1], found[3], sorted(found[4]))
+        with open(os.path.join(TEST_DIR, "ENST00000343882.json")) as json_file:
+            expected = AnnotationStore.coords_from_json(json.load(json_file))
+        chromosome, strand, name, starts, ends = index.exons("ENST00000343882")
+        assert (expected[0], expected[1], expected[3]) == (chromosome, strand, name)
+        assert [(iv.begin, iv.end) for iv in sorted(expected[4])] == list(zip(starts, ends))
+        assert "ENSG00000000001" not in index and index.lookup("ENSG00000000001") is None
+        # the other process maps the file on its own
+        assert "ENST00000343882" in pickle.loads(pickle.dumps(index))
+
+    def test_json2bed(self, tmp_path, monkeypatch):
+        import gzip
+        from vcffuse import json2bed, SyntheticData
+        with open(os.path.join(TEST_DIR, "ENST00000343882.json")) as json_file:
+            obj = json.load(json_file)
+        monkeypatch.chdir(tmp_path)
+        # a single transcript (no 'Transcript' list) is written as well
+        json2bed.print_coords_from_json(obj)
+        assert len([name for name in os.listdir(tmp_path) if name.endswith("_ENST00000343882.bed")]) == 1
+        data = SyntheticData.SyntheticData(20)
+        store = data.fill_store(AnnotationStore.AnnotationStore(str(tmp_path / "annotation.sqlite")))
+        models = dict(data.gene_models())
+        for ENS_ID, model in models.items():
+            with open(ENS_ID + ".json", "w") as json_file:
+                json.dump(model, json_file)
+        IDs = list(models) + ["ENSG00000000001"]
+        count, failed = json2bed.make_bulk_bed("ids.bed", IDs, rest=False)
+        assert failed == ["ENSG00000000001"]
+        with open("ids.bed") as bed:
+            lines = bed.readlines()
+        assert count == len(lines) == sum(len(model.get("Transcript", [model])) for model in models.values())
+        # the same with processes, in the same order
+        assert json2bed.make_bulk_bed("jobs.bed", IDs, rest=False, jobs=2)[0] == count
+        with open("jobs.bed") as bed:
+            assert bed.readlines() == lines
+        for line in lines:
+            chromosome, start, end, name, _, strand, _, _, _, blocks, sizes, starts = line.rstrip("\n").split("\t")
+            sizes, starts = [int(size) for size in sizes.split(",")[:-1]], [int(st) for st in starts.split(",")[:-1]]
+            assert int(blocks) == len(sizes) == len(starts) and starts[0] == 0
+            assert int(start) + starts[-1] + sizes[-1] == int(end)
+        # the cache, compressed and sorted
+        json2bed.make_bulk_bed("cache.bed.gz", from_cache=store.path, bgzip=True, sort=True)
+        with gzip.open("cache.bed.gz", "rt") as bed:
+            cached = bed.readlines()
+        assert len(cached) == len(list(store.items()))
+        assert cached == sorted(cached, key=json2bed.bed_sort_key)
+        assert sorted(line.split("\t")[3] for line in cached) == \
+            sorted(name + "_" + ENS_ID for ENS_ID, (_, _, name, _) in store.items())
+
+    def test_vcffuse_command(self):
+        import subprocess
+        import sys
+        # a fresh interpreter, the other tests have imported everything already
+        script = ("import sys\n"
+                  "from vcffuse.vcffuse import main\n"
+                  "for args in (['--help'], ['dump', '--help'], ['fuse', '--help']):\n"
+                  "    try:\n"
+                  "        main(args)\n"
+                  "    except SystemExit:\n"
+                  "        pass\n"
+                  "    modules = ('requests', 'svgwrite', 'intervaltree')\n"
+                  "    print('loaded', args[0], *[m for m in modules if m in sys.modules])\n")
+        output = subprocess.run([sys.executable, "-c", script], cwd=os.path.dirname(TEST_DIR), check=True,
+                                stdout=subprocess.PIPE, universal_newlines=True).stdout
+        assert "Draw the gene fusions of a VCF" in output and "--vcf" in output
+        # fuse needs the intervals, but not the REST client and the svgwrite DOM before it uses them
+        assert [line for line in output.splitlines() if line.startswith("loaded ")] == \
+            ["loaded --help", "loaded dump", "loaded fuse intervaltree"]
+
+    def test_ShardedVCF(self, tmp_path, monkeypatch, caplog):
+        from vcffuse import BGZF, FusionTable, ShardedVCF, SyntheticData, getFusionFromVCF
+        data = SyntheticData.SyntheticData(60)
+        data.write_gene_models(str(tmp_path))
+        lines = [line + "\n" for line in data.vcf_lines()]
+        # a translocation without its mate
+        lines.remove(next(line for line in lines if "MantaBND" in line))
+        with open(str(tmp_path / "synthetic.vcf"), "w") as vcf, \
+                BGZF.BGZFWriter(str(tmp_path / "synthetic.vcf.gz")) as gz:
+            vcf.write("".join(lines))
+            gz.write("".join(lines))
+        ShardedVCF.write_tabix_index(str(tmp_path / "synthetic.vcf.gz"))
+        records = [line for line in lines if line[0] != "#"]
+        for path, shard_size in [("synthetic.vcf", None), ("synthetic.vcf.gz", None), ("synthetic.vcf.gz", 5000000)]:
+            shards = ShardedVCF.plan_shards(str(tmp_path / path), 7, shard_size)
+            assert len(shards) > 1
+            # every record once, in file order
+            assert records == [line for shard in shards for line in ShardedVCF.read_shard(shard) if line[0] != "#"]
+        # records on the first base of a shard, when the shards start at the windows of the tabix linear index
+        positions = [1, 100, 16383, 16384, 16385, 20000, 32768, 40000, 49152, 65536, 65537]
+        with BGZF.BGZFWriter(str(tmp_path / "aligned.vcf.gz")) as gz:
+            gz.write("".join(lines[:next(i for i, line in enumerate(lines) if line[0] != "#")]))
+            gz.write("".join("chr1\t%d\tr%d\tN\tN[chr2:1[\t.\tPASS\tSVTYPE=BND\n" % (pos, pos) for pos in positions))
+        ShardedVCF.write_tabix_index(str(tmp_path / "aligned.vcf.gz"))
+        for shard_size in [16384, 32768, 1 << 20]:
+            shards = ShardedVCF.plan_shards(str(tmp_path / "aligned.vcf.gz"), 1, shard_size)
+            assert ["r%d" % pos for pos in positions] == \
+                [line.split("\t")[2] for shard in shards for line in ShardedVCF.read_shard(shard)]
+        monkeypatch.chdir(tmp_path)
+        runs = {}
+        # the shards keep all their breakends, the window is not used
+        for name, path, jobs, shard_size, bnd_window in [("serial", "synthetic.vcf", 1, None, None),
+                                                         ("plain", "synthetic.vcf", 2, None, None),
+                                                         ("indexed", "synthetic.vcf.gz", 2, 5000000, 1000)]:
+            with FusionTable.FusionTableWriter(jsonl=name + ".jsonl") as table:
+                getFusionFromVCF.make_fusions(path, name + ".svg", False, str(tmp_path / "annotation.sqlite"), False,
+                                              None, 1, 1.0, jobs, bnd_window, "stream", "gallery", table=table,
+                                              shard=True, shard_size=shard_size)
+            with open(name + ".jsonl") as rows, open(name + ".html") as gallery:
+                # the pictures are named after the run
+                runs[name] = rows.read().replace(name, ""), gallery.read().replace(name, "")
+        # the same rows and pictures in the same order, the translocations across shards are paired as well
+        assert runs["serial"][0].count("\n") > 60
+        assert runs["serial"] == runs["plain"]
+        assert runs["serial"][0] == runs["indexed"][0]
+        assert 1 == sum("--bnd-window is not used" in message for message in caplog.messages)
+
+    def test_RunManifest(self, tmp_path, monkeypatch):
+        from vcffuse import FusionTable, Metrics, RunManifest, SyntheticData, getFusionFromVCF
+        data = SyntheticData.SyntheticData(30)
+        data.write_gene_models(str(tmp_path))
+        lines = [line + "\n" for line in data.vcf_lines()]
+        monkeypatch.chdir(tmp_path)
+
+        def run(name, settings=("files",)):
+            with open("synthetic.vcf", "w") as vcf:
+                vcf.write("".join(lines))
+            Metrics.registry.reset()
+            manifest = RunManifest.RunManifest("run.manifest", settings)
+            with FusionTable.FusionTableWriter(jsonl=name + ".jsonl") as table:
+                getFusionFromVCF.make_fusions("synthetic.vcf", "run.svg", False, str(tmp_path / "annotation.sqlite"),
+                                              False, None, 1, 1.0, 1, None, "stream", table=table, manifest=manifest)
+            with open(name + ".jsonl") as rows:
+                return Metrics.registry.counters.get("resumed_records", 0), rows.read(), manifest
+
+        resumed, first, manifest = run("first")
+        assert resumed == 0
+        counts = manifest.counts()
+        assert counts.get(RunManifest.DONE, 0) > 10
+        records = sum(counts.values())
+        # nothing changed, everything is taken from the manifest with the same rows
+        resumed, second, _ = run("second")
+        assert resumed == records
+        assert second == first
+        # a changed record and a removed picture are made again, only those
+        entries = [(line.split("\t")[2], manifest.get(line.split("\t")[2])) for line in lines if line[0] != "#"]
+        record_ID, outputs = next((record_ID, entry[2]) for record_ID, entry in entries if entry and entry[2])
+        os.remove(outputs[0])
+        changed = next(i for i, line in enumerate(lines) if line[0] != "#" and line.split("\t")[2] != record_ID
+                       and "SVTYPE=BND" not in line)
+        columns = lines[changed].split("\t")
+        columns[7] += ";RESUMED=0"
+        lines[changed] = "\t".join(columns)
+        resumed, third, _ = run("third")
+        assert resumed == records - 2
+        assert os.path.exists(outputs[0])
+        assert third == first
+        # other settings, other pictures: the manifest starts over
+        resumed, _, manifest = run("fourth", ("gallery",))
+        assert resumed == 0
+        assert sum(manifest.counts().values()) == records
+        # so do an other REST server and an edited GTF, even with the same file name
+        from click.testing import CliRunner
+        data.fill_store(AnnotationStore.AnnotationStore(str(tmp_path / "store.sqlite"))).close()
+        gtf = tmp_path / "empty.gtf"
+        gtf.write_text("")
+        resumed = []
+        for server, gtf_lines in [("http://a", ""), ("http://a", ""), ("http://b", ""), ("http://b", "#\n")]:
+            if gtf.read_text() != gtf_lines:
+                gtf.write_text(gtf_lines)
+            Metrics.registry.reset()
+            result = CliRunner().invoke(getFusionFromVCF.print_SV, [
+                "--vcf", "synthetic.vcf", "--svg", "cli.svg", "--svg-backend", "stream", "--cache", "store.sqlite",
+                "--gtf", str(gtf), "--server", server, "--manifest", "cli.manifest", "--log-level", "ERROR"])
+            assert 0 == result.exit_code, result.output
+            resumed.append(Metrics.registry.counters.get("resumed_records", 0))
+        assert [0, records, 0, 0] == resumed
+
+    def test_malformed_annotation(self, tmp_path, monkeypatch):
+        import re
+        from vcffuse import Metrics, RunManifest, SyntheticData, getFusionFromVCF
+        data = SyntheticData.SyntheticData(10)
+        data.write_gene_models(str(tmp_path))
+        records = [line.split("\t") for line in data.vcf_lines() if line[0] != "#"]
+        # a translocation pair without the transcripts in HGVS.p, and a deletion with a single gene ID
+        bad_BND = next(columns[2] for columns in records if "SVTYPE=BND" in columns[7])
+        bad_DEL = next(columns[2] for columns in records if "SVTYPE=DEL" in columns[7])
+        with open(str(tmp_path / "malformed.vcf"), "w") as vcf:
+            for line in data.vcf_lines():
+                if "SVTYPE=BND" in line:
+                    line = re.sub(r"\|t\(\d+%3B\d+\)\(ENST[^|]*\)\|", "||", line)
+                elif bad_DEL in line:
+                    line = re.sub(r"\|(ENSG\d+)&ENSG\d+\|", r"|\1|", line)
+                vcf.write(line + "\n")
+        monkeypatch.chdir(tmp_path)
+        manifest = RunManifest.RunManifest("run.manifest", ("files",))
+        for _ in range(2):
+            Metrics.registry.reset()
+            # the bad records cost only themselves, the run goes on
+            getFusionFromVCF.make_fusions("malformed.vcf", "run.svg", False, str(tmp_path / "annotation.sqlite"),
+                                          False, None, 1, 1.0, 1, None, "stream", manifest=manifest)
+            assert 1 == Metrics.registry.counters.get("failed_records", 0)
+            assert RunManifest.FAILED == manifest.get(bad_DEL)[1]
+            # the translocation is done, only it has no picture
+            mate = re.search("MATEID=([^;]+)", next(c[7] for c in records if c[2] == bad_BND)).group(1)
+            assert [RunManifest.DONE, []] == list((manifest.get(bad_BND) or manifest.get(mate))[1:3])
+        # the second run takes everything from the manifest but the failed record
+        assert sum(manifest.counts().values()) - 1 == Metrics.registry.counters.get("resumed_records", 0)
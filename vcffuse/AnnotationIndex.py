@@ -0,0 +1,305 @@
+"""
+Compiled, memory-mapped annotation: a binary file with a sorted table of the ENSEMBL IDs, and for each ID
+the chromosome, the strand, the name and a slice of the exon start and end arrays. Opening it reads
+only the header, a lookup is a binary search plus a slice of the map, so it costs the same for 100 or
+250000 transcripts, and all the worker processes share the pages of the file.
+
+    python -m vcffuse.AnnotationIndex build --gtf Homo_sapiens.GRCh38.110.gtf.gz -o GRCh38.vfi
+    python -m vcffuse.getFusionFromVCF --index GRCh38.vfi ...
+
+Layout (little-endian): header, IDs (fixed width, zero padded, sorted), records, exon starts (uint32),
+exon ends (uint32), strings (uint16 length + UTF-8). Genes point to the exons of their canonical transcript.
+"""
+import glob
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+from array import array
+import click
+from intervaltree import Interval, IntervalTree
+from vcffuse import AnnotationStore
+from vcffuse.GTFAnnotation import GTFAnnotation, strip_version
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"VCFFUSEI"
+VERSION = 1
+# magic, version, number of IDs, ID width, number of exons, offsets of IDs, records, starts, ends and strings
+HEADER = struct.Struct("<8sIIIIQQQQQ")
+# first exon, number of exons, chromosome and name (offsets in the strings), strand
+RECORD = struct.Struct("<IIIIb3x")
+
+
+def align(offset, to=8):
+    return (offset + to - 1) // to * to
+
+
+class AnnotationIndex:
+    """
+    Annotation backend reading a file made by build_index()
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._file = None
+        self._map = None
+        self._pid = None
+        self._header = None
+        self._open()
+
+    def _open(self):
+        # a map can not go to an other process, each one maps the file on its own (and shares the pages)
+        if self._map is None or self._pid != os.getpid():
+            self._file = open(self._path, "rb")
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._pid = os.getpid()
+            header = HEADER.unpack_from(self._map, 0)
+            if header[0] != MAGIC or header[1] != VERSION:
+                raise ValueError(self._path + " is not a vcffuse annotation index (version " + str(VERSION) + ")")
+            self._header = header
+        return self._map
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_file"] = None
+        state["_map"] = None
+        state["_pid"] = None
+        return state
+
+    def close(self):
+        if self._map is not None and self._pid == os.getpid():
+            self._map.close()
+            self._file.close()
+        self._map = None
+        self._file = None
+
+    @property
+    def path(self):
+        return self._path
+
+    def __len__(self):
+        return self._header[2]
+
+    def _find(self, ENS_ID):
+        """
+        :return: number of the ID in the table, or -1
+        """
+        mm = self._open()
+        _, _, count, width, _, ids, _, _, _, _ = self._header
+        key = strip_version(ENS_ID).encode("ascii", "replace")
+        if len(key) > width:
+            return -1
+        key = key.ljust(width, b"\0")
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            start = ids + middle * width
+            if mm[start:start + width] < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < count and mm[ids + low * width:ids + (low + 1) * width] == key:
+            return low
+        return -1
+
+    def ids(self):
+        """
+        Yields the IDs in the index, in sorted order
+        """
+        mm = self._open()
+        _, _, count, width, _, ids, _, _, _, _ = self._header
+        for i in range(count):
+            yield mm[ids + i * width:ids + (i + 1) * width].rstrip(b"\0").decode("ascii")
+
+    def __contains__(self, ENS_ID):
+        return self._find(ENS_ID) >= 0
+
+    def _string(self, offset):
+        start = self._header[9] + offset
+        length, = struct.unpack_from("<H", self._map, start)
+        return self._map[start + 2:start + 2 + length].decode("utf-8")
+
+    def exons(self, ENS_ID):
+        """
+        :return: (chromosome, strand, name, exon starts, exon ends) with the starts and ends as memoryviews
+        of the map (no copy), or None if the ID is not in the index
+        """
+        found = self._find(ENS_ID)
+        if found < 0:
+            return None
+        first, count, chromosome, name, strand = RECORD.unpack_from(self._map, self._header[6] + found * RECORD.size)
+        view = memoryview(self._map)
+        starts = view[self._header[7] + first * 4:self._header[7] + (first + count) * 4]
+        ends = view[self._header[8] + first * 4:self._header[8] + (first + count) * 4]
+        if sys.byteorder == "little":
+            starts, ends = starts.cast("I"), ends.cast("I")
+        else:
+            starts, ends = array("I", starts.tobytes()), array("I", ends.tobytes())
+            starts.byteswap()
+            ends.byteswap()
+        return self._string(chromosome), strand, self._string(name), starts, ends
+
+    def lookup(self, ENS_ID):
+        """
+        :return: (chromosome, strand, 0, display name, IntervalTree) like get_CDS_coords(),
+        or None if the ID is not in the index
+        """
+        found = self.exons(ENS_ID)
+        if found is None:
+            return None
+        chromosome, strand, name, starts, ends = found
+        return chromosome, strand, 0, name, IntervalTree(Interval(s, e) for s, e in zip(starts, ends))
+
+
+def exon_tuples(coords):
+    """
+    Sorted (start, end) tuples of the IntervalTree in (chromosome, strand, breakpoint, name, IntervalTree)
+    """
+    return tuple((iv.begin, iv.end) for iv in sorted(coords[4]))
+
+
+def annotation_from_gtf(path):
+    """
+    Yields (ID, (chromosome, strand, name, exons)) for the genes and transcripts of a GTF or GFF3
+    """
+    annotation = GTFAnnotation(path)
+    for ENS_ID in annotation.ids():
+        coords = annotation.build(ENS_ID)
+        yield ENS_ID, (coords[0], coords[1], coords[3], exon_tuples(coords))
+
+
+def annotation_from_json(directory):
+    """
+    Yields the same for a directory of ENSEMBL lookup JSONs named <ID>.json (like the ones --no-rest reads),
+    genes with all their transcripts
+    """
+    for path in sorted(glob.glob(os.path.join(directory, "*.json"))):
+        with open(path, "r") as json_file:
+            try:
+                obj = json.loads(json_file.read())
+            except ValueError:
+                logger.warning("Skipping %s, it is not JSON", path)
+                continue
+        if not isinstance(obj, dict) or "seq_region_name" not in obj:
+            continue
+        coords = AnnotationStore.coords_from_json(obj)
+        yield strip_version(os.path.basename(path)[:-5]), (coords[0], coords[1], coords[3], exon_tuples(coords))
+        for transcript in obj.get("Transcript", []):
+            # the transcripts of a gene are on the same place
+            transcript = dict({"seq_region_name": obj["seq_region_name"], "strand": obj["strand"]}, **transcript)
+            transcript.pop("Transcript", None)
+            coords = AnnotationStore.coords_from_json(transcript)
+            yield strip_version(transcript["id"]), (coords[0], coords[1], coords[3], exon_tuples(coords))
+
+
+def annotation_from_store(path):
+    """
+    Yields the same for the IDs of an AnnotationStore (the --cache of the runs)
+    """
+    store = AnnotationStore.AnnotationStore(path)
+    for ENS_ID, (chromosome, strand, name, exons) in store.items():
+        yield strip_version(ENS_ID), (chromosome, strand, name, exons)
+    store.close()
+
+
+def build_index(sources, path):
+    """
+    :param sources: iterables of (ID, (chromosome, strand, name, exons)), an ID is taken from the first one having it
+    :return: number of IDs in the index
+    """
+    entries = {}
+    for source in sources:
+        for ENS_ID, annotation in source:
+            entries.setdefault(ENS_ID, annotation)
+    IDs = sorted(entries)
+    keys = [ENS_ID.encode("ascii", "replace") for ENS_ID in IDs]
+    width = max((len(key) for key in keys), default=1)
+    starts, ends = array("I"), array("I")
+    exon_slices = {}  # a gene and its canonical transcript share the exons
+    strings = bytearray()
+    string_offsets = {}
+    records = bytearray()
+
+    def string(value):
+        if value not in string_offsets:
+            encoded = value.encode("utf-8")[:0xffff]
+            string_offsets[value] = len(strings)
+            strings.extend(struct.pack("<H", len(encoded)) + encoded)
+        return string_offsets[value]
+
+    for ENS_ID in IDs:
+        chromosome, strand, name, exons = entries[ENS_ID]
+        if exons not in exon_slices:
+            exon_slices[exons] = len(starts)
+            for start, end in exons:
+                starts.append(start)
+                ends.append(end)
+        records += RECORD.pack(exon_slices[exons], len(exons), string(chromosome), string(name or ENS_ID),
+                               1 if strand > 0 else -1)
+    if sys.byteorder != "little":
+        starts.byteswap()
+        ends.byteswap()
+    offsets = [align(HEADER.size)]
+    for size in (len(keys) * width, len(records), len(starts) * 4, len(ends) * 4):
+        offsets.append(align(offsets[-1] + size))
+    with open(path + ".tmp", "wb") as index:
+        index.write(HEADER.pack(MAGIC, VERSION, len(keys), width, len(starts), *offsets))
+        for offset, chunk in zip(offsets, (b"".join(key.ljust(width, b"\0") for key in keys), records,
+                                           starts.tobytes(), ends.tobytes(), strings)):
+            index.write(b"\0" * (offset - index.tell()))
+            index.write(chunk)
+    # readers never see a half-written index
+    os.replace(path + ".tmp", path)
+    logger.info("%d IDs with %d distinct exons in %s", len(keys), len(starts), path)
+    return len(keys)
+
+
+@click.group(context_settings=dict(help_option_names=['-h', '--help']))
+def index():
+    """
+    Builds and queries memory-mapped annotation indexes
+    """
+
+
+@index.command()
+@click.option('--out', '-o', type=str, required=True, help='The index file to write')
+@click.option('--gtf', '-g', type=str, multiple=True, help='ENSEMBL GTF or GFF3 (can be gzipped)')
+@click.option('--json', '-j', 'json_dirs', type=str, multiple=True,
+              help='Directory of ENSEMBL lookup JSON files named <ENSEMBL ID>.json')
+@click.option('--cache', '-c', type=str, multiple=True, help='SQLite annotation store of earlier runs')
+def build(out, gtf, json_dirs, cache):
+    """
+    Compiles annotation into an index, an ID is taken from the first source having it (GTFs, JSONs, caches)
+    """
+    logging.basicConfig(level="INFO", format="%(message)s")
+    if not (gtf or json_dirs or cache):
+        raise click.UsageError("Give at least one --gtf, --json or --cache")
+    sources = ([annotation_from_gtf(path) for path in gtf] + [annotation_from_json(path) for path in json_dirs] +
+               [annotation_from_store(path) for path in cache])
+    build_index(sources, out)
+
+
+@index.command()
+@click.argument('path')
+@click.argument('ENS_IDs', nargs=-1)
+def show(path, ens_ids):
+    """
+    Prints the size of an index, and the exons of the IDs as BED
+    """
+    annotation = AnnotationIndex(path)
+    click.echo(path + ": " + str(len(annotation)) + " IDs")
+    for ENS_ID in ens_ids:
+        found = annotation.exons(ENS_ID)
+        if found is None:
+            click.echo(ENS_ID + " is not in the index", err=True)
+            continue
+        chromosome, strand, name, starts, ends = found
+        for start, end in zip(starts, ends):
+            click.echo("\t".join((chromosome, str(start), str(end), name, ".", "+" if strand > 0 else "-")))
+
+
+if __name__ == "__main__":
+    index()
@@ -0,0 +1,208 @@
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from intervaltree import Interval, IntervalTree
+
+logger = logging.getLogger(__name__)
+
+
+def default_store_path():
+    """
+    Location of the shared annotation store: $VCFFUSE_CACHE if it is set,
+    ~/.cache/vcffuse/annotation.sqlite otherwise
+    """
+    if os.environ.get("VCFFUSE_CACHE"):
+        return os.environ["VCFFUSE_CACHE"]
+    return os.path.join(os.path.expanduser("~"), ".cache", "vcffuse", "annotation.sqlite")
+
+
+def read_from_json(obj):
+    intree = IntervalTree()
+    # if we have a whole gene with many transcripts,
+    # find the canonical one:
+    if 'Transcript' in obj.keys():
+        for trs in obj['Transcript']:
+            # go only for the canonical one
+            if trs['is_canonical'] > 0:
+                logger.debug("Using canonical transcript %s / %s", trs['id'], trs['display_name'])
+                for exon in trs['Exon']:
+                    intree.add(Interval(exon['start'], exon['end']))
+    else:
+        # it is a single transcript only
+        logger.debug("Using transcript %s / %s", obj['id'], obj['display_name'])
+        for exon in obj['Exon']:
+            intree.add(Interval(exon['start'], exon['end']))
+
+    intree.merge_overlaps()
+    return intree
+
+
+def coords_from_json(obj):
+    """
+    Turns an ENSEMBL REST lookup object into the
+    (chromosome, strand, breakpoint, gene name, exons) tuple that ExonCoords.fromTuple() eats
+    """
+    chromosome = "chr" + str(obj['seq_region_name'])
+    exon_intervals = read_from_json(obj)
+    return (chromosome, obj['strand'], 0, obj['display_name'], IntervalTree(sorted(exon_intervals.items())))
+
+
+class AnnotationNotFound(LookupError):
+    """
+    The ID is known to be missing from ENSEMBL (negative cache hit)
+    """
+    pass
+
+
+class AnnotationStore:
+    """
+    On-disk (SQLite) store of canonical exon intervals keyed by ENSEMBL ID, with an
+    in-memory LRU in front of it. IDs that ENSEMBL does not know are stored as well,
+    so we are not asking for them again and again.
+    Each row is written in a single transaction, and the database is in WAL mode,
+    so several processes on the same node can share one store.
+    """
+    MISSING = object()  # negative cache marker in the LRU
+
+    def __init__(self, path=None, lru_size=4096, timeout=60.0):
+        self._path = path if path is not None else default_store_path()
+        self._lru_size = lru_size
+        self._timeout = timeout
+        self._lru = OrderedDict()
+        self._conn = None
+        self._pid = None
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def lru_size(self):
+        return self._lru_size
+
+    @lru_size.setter
+    def lru_size(self, value):
+        self._lru_size = value
+
+    def _connection(self):
+        # connections must not be shared across fork(), so open a new one in each process
+        if self._conn is None or self._pid != os.getpid():
+            directory = os.path.dirname(os.path.abspath(self._path))
+            os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self._path, timeout=self._timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS annotation ("
+                         "ens_id TEXT PRIMARY KEY, "
+                         "chromosome TEXT, "
+                         "strand INTEGER, "
+                         "gene_name TEXT, "
+                         "exons TEXT, "
+                         "missing INTEGER NOT NULL DEFAULT 0, "
+                         "updated REAL)")
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def __getstate__(self):
+        # the connection stays in this process, the other one opens its own
+        state = self.__dict__.copy()
+        state["_conn"] = None
+        state["_pid"] = None
+        return state
+
+    def close(self):
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+
+    def _remember(self, ens_id, value):
+        self._lru[ens_id] = value
+        self._lru.move_to_end(ens_id)
+        while len(self._lru) > self._lru_size:
+            self._lru.popitem(last=False)
+
+    @staticmethod
+    def _as_tuple(row):
+        # row is (chromosome, strand, gene name, [[start, end], ...])
+        return (row[0], row[1], 0, row[2], IntervalTree(Interval(s, e) for s, e in row[3]))
+
+    def _fetch(self, ens_id):
+        """
+        Returns with the cached row, MISSING or None if we know nothing about the ID
+        """
+        if ens_id in self._lru:
+            self._lru.move_to_end(ens_id)
+            return self._lru[ens_id]
+        cur = self._connection().execute(
+            "SELECT chromosome, strand, gene_name, exons, missing FROM annotation WHERE ens_id = ?", (ens_id,))
+        found = cur.fetchone()
+        if found is None:
+            return None
+        if found[4]:
+            value = self.MISSING
+        else:
+            value = (found[0], found[1], found[2], tuple(tuple(ex) for ex in json.loads(found[3])))
+        self._remember(ens_id, value)
+        return value
+
+    def __contains__(self, ens_id):
+        return self._fetch(ens_id) is not None
+
+    def get(self, ens_id):
+        """
+        :return: (chromosome, strand, 0, gene name, IntervalTree) or None if the ID is not stored yet
+        :raises AnnotationNotFound: if the ID is stored as missing from ENSEMBL
+        """
+        value = self._fetch(ens_id)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if value is self.MISSING:
+            raise AnnotationNotFound(ens_id)
+        return self._as_tuple(value)
+
+    def items(self):
+        """
+        Yields (ID, (chromosome, strand, gene name, ((start, end), ...))) for all the IDs that are not missing
+        """
+        cur = self._connection().execute(
+            "SELECT ens_id, chromosome, strand, gene_name, exons FROM annotation WHERE missing = 0 ORDER BY ens_id")
+        for ens_id, chromosome, strand, gene_name, exons in cur:
+            yield ens_id, (chromosome, strand, gene_name, tuple(tuple(ex) for ex in json.loads(exons)))
+
+    def is_missing(self, ens_id):
+        return self._fetch(ens_id) is self.MISSING
+
+    def _write(self, ens_id, chromosome, strand, gene_name, exons, missing):
+        conn = self._connection()
+        # BEGIN IMMEDIATE takes the write lock up front, so concurrent writers queue up
+        # instead of failing half-way; the row is either there completely or not at all
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("INSERT OR REPLACE INTO annotation "
+                         "(ens_id, chromosome, strand, gene_name, exons, missing, updated) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (ens_id, chromosome, strand, gene_name, exons, missing, time.time()))
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def put(self, ens_id, coords: tuple):
+        """
+        Stores a (chromosome, strand, breakpoint, gene name, IntervalTree) tuple
+        """
+        exons = tuple((iv.begin, iv.end) for iv in sorted(coords[4]))
+        self._write(ens_id, coords[0], coords[1], coords[3], json.dumps(exons), 0)
+        self._remember(ens_id, (coords[0], coords[1], coords[3], exons))
+
+    def put_missing(self, ens_id):
+        self._write(ens_id, None, None, None, None, 1)
+        self._remember(ens_id, self.MISSING)
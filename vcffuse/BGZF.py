@@ -0,0 +1,112 @@
+"""
+Writer and block reader of BGZF (blocked gzip) files, the compression tabix and IGV can index and seek in.
+Each block is a gzip member of at most 64k, with its compressed size in a BC extra field,
+and the file ends with an empty block. Plain gzip readers (and VCFReader.open_text) read it as well.
+A place in the file is a virtual offset: the offset of the block in the file << 16 | the offset in the block.
+"""
+import struct
+import zlib
+
+# uncompressed bytes in a block, the same as htslib uses
+BLOCK_SIZE = 0xff00
+MAX_BLOCK = 1 << 16
+# gzip header with the BC extra field, and the size of the block - 1 at the end
+HEADER = struct.Struct("<BBBBIBBHBBHH")
+EOF_BLOCK = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+
+def compress_block(data: bytes, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    size = HEADER.size + len(deflated) + 8
+    if size > MAX_BLOCK:
+        # hardly compressible data, halve it
+        half = len(data) // 2
+        return compress_block(data[:half], level) + compress_block(data[half:], level)
+    return (HEADER.pack(31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, size - 1) + deflated +
+            struct.pack("<II", zlib.crc32(data), len(data)))
+
+
+class BGZFWriter:
+    """
+    Text (or binary) file writer: the data is collected into full blocks, and each block is compressed when it is full
+    """
+
+    def __init__(self, path, level=6, encoding="utf-8"):
+        self._out = open(path, "wb", buffering=1 << 20)
+        self._level = level
+        self._encoding = encoding
+        self._buffer = bytearray()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, text: str):
+        self.write_bytes(text.encode(self._encoding))
+
+    def write_bytes(self, data: bytes):
+        self._buffer += data
+        if len(self._buffer) >= BLOCK_SIZE:
+            self._flush_blocks(full_only=True)
+
+    def _flush_blocks(self, full_only=False):
+        start = 0
+        while len(self._buffer) - start >= BLOCK_SIZE or (not full_only and start < len(self._buffer)):
+            chunk = bytes(self._buffer[start:start + BLOCK_SIZE])
+            self._out.write(compress_block(chunk, self._level))
+            start += len(chunk)
+        del self._buffer[:start]
+
+    def close(self):
+        if self._out is None:
+            return
+        self._flush_blocks()
+        self._out.write(EOF_BLOCK)
+        self._out.close()
+        self._out = None
+
+
+def blocks(path):
+    """
+    Yields (offset of the block in the file, uncompressed data) for the blocks of a BGZF file
+    """
+    with open(path, "rb", buffering=1 << 20) as bgzf:
+        offset = 0
+        while True:
+            header = bgzf.read(HEADER.size)
+            if not header:
+                return
+            if len(header) < HEADER.size or header[:4] != b"\x1f\x8b\x08\x04" or header[12:14] != b"BC":
+                raise ValueError(path + " is not BGZF")
+            size = HEADER.unpack(header)[-1] + 1
+            deflated = bgzf.read(size - HEADER.size)
+            yield offset, zlib.decompress(deflated[:-8], -15)
+            offset += size
+
+
+def lines(path):
+    """
+    Yields (virtual offset of the line, virtual offset after the line, line without the new line as bytes)
+    """
+    pending = b""   # start of a line that goes on in the next block
+    start = None
+    last = 0
+    for offset, data in blocks(path):
+        last = (offset << 16) | len(data)
+        position = 0
+        while position < len(data):
+            if start is None:
+                start = (offset << 16) | position
+            end = data.find(b"\n", position)
+            if end < 0:
+                pending += data[position:]
+                break
+            yield start, (offset << 16) | (end + 1), pending + data[position:end]
+            pending = b""
+            start = None
+            position = end + 1
+    if pending:
+        yield start, last, pending
@@ -0,0 +1,114 @@
+import heapq
+import re
+
+# the mate position in a breakend ALT like T]CHR15:88000021] or [chr8:108561001[T
+mate_position_re = re.compile("[\\[\\]]([^\\[\\]:]+):([0-9]+)[\\[\\]]")
+
+
+def mate_position(alt: str):
+    """
+    :return: (lowercase chromosome, position) of the mate from a breakend ALT, or None
+    """
+    found = mate_position_re.search(alt)
+    if found is None:
+        return None
+    return found.group(1).lower(), int(found.group(2))
+
+
+class BreakendPairer:
+    """
+    Pairs the two breakends of Manta translocations by MATEID (or by EVENT if there is no MATEID),
+    regardless of which one comes first. A breakend is kept only until its mate arrives.
+    If max_distance is given the input is expected to be coordinate-sorted: once the stream is past
+    the expected mate position by max_distance (or past the whole mate contig), the waiting breakend
+    is dropped as an orphan, so memory stays bounded.
+    """
+
+    def __init__(self, max_distance=None):
+        self._max_distance = max_distance
+        self._pending = {}      # key (our ID, or the EVENT) -> waiting record
+        self._waiting = {}      # mate contig -> heap of (mate position, key)
+        self._finished = set()  # contigs the sorted stream is already past
+        self._contig = None
+        self.orphans = []       # IDs of breakends whose mate never arrived
+        self.pairs = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    @staticmethod
+    def primary(first, second):
+        """
+        We are making the fusion from the point of view of the breakend with the larger ID
+        (MantaBND:...:1 rather than MantaBND:...:0), so the result does not depend on the order
+        """
+        return (first, second) if first.id > second.id else (second, first)
+
+    def add(self, record):
+        """
+        :return: (primary, mate) records if this breakend completes a pair, None otherwise
+        """
+        if self._max_distance is not None:
+            self.advance(record.chrom.lower(), record.pos)
+        mate_ID = record.get("MATEID")
+        if mate_ID is not None:
+            mate = self._pending.pop(mate_ID, None)
+            key = record.id
+        else:
+            key = record.get("EVENT")
+            if key is None:
+                self.orphans.append(record.id)
+                return None
+            mate = self._pending.pop(key, None)
+        if mate is not None:
+            self.pairs += 1
+            return self.primary(record, mate)
+        self._pending[key] = record
+        if self._max_distance is not None:
+            self.wait_for_mate(key, record)
+        return None
+
+    def wait_for_mate(self, key, record):
+        position = mate_position(record.alt)
+        if position is None:
+            return
+        if position[0] in self._finished:
+            # the mate should have been seen already
+            self.evict(key)
+            return
+        heapq.heappush(self._waiting.setdefault(position[0], []), (position[1], key))
+
+    def evict(self, key):
+        record = self._pending.pop(key, None)
+        if record is not None:
+            self.orphans.append(record.id)
+
+    def advance(self, contig, pos):
+        """
+        Drops the breakends whose mates should have been already seen in a sorted stream
+        """
+        if contig != self._contig:
+            if self._contig is not None:
+                self._finished.add(self._contig)
+                for _, key in self._waiting.pop(self._contig, []):
+                    self.evict(key)
+            self._contig = contig
+        heap = self._waiting.get(contig)
+        while heap and heap[0][0] + self._max_distance < pos:
+            self.evict(heapq.heappop(heap)[1])
+
+    def pending(self):
+        """
+        :return: the breakends still waiting for their mates, in the order they came
+        """
+        return list(self._pending.values())
+
+    def flush(self):
+        """
+        End of the input: everything still waiting is an orphan
+        :return: IDs of all the orphans
+        """
+        for key in list(self._pending.keys()):
+            self.evict(key)
+        self._waiting = {}
+        return self.orphans
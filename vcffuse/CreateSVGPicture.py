@@ -1,5 +1,5 @@
 import svgwrite
-from vcffuse import ExonCoords
+from vcffuse import ExonCoords, SVGStream
 from svgwrite import cm, mm
 
 
@@ -8,6 +8,7 @@ class CreateSVGPicture:
         self._width = '100%'
         self._height = '100%'
         self._verbose = False
+        self._backend = "svgwrite"
 
     @property
     def verbose(self):
@@ -17,8 +18,24 @@ class CreateSVGPicture:
     def verbose(self, value):
         self._verbose = value
 
+    @property
+    def backend(self):
+        """
+        "svgwrite" or "stream" (same bytes, written straight to the file, see SVGStream)
+        """
+        return self._backend
+
+    @backend.setter
+    def backend(self, value):
+        self._backend = value
+
     def make_SVG_file(self, fex, svg_file_name, pic_count, prime5name, prime3name):
         outfile = str(pic_count) + "_" + prime5name + "_" + prime3name + "-" + svg_file_name
+        if self._backend == "stream":
+            SVGStream.save_fusion_svg(fex, outfile)
+            if self._verbose:
+                print("Fusion picture is at", outfile)
+            return pic_count + 1
         dwg = svgwrite.Drawing(filename=outfile, size=(self._width, self._height), debug=True)
         # background
         dwg.add(dwg.rect(insert=(0, 0), size=(self._width, self._height), fill='white', stroke='white'))
@@ -42,7 +59,7 @@ class CreateSVGPicture:
 
     def shape_intervals(self, dwg, shapes, itv: ExonCoords, color):
         height = 2 * cm
-        for iv in itv:
+        for iv in sorted(itv):
             if abs(iv.end - iv.begin) > 1:
                 s = iv.begin / 100
                 width = int(abs(iv.end - iv.begin + 100) / 100)
@@ -0,0 +1,230 @@
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_SERVER = "https://rest.ensembl.org"
+# ENSEMBL allows 15 requests per second, see https://github.com/Ensembl/ensembl-rest/wiki/Rate-Limits
+DEFAULT_RATE = 15.0
+# ENSEMBL accepts up to 1000 IDs in a POST, but expanded gene entries are large,
+# so we are asking for them in smaller chunks
+LOOKUP_CHUNK_SIZE = 50
+
+
+def chunks(items: list, size: int):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+_default_client = None
+
+
+def default_client():
+    """
+    Client with the default settings, shared by everybody who did not make an own one.
+    $VCFFUSE_ENSEMBL_SERVER points it to an other server, like a local EnsemblStandIn.
+    """
+    global _default_client
+    if _default_client is None:
+        _default_client = EnsemblClient(server=os.environ.get("VCFFUSE_ENSEMBL_SERVER", DEFAULT_SERVER))
+    return _default_client
+
+
+class EnsemblLookupError(Exception):
+    """
+    We could not get an answer for an ID even after retrying
+    """
+
+    def __init__(self, ENS_ID, reason):
+        super().__init__(str(ENS_ID) + ": " + str(reason))
+        self.ENS_ID = ENS_ID
+        self.reason = reason
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: at most `rate` requests per second on average, with bursts of `capacity`.
+    pause() stops everybody for a while, that is what we do when the server sends a Retry-After.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, capacity=None):
+        self._rate = rate
+        self._capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self._capacity
+        self._last = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now >= self._paused_until:
+                    self._tokens = min(self._capacity, self._tokens + (now - self._last) * self._rate)
+                    self._last = now
+                    if self._tokens >= 1.0:
+                        self._tokens -= 1.0
+                        return
+                    wait = (1.0 - self._tokens) / self._rate
+                else:
+                    wait = self._paused_until - now
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+            self._last = self._paused_until
+
+
+class EnsemblClient:
+    """
+    ENSEMBL REST client shared by all lookups: one pooled keep-alive session, a token bucket
+    for the rate limit, timeouts, and retries with exponential backoff on 429 and 5xx answers.
+    """
+
+    def __init__(self, server=DEFAULT_SERVER, rate=DEFAULT_RATE, workers=4, retries=5, backoff=0.5,
+                 timeout=30.0):
+        self._server = server.rstrip("/")
+        self._workers = workers
+        self._retries = retries
+        self._backoff = backoff
+        self._timeout = timeout
+        self._bucket = TokenBucket(rate)
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    def _open_session(self):
+        # requests is imported on the first request: runs answered from the local annotation do not pay for it
+        with self._session_lock:
+            if self._session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, self._workers))
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                session.headers.update({"Content-Type": "application/json", "Accept": "application/json"})
+                self._session = session
+        return self._session
+
+    @property
+    def server(self):
+        return self._server
+
+    @property
+    def workers(self):
+        return self._workers
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+
+    def retry_wait(self, attempt, response=None):
+        """
+        Seconds to wait before the next attempt: Retry-After if the server told us, exponential backoff otherwise
+        """
+        if response is not None and response.headers.get("Retry-After"):
+            try:
+                return float(response.headers["Retry-After"])
+            except ValueError:
+                pass
+        return self._backoff * (2 ** attempt) * (1.0 + random.random() / 2)
+
+    def request(self, method, ext, ENS_ID=None, **kwargs):
+        """
+        Sends a request, retrying on connection errors, 429 and 5xx.
+        Other answers (also 4xx ones) are returned to the caller.
+        :raises EnsemblLookupError: when we ran out of retries
+        """
+        import requests
+        session = self._session or self._open_session()
+        reason = None
+        for attempt in range(self._retries + 1):
+            self._bucket.acquire()
+            try:
+                r = session.request(method, self._server + ext, timeout=self._timeout, **kwargs)
+            except requests.RequestException as e:
+                reason = e
+                time.sleep(self.retry_wait(attempt))
+                continue
+            if r.status_code == 429 or r.status_code >= 500:
+                reason = "HTTP " + str(r.status_code)
+                wait = self.retry_wait(attempt, r)
+                if r.status_code == 429:
+                    # we are over the limit, everybody should wait
+                    self._bucket.pause(wait)
+                else:
+                    time.sleep(wait)
+                continue
+            return r
+        raise EnsemblLookupError(ENS_ID, reason)
+
+    @staticmethod
+    def answer(r, ENS_ID):
+        """
+        :return: the JSON body of an answer
+        :raises EnsemblLookupError: if it is not JSON, like a truncated or an HTML page from a proxy
+        """
+        try:
+            return r.json()
+        except ValueError:
+            raise EnsemblLookupError(ENS_ID, "invalid JSON")
+
+    def lookup(self, ENS_ID):
+        """
+        :return: the expanded lookup object, or None if ENSEMBL does not know the ID
+        :raises EnsemblLookupError: if we did not get a meaningful answer
+        """
+        r = self.request("GET", "/lookup/id/" + ENS_ID, ENS_ID=ENS_ID, params={"expand": 1})
+        # ENSEMBL is answering with 400 for unknown IDs
+        if r.status_code in (400, 404):
+            return None
+        if not r.ok:
+            raise EnsemblLookupError(ENS_ID, "HTTP " + str(r.status_code))
+        return self.answer(r, ENS_ID)
+
+    def lookup_many(self, ENS_IDs):
+        """
+        Looks up IDs one by one, concurrently
+        :return: (dict of ID -> lookup object or None, dict of ID -> failure reason)
+        """
+        found = {}
+        failed = {}
+
+        def lookup_one(ENS_ID):
+            try:
+                found[ENS_ID] = self.lookup(ENS_ID)
+            except EnsemblLookupError as e:
+                failed[ENS_ID] = e.reason
+
+        with ThreadPoolExecutor(max_workers=max(1, self._workers)) as pool:
+            list(pool.map(lookup_one, ENS_IDs))
+        return found, failed
+
+    def lookup_batch(self, ENS_IDs, chunk_size=LOOKUP_CHUNK_SIZE):
+        """
+        Resolves many IDs with the batch POST /lookup/id endpoint, chunks are sent concurrently
+        :return: (dict of ID -> lookup object or None, dict of ID -> failure reason)
+        """
+        found = {}
+        failed = {}
+
+        def lookup_chunk(chunk):
+            try:
+                r = self.request("POST", "/lookup/id", ENS_ID=chunk[0], params={"expand": 1}, json={"ids": chunk})
+                if not r.ok:
+                    raise EnsemblLookupError(chunk[0], "HTTP " + str(r.status_code))
+                answer = self.answer(r, chunk[0])
+                if not isinstance(answer, dict):
+                    raise EnsemblLookupError(chunk[0], "unexpected answer")
+                for ENS_ID in chunk:
+                    found[ENS_ID] = answer.get(ENS_ID)
+            except EnsemblLookupError as e:
+                for ENS_ID in chunk:
+                    failed[ENS_ID] = e.reason
+
+        with ThreadPoolExecutor(max_workers=max(1, self._workers)) as pool:
+            list(pool.map(lookup_chunk, list(chunks(list(ENS_IDs), chunk_size))))
+        return found, failed
@@ -0,0 +1,219 @@
+"""
+Local stand-in for the ENSEMBL REST lookup endpoints, answering from JSON files like test/ENST00000343882.json,
+so the lookups, the retries and the caching can be tested and benchmarked offline.
+It can be slow (latency), and can answer with 429 + Retry-After or with 5xx errors at random.
+
+    python -m vcffuse.EnsemblStandIn --fixtures test --port 3000 --latency 0.05 --throttle 0.1
+    python -m vcffuse.getFusionFromVCF --server http://localhost:3000 ...
+"""
+import json
+import logging
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+import click
+
+logger = logging.getLogger(__name__)
+
+
+class EnsemblStandIn:
+    """
+    :param fixtures: directory of <ENSEMBL ID>.json files, or a function returning the lookup object
+    of an ID (or None), like dict.get or SyntheticData.gene_model
+    :param latency: seconds each answer takes, plus a random jitter of at most `jitter` seconds
+    :param throttle: probability of a 429 answer with a Retry-After of `retry_after` seconds
+    :param errors: probability of an `error_status` answer
+    """
+
+    def __init__(self, fixtures, host="127.0.0.1", port=0, latency=0.0, jitter=0.0, throttle=0.0,
+                 retry_after=1.0, errors=0.0, error_status=503, seed=None):
+        self.fixtures = fixtures
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle = throttle
+        self.retry_after = retry_after
+        self.errors = errors
+        self.error_status = error_status
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self.stats = {"requests": 0, "ids": 0, "max_in_flight": 0, "status": {}}
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return "http://" + host + ":" + str(port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def serve_forever(self):
+        logger.info("ENSEMBL stand-in is at %s", self.url)
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+
+    def find(self, ENS_ID):
+        """
+        :return: the lookup object of the ID, or None if there is no fixture for it
+        """
+        if callable(self.fixtures):
+            return self.fixtures(ENS_ID)
+        path = os.path.join(self.fixtures, os.path.basename(ENS_ID) + ".json")
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'r') as json_file:
+            return json.loads(json_file.read())
+
+    def fault(self):
+        """
+        :return: (status, headers) of an injected failure, or None if this request should be answered
+        """
+        with self._lock:
+            dice = self._random.random()
+            delay = self.latency + self._random.random() * self.jitter
+        if delay > 0:
+            time.sleep(delay)
+        if dice < self.throttle:
+            return 429, {"Retry-After": str(self.retry_after)}
+        if dice < self.throttle + self.errors:
+            return self.error_status, {}
+        return None
+
+    def _count(self, status):
+        with self._lock:
+            self.stats["status"][status] = self.stats["status"].get(status, 0) + 1
+
+    def _enter(self):
+        with self._lock:
+            self.stats["requests"] += 1
+            self._in_flight += 1
+            self.stats["max_in_flight"] = max(self.stats["max_in_flight"], self._in_flight)
+
+    def _leave(self):
+        with self._lock:
+            self._in_flight -= 1
+
+    def _handler_class(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep-alive, like the real server, so the client can pool its connections
+            protocol_version = "HTTP/1.1"
+            # headers and body are separate writes, without this every answer would wait for a delayed ACK
+            disable_nagle_algorithm = True
+
+            def answer(self, status, obj, headers=None):
+                body = json.dumps(obj).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(body)
+                stand_in._count(status)
+
+            def handle_lookup(self, lookup):
+                stand_in._enter()
+                try:
+                    failure = stand_in.fault()
+                    if failure is not None:
+                        self.answer(failure[0], {"error": "injected failure"}, failure[1])
+                        return
+                    path = urlsplit(self.path).path.rstrip("/")
+                    if path != "/lookup/id" and not path.startswith("/lookup/id/"):
+                        self.answer(404, {"error": "page not found"})
+                        return
+                    lookup(path)
+                finally:
+                    stand_in._leave()
+
+            def do_GET(self):
+                def lookup(path):
+                    ENS_ID = unquote(path[len("/lookup/id/"):])
+                    obj = stand_in.find(ENS_ID) if ENS_ID else None
+                    with stand_in._lock:
+                        stand_in.stats["ids"] += 1
+                    if obj is None:
+                        # ENSEMBL is answering with 400 for unknown IDs
+                        self.answer(400, {"error": "ID '" + ENS_ID + "' not found"})
+                    else:
+                        self.answer(200, obj)
+
+                self.handle_lookup(lookup)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length) if length else b""
+
+                def lookup(path):
+                    try:
+                        ENS_IDs = json.loads(body.decode("utf-8"))["ids"]
+                    except (ValueError, KeyError, TypeError):
+                        self.answer(400, {"error": "POST body should be like {\"ids\": [...]}"})
+                        return
+                    with stand_in._lock:
+                        stand_in.stats["ids"] += len(ENS_IDs)
+                    # unknown IDs are missing from the answer, like at ENSEMBL
+                    answer = {}
+                    for ENS_ID in ENS_IDs:
+                        obj = stand_in.find(ENS_ID)
+                        if obj is not None:
+                            answer[ENS_ID] = obj
+                    self.answer(200, answer)
+
+                self.handle_lookup(lookup)
+
+            def log_message(self, format, *args):
+                logger.debug("%s " + format, self.address_string(), *args)
+
+        return Handler
+
+
+@click.command(context_settings=dict(help_option_names=['-h', '--help']))
+@click.option('--fixtures', '-f', type=str, required=True, help='Directory of <ENSEMBL ID>.json files to serve')
+@click.option('--host', type=str, required=False, default="127.0.0.1", show_default=True)
+@click.option('--port', '-p', type=int, required=False, default=3000, show_default=True)
+@click.option('--latency', type=float, required=False, default=0.0, show_default=True,
+              help='Seconds each answer takes')
+@click.option('--jitter', type=float, required=False, default=0.0, show_default=True,
+              help='Random extra latency, at most this many seconds')
+@click.option('--throttle', type=float, required=False, default=0.0, show_default=True,
+              help='Probability of a 429 answer')
+@click.option('--retry-after', type=float, required=False, default=1.0, show_default=True,
+              help='Retry-After seconds of the 429 answers')
+@click.option('--errors', type=float, required=False, default=0.0, show_default=True,
+              help='Probability of a server error')
+@click.option('--error-status', type=int, required=False, default=503, show_default=True)
+@click.option('--seed', type=int, required=False, default=None, help='Seed of the failures, for repeatable runs')
+def serve(fixtures, host, port, latency, jitter, throttle, retry_after, errors, error_status, seed):
+    logging.basicConfig(level="INFO", format="%(message)s")
+    EnsemblStandIn(fixtures, host, port, latency, jitter, throttle, retry_after, errors, error_status,
+                   seed).serve_forever()
+
+
+if __name__ == "__main__":
+    serve()
@@ -0,0 +1,178 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from intervaltree import Interval, IntervalTree
+
+
+class ExonArray:
+    """
+    Exon intervals as two sorted arrays of starts and ends, ordered like sorted(IntervalTree).
+    The exons of a transcript are not overlapping (the only exception is the 1 base long mark
+    at a breakpoint), so splitting is a bisect, and shifting or turning around is a single pass
+    over the arrays instead of rebuilding an IntervalTree interval by interval.
+    Operations are returning new ExonArrays, the original is never changed.
+    """
+    __slots__ = ("starts", "ends")
+
+    def __init__(self, starts=(), ends=()):
+        self.starts = starts if isinstance(starts, array) else array('q', starts)
+        self.ends = ends if isinstance(ends, array) else array('q', ends)
+
+    @classmethod
+    def from_intervals(cls, intervals):
+        """
+        :param intervals: (begin, end) pairs or Interval objects, in any order
+        """
+        pairs = sorted(set((iv[0], iv[1]) for iv in intervals))
+        return cls((p[0] for p in pairs), (p[1] for p in pairs))
+
+    @classmethod
+    def from_tree(cls, tree: IntervalTree):
+        return cls.from_intervals(tree)
+
+    def to_tree(self):
+        return IntervalTree(Interval(s, e) for s, e in zip(self.starts, self.ends))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        return zip(self.starts, self.ends)
+
+    def __eq__(self, other):
+        if not isinstance(other, ExonArray):
+            return NotImplemented
+        return self.starts == other.starts and self.ends == other.ends
+
+    def __repr__(self):
+        return "ExonArray(" + repr(list(self)) + ")"
+
+    def begin(self):
+        # like IntervalTree, empty ones are starting and ending at 0
+        return self.starts[0] if self.starts else 0
+
+    def end(self):
+        return max(self.ends) if self.ends else 0
+
+    def at(self, point):
+        """
+        :return: True if any of the exons contains the point
+        """
+        i = bisect_right(self.starts, point)
+        # the exon before could be the breakpoint mark, so look at the one before that as well
+        return any(self.ends[j] > point for j in range(max(0, i - 2), i))
+
+    def with_interval(self, begin, end):
+        """
+        New ExonArray with the interval added, keeping the order and skipping duplicates like a set
+        """
+        i = bisect_left(self.starts, begin)
+        while i < len(self.starts) and self.starts[i] == begin and self.ends[i] < end:
+            i += 1
+        if i < len(self.starts) and self.starts[i] == begin and self.ends[i] == end:
+            return self
+        starts = self.starts[:i]
+        starts.append(begin)
+        starts.extend(self.starts[i:])
+        ends = self.ends[:i]
+        ends.append(end)
+        ends.extend(self.ends[i:])
+        return ExonArray(starts, ends)
+
+    def left_part(self, bp):
+        # |-->---!->-->-->--|
+        # xxxxxxxx
+        # if the breakpoint is in an intron, we have to add a 1-base long interval at the breakpoint
+        exons = self if self.at(bp) else self.with_interval(bp - 1, bp)
+        # the exons starting at or after the breakpoint are dropped,
+        # the one containing the breakpoint is shortened
+        i = bisect_left(exons.starts, bp)
+        return ExonArray(exons.starts[:i], array('q', (min(e, bp) for e in exons.ends[:i])))
+
+    def right_part(self, bp):
+        # |--<---!-<--<--<--|
+        #        xxxxxxxxxxxx
+        # the exons ending after the breakpoint are kept as they are
+        # (gene exons are merged, so the ends are sorted as well)
+        if bp < self.end():
+            i = bisect_right(self.ends, bp)
+            exons = ExonArray(self.starts[i:], self.ends[i:])
+        else:
+            exons = ExonArray()
+        return exons.with_interval(bp, bp + 1)
+
+    def shift(self, offset):
+        return ExonArray(array('q', (s + offset for s in self.starts)), array('q', (e + offset for e in self.ends)))
+
+    def shift_left_to(self, new_base):
+        return self.shift(new_base - self.begin())
+
+    def mirror(self, axis):
+        """
+        Reflects every exon to axis - position: [s, e) becomes [axis - e, axis - s)
+        """
+        mirrored = ExonArray(array('q', (axis - e for e in reversed(self.ends))),
+                             array('q', (axis - s for s in reversed(self.starts))))
+        # a breakpoint mark inside an exon can get out of order, the rest stays sorted
+        if any(a > b for a, b in zip(mirrored, list(mirrored)[1:])):
+            return ExonArray.from_intervals(mirrored)
+        return mirrored
+
+    def turn_backwards(self):
+        """
+        |###|----|####|--|#|
+        becomes
+        |#|--|####|----|###|
+        in the same place
+        """
+        return self.mirror(self.begin() + self.end())
+
+    def transform(self, t):
+        """
+        Applies a Transform in a single pass
+        """
+        return self.mirror(t.offset) if t.mirrored else self.shift(t.offset)
+
+
+class Transform:
+    """
+    Affine map of coordinates: x -> offset + x, or x -> offset - x if mirrored.
+    An interval [b, e) goes to [offset + b, offset + e) or to [offset - e, offset - b).
+    Transforms are composed with then(), so the exons are moved only once, at the end.
+    """
+    __slots__ = ("offset", "mirrored")
+
+    def __init__(self, offset=0, mirrored=False):
+        self.offset = offset
+        self.mirrored = mirrored
+
+    @classmethod
+    def shift(cls, offset):
+        return cls(offset, False)
+
+    @classmethod
+    def mirror(cls, axis):
+        return cls(axis, True)
+
+    def __eq__(self, other):
+        if not isinstance(other, Transform):
+            return NotImplemented
+        return self.offset == other.offset and self.mirrored == other.mirrored
+
+    def __repr__(self):
+        return "Transform(" + str(self.offset) + ", mirrored=" + str(self.mirrored) + ")"
+
+    def then(self, other):
+        """
+        :return: the transform doing this one first, and other after it
+        """
+        if other.mirrored:
+            return Transform(other.offset - self.offset, not self.mirrored)
+        return Transform(self.offset + other.offset, self.mirrored)
+
+    def extent(self, begin, end):
+        """
+        Where the [begin, end) span goes
+        """
+        if self.mirrored:
+            return self.offset - end, self.offset - begin
+        return self.offset + begin, self.offset + end
@@ -1,6 +1,10 @@
-from vcffuse import ExonCoords
+import logging
+from vcffuse import ExonCoords, Metrics
+from vcffuse.ExonArray import ExonArray, Transform
 from intervaltree import Interval, IntervalTree
 
+logger = logging.getLogger(__name__)
+
 
 class FusionMaker:
     """
@@ -16,6 +20,9 @@ class FusionMaker:
         """
         self.prime5 = ExonCoords.ExonCoords(p5.chromosome, p5.strand, 0, p5.gene_name, p5.exons)
         self.prime3 = ExonCoords.ExonCoords(p3.chromosome, p3.strand, 0, p3.gene_name, p3.exons)
+        # the geometry is done on arrays, the trees are there for the callers
+        self.prime5_exons = ExonArray.from_tree(self.prime5.exons)
+        self.prime3_exons = ExonArray.from_tree(self.prime3.exons)
 
         # now assign breakpoints to genes:
         # since using the Manta VCF line it is not yet clear
@@ -32,16 +39,16 @@ class FusionMaker:
             gene_ends.add(Interval(gene_coords.begin(), gene_coords.end()))
             if gene_ends.at(bp):
                 gene.breakpoint = bp
-                print("Breakpoint", bp, "assigned to", gene.gene_name)
+                logger.debug("Breakpoint %s assigned to %s", bp, gene.gene_name)
                 break;
             else:
-                print("Breakpoint", bp, "is outside gene", gene.gene_name)
+                logger.debug("Breakpoint %s is outside gene %s", bp, gene.gene_name)
         # there can be a chance that the breakpoint is outside of both genes, assign it to the closest one
         for gene in [self.prime5, self.prime3]:
             if gene.breakpoint == 0 and gene.chromosome == chrom and (
                     abs(gene.exons.begin() - bp) < 20000 or abs(gene.exons.end() - bp) < 20000):
                 gene.breakpoint = bp
-                print("Breakpoint", bp, "assigned to", gene.gene_name)
+                logger.debug("Breakpoint %s assigned to %s", bp, gene.gene_name)
 
     def assign_breakpoint_to_genes(self, bp: tuple):
         chromosome = bp[0]
@@ -52,33 +59,38 @@ class FusionMaker:
                 if gene_extremes.at(bp[1]):
                     gene.breakpoint = bp[1]
 
-    def get_left_part(self, gene: ExonCoords):
-        # |-->---!->-->-->--|
-        # xxxxxxxx
-        # if the breakpoint is in an intron, we have to add a 1-base long interval at the breakpoint
-        breakpoint_in_exon = True if len(gene.exons.at(gene.breakpoint)) > 0 else False
-        if not breakpoint_in_exon:
-            print("**** intron breakpoint at -> ", gene.chromosome + ":" + str(gene.breakpoint - 1))
-            gene.exons.add(Interval(gene.breakpoint - 1, gene.breakpoint))
-        # when the breakpoint is in an exon, we have to shorten that one
-        # by chopping out the unneeded part
-        # TODO check it for tandem repeats as looks it was a bug
-        # it is still a bug actually
-        gene.exons.chop(gene.breakpoint, gene.exons.end())
+    def exon_array(self, gene: ExonCoords):
+        if gene is self.prime5:
+            return self.prime5_exons
+        if gene is self.prime3:
+            return self.prime3_exons
+        return ExonArray.from_tree(gene.exons)
 
-        return gene.exons
+    def left_part(self, gene: ExonCoords) -> ExonArray:
+        exons = self.exon_array(gene)
+        if not exons.at(gene.breakpoint):
+            logger.debug("**** intron breakpoint at -> %s:%s", gene.chromosome, gene.breakpoint - 1)
+        return exons.left_part(gene.breakpoint)
+
+    def right_part(self, gene: ExonCoords) -> ExonArray:
+        return self.exon_array(gene).right_part(gene.breakpoint)
+
+    def get_left_part(self, gene: ExonCoords):
+        return self.left_part(gene).to_tree()
 
     def get_right_part(self, gene: ExonCoords):
-        # |--<---!-<--<--<--|
-        #        xxxxxxxxxxxx
-        tr_exons = gene.exons
-        tr_exons = tr_exons.overlap(gene.breakpoint, gene.exons.end())
-        tr_exons.add(Interval(gene.breakpoint, gene.breakpoint + 1))
-        return tr_exons
+        return self.right_part(gene).to_tree()
 
     def print_as_bed(self, chromosome, exs):
-        for e in sorted(exs):
-            print(chromosome + "\t" + str(e.begin) + "\t" + str(e.end))
+        if logger.isEnabledFor(logging.DEBUG):
+            for e in sorted(exs):
+                logger.debug("%s\t%s\t%s", chromosome, e.begin, e.end)
+
+    @staticmethod
+    def print_part_as_bed(gene: ExonCoords, exons: ExonArray):
+        if logger.isEnabledFor(logging.DEBUG):
+            for begin, end in exons:
+                logger.debug("%s\t%s\t%s", gene.chromosome, begin, end)
 
     def getFusedPart(self, gene: ExonCoords, direction) -> ExonCoords:
         """
@@ -96,66 +108,29 @@ class FusionMaker:
                 tr_exons = self.get_right_part(gene)
             else:
                 tr_exons = self.get_left_part(gene)
-        return ExonCoords(gene.chromosome, gene.strand, gene.breakpoint, gene.gene_name, tr_exons)
+        return ExonCoords.ExonCoords(gene.chromosome, gene.strand, gene.breakpoint, gene.gene_name, tr_exons)
 
-    def fuse_deletion(self):
-        prime5part = None
-        prime3part = None
+    @Metrics.timed("fuse")
+    def fuse_deletion(self, reverse=False):
+        """
+        :param reverse: rotate the picture with 180 degrees, as the fusion is depicted as from 3' to 5'
+        """
         if self.prime5.strand < 0:
             # |<-<-<-<-|     |<-<-<-<-|
             #     |-------------|
             # we need right part for 5' and left part for 3'
-            prime5part = ExonCoords(self.prime5.chromosome,
-                                    self.prime5.strand,
-                                    self.prime5.breakpoint,
-                                    self.prime5.gene_name,
-                                    self.get_right_part(self.prime5))
-            prime3part = ExonCoords(self.prime3.chromosome,
-                                    self.prime3.strand,
-                                    self.prime3.breakpoint,
-                                    self.prime3.gene_name,
-                                    self.get_left_part(self.prime3))
+            prime5part = self.right_part(self.prime5)
+            prime3part = self.left_part(self.prime3)
         else:
             # |->->->->|     |->->->->|
             #     |-------------|
             # we need left part for 5' and right part for 3'
-            prime5part = ExonCoords(self.prime5.chromosome,
-                                    self.prime5.strand,
-                                    self.prime5.breakpoint,
-                                    self.prime5.gene_name,
-                                    self.get_left_part(self.prime5))
-            prime3part = ExonCoords(self.prime3.chromosome,
-                                    self.prime3.strand,
-                                    self.prime3.breakpoint,
-                                    self.prime3.gene_name,
-                                    self.get_right_part(self.prime3))
-        prime5part.print_as_bed()
-        prime3part.print_as_bed()
-        # now move the 3' part to the 5' part
-        p5borders = (prime5part.exons.begin(), prime5part.exons.end())
-        p3borders = (prime3part.exons.begin(), prime3part.exons.end())
-        shift = 0
-        if prime5part.strand > 0:
-            shift = prime5part.breakpoint - prime3part.exons.begin() + 1
-        else:
-            shift = prime5part.exons.begin() - prime3part.exons.end()
-        # we have to shift 3' only
-        shifted3p = IntervalTree()
-        for iv in prime3part.exons:
-            shifted3p.add(Interval(iv.begin + shift, iv.end + shift))
-        shifted5p = prime5part.exons
-        # and now shift down the stuff to 0 for SVG
-        left_shift = (shifted5p | shifted3p).begin()
-        # TODO: DRY it out
-        based05p = IntervalTree()
-        for iv in shifted5p:
-            based05p.add(Interval(iv.begin - left_shift, iv.end - left_shift))
-        based03p = IntervalTree()
-        for iv in shifted3p:
-            based03p.add(Interval(iv.begin - left_shift, iv.end - left_shift))
-        return based05p, based03p
+            prime5part = self.left_part(self.prime5)
+            prime3part = self.right_part(self.prime3)
+        return self.join_parts(prime5part, prime3part, reverse)
 
-    def fuse_tandem_genes(self):
+    @Metrics.timed("fuse")
+    def fuse_tandem_genes(self, reverse=False):
         # dealing with tandem repeats:
         # first we have to get parts by strand
         # - strand means we want to have the
@@ -168,35 +143,20 @@ class FusionMaker:
         #       right part from the breakpoint for 3'
         #       join them by starting with the 5' part
         #       add the 3' part to its right
-        prime5part = None
-        prime3part = None
         if (self.prime5.strand < 0):
-            prime5part = ExonCoords(self.prime5.chromosome,
-                                    self.prime5.strand,
-                                    self.prime5.breakpoint,
-                                    self.prime5.gene_name,
-                                    self.get_right_part(self.prime5))
-            prime3part = ExonCoords(self.prime3.chromosome,
-                                    self.prime3.strand,
-                                    self.prime3.breakpoint,
-                                    self.prime3.gene_name,
-                                    self.get_left_part(self.prime3))
+            prime5part = self.right_part(self.prime5)
+            prime3part = self.left_part(self.prime3)
         else:
-            prime5part = ExonCoords(self.prime5.chromosome,
-                                    self.prime5.strand,
-                                    self.prime5.breakpoint,
-                                    self.prime5.gene_name,
-                                    self.get_left_part(self.prime5))
-            prime3part = ExonCoords(self.prime3.chromosome,
-                                    self.prime3.strand,
-                                    self.prime3.breakpoint,
-                                    self.prime3.gene_name,
-                                    self.get_right_part(self.prime3))
-        prime5part.print_as_bed()
-        prime3part.print_as_bed()
-        # now move the 3' part to the 5' part
-        p5borders = (prime5part.exons.begin(), prime5part.exons.end())
-        p3borders = (prime3part.exons.begin(), prime3part.exons.end())
+            prime5part = self.left_part(self.prime5)
+            prime3part = self.right_part(self.prime3)
+        return self.join_parts(prime5part, prime3part, reverse)
+
+    def join_parts(self, prime5part: ExonArray, prime3part: ExonArray, reverse=False):
+        """
+        Moves the 3' part next to the 5' one, in the same orientation
+        """
+        self.print_part_as_bed(self.prime5, prime5part)
+        self.print_part_as_bed(self.prime3, prime3part)
         # |------5------|
         #                   |------3------|
         # |------5------|
@@ -208,100 +168,100 @@ class FusionMaker:
         # |------3------|
         # shift = (5'start - 3'start)
         # 3'start = 3'start + shift
-        shift = 0
-        if prime5part.strand > 0:
-            shift = prime5part.breakpoint - prime3part.exons.begin() + 1
+        if self.prime5.strand > 0:
+            shift = self.prime5.breakpoint - prime3part.begin() + 1
         else:
-            shift = prime5part.exons.begin() - prime3part.exons.end()
+            shift = prime5part.begin() - prime3part.end()
         # we have to shift 3' only
-        shifted3p = IntervalTree()
-        for iv in prime3part.exons:
-            shifted3p.add(Interval(iv.begin + shift, iv.end + shift))
-        shifted5p = prime5part.exons
-        # and now shift down the stuff to 0 for SVG
-        left_shift = (shifted5p | shifted3p).begin()
-        # TODO: DRY it out
-        based05p = IntervalTree()
-        for iv in shifted5p:
-            based05p.add(Interval(iv.begin - left_shift, iv.end - left_shift))
-        based03p = IntervalTree()
-        for iv in shifted3p:
-            based03p.add(Interval(iv.begin - left_shift, iv.end - left_shift))
-        return based05p, based03p
+        return self.assemble(prime5part, prime3part, Transform(), Transform.shift(shift), reverse)
 
-    def fuse_inversion(self):
-        based05p = None
-        based03p = None
+    @Metrics.timed("fuse")
+    def fuse_inversion(self, reverse=False):
         if self.prime5.strand > 0:  # forward 5'
-            print("Forward 5' inversion")
-            prime5part = ExonCoords(self.prime5.chromosome, self.prime5.strand,
-                                    self.prime5.breakpoint, self.prime5.gene_name,
-                                    self.get_left_part(self.prime5))
-            prime3part = ExonCoords(self.prime3.chromosome, self.prime3.strand,
-                                    self.prime3.breakpoint, self.prime3.gene_name,
-                                    self.get_left_part(self.prime3))
+            logger.debug("Forward 5' inversion")
+            prime5part = self.left_part(self.prime5)
+            prime3part = self.left_part(self.prime3)
             # we have to turn around the 3' part
             # -->  <--
-            prime3part = self.turn_backwards(prime3part)
+            transforms = (Transform(), self.turning_backwards(prime3part))
             # -->  -->
         else:
-            print("Reverse 5' inversion")
-            prime5part = ExonCoords(self.prime5.chromosome, self.prime5.strand,
-                                    self.prime5.breakpoint, self.prime5.gene_name,
-                                    self.get_right_part(self.prime5))
-            prime3part = ExonCoords(self.prime3.chromosome, self.prime3.strand,
-                                    self.prime3.breakpoint, self.prime3.gene_name,
-                                    self.get_right_part(self.prime3))
+            logger.debug("Reverse 5' inversion")
+            prime5part = self.right_part(self.prime5)
+            prime3part = self.right_part(self.prime3)
             # now the inversion is like
             # <--  -->
-            prime5part = self.turn_backwards(prime5part)
+            transforms = (self.turning_backwards(prime5part), Transform())
             # -->  -->
-        based05p = self.shift_left_to(0, prime5part)
-        based03p = self.shift_left_to(based05p.end(), prime3part)
-        print(based05p)
-        print(based03p)
-        return based05p, based03p
+        return self.stick_parts(prime5part, prime3part, transforms, reverse)
 
-    def fuse_translocations(self, p5dir, p3dir):
-        prime5part = None
-        prime3part = None
-        # TODO: DRY it out
+    @Metrics.timed("fuse")
+    def fuse_translocations(self, p5dir, p3dir, reverse=False):
         if p5dir == self.DIR_LEFT:
-            prime5part = ExonCoords(self.prime5.chromosome, self.prime5.strand,
-                                    self.prime5.breakpoint, self.prime5.gene_name,
-                                    self.get_left_part(self.prime5))
-        else:
-            prime3part = ExonCoords(self.prime3.chromosome, self.prime3.strand,
-                                    self.prime3.breakpoint, self.prime3.gene_name,
-                                    self.get_right_part(self.prime3))
+            prime5part = self.left_part(self.prime5)
+        else:  # DIR_RIGHT
+            prime5part = self.right_part(self.prime5)
         if p3dir == self.DIR_LEFT:
-            prime3part = ExonCoords(self.prime3.chromosome, self.prime3.strand,
-                                    self.prime3.breakpoint, self.prime3.gene_name,
-                                    self.get_left_part(self.prime3))
-        else:
-            prime3part = ExonCoords(self.prime3.chromosome, self.prime3.strand,
-                                    self.prime3.breakpoint, self.prime3.gene_name,
-                                    self.get_right_part(self.prime3))
+            prime3part = self.left_part(self.prime3)
+        else:  # DIR_RIGHT
+            prime3part = self.right_part(self.prime3)
 
+        transforms = (Transform(), Transform())
         if p5dir == self.DIR_LEFT and p3dir == self.DIR_LEFT:
-            # forward antiparallel
+            # forward antiparallel or reverse parallel
             # we have to turn the reverse strand 3' gene backwards
-            prime3part = self.turn_backwards(prime3part)
+            transforms = (Transform(), self.turning_backwards(prime3part))
             # and have to stick it to the 5' part
             # we are ignoring chromosomes this time
-            # TODO: DRY it out
-            based05p = self.shift_left_to(0, prime5part)
-            based03p = self.shift_left_to(based05p.end(), prime3part)
-            print(based05p)
-            print(based03p)
-            return (based05p, based03p)
+        elif p5dir == self.DIR_RIGHT and p3dir == self.DIR_LEFT:
+            transforms = (self.turning_backwards(prime5part), Transform())
+        return self.stick_parts(prime5part, prime3part, transforms, reverse)
+
+    @staticmethod
+    def turning_backwards(exons: ExonArray):
+        """
+        The transform of ExonArray.turn_backwards(): mirroring in the middle of the part
+        """
+        return Transform.mirror(exons.begin() + exons.end())
+
+    def stick_parts(self, prime5part: ExonArray, prime3part: ExonArray, transforms, reverse=False):
+        """
+        Puts the (transformed) 3' part right after the end of the (transformed) 5' one
+        """
+        transform5, transform3 = transforms
+        end5 = transform5.extent(prime5part.begin(), prime5part.end())[1]
+        begin3 = transform3.extent(prime3part.begin(), prime3part.end())[0]
+        based05p, based03p = self.assemble(prime5part, prime3part, transform5,
+                                           transform3.then(Transform.shift(end5 - begin3)), reverse)
+        logger.debug("%s", based05p)
+        logger.debug("%s", based03p)
+        return based05p, based03p
+
+    @staticmethod
+    def assemble(prime5part: ExonArray, prime3part: ExonArray, transform5: Transform, transform3: Transform,
+                 reverse=False):
+        """
+        The shared last step of all the fusions: shifts the placed parts down to 0 for SVG,
+        rotates them with 180 degrees if asked, and moves the exons only here, once.
+        The extents are calculated from the part ends, without touching the exons.
+        :return: 5' and 3' IntervalTrees
+        """
+        begin5, end5 = transform5.extent(prime5part.begin(), prime5part.end())
+        begin3, end3 = transform3.extent(prime3part.begin(), prime3part.end())
+        to_zero = Transform.shift(-min(begin5, begin3))
+        transform5 = transform5.then(to_zero)
+        transform3 = transform3.then(to_zero)
+        if reverse:
+            # we are assuming they are right to left: from the start of 3' to the end of 5'
+            begin3 = transform3.extent(prime3part.begin(), prime3part.end())[0]
+            end5 = transform5.extent(prime5part.begin(), prime5part.end())[1]
+            rotate = Transform.mirror(begin3 + end5)
+            transform5 = transform5.then(rotate)
+            transform3 = transform3.then(rotate)
+        return prime5part.transform(transform5).to_tree(), prime3part.transform(transform3).to_tree()
 
     def shift_left_to(self, new_base: int, exs: ExonCoords):
-        rebased = IntervalTree()
-        shift = exs.exons.begin() - new_base
-        for item in exs.exons:
-            rebased.add(Interval(item.begin - shift, item.end - shift))
-        return rebased
+        return ExonArray.from_tree(exs.exons).shift_left_to(new_base).to_tree()
 
     def turn_backwards(self, exs: ExonCoords):
         """
@@ -312,32 +272,18 @@ class FusionMaker:
         :param exs:
         ExonCoords that we want to turn backwards
         :return:
-        new IntervalTree() with backwards coordinates
+        new ExonCoords with backwards coordinates
         """
-        gene_start = exs.exons.begin()
-        gene_end = exs.exons.end()
-        new_exons = IntervalTree()
-        for item in sorted(exs.exons):
-            new_end = gene_end - (item.begin - gene_start)
-            new_start = gene_end + gene_start - item.end
-            # print(exs.chromosome + "\t" + str(new_start) + "\t" + str(new_end) + "\t"+ exs.gene_name)
-            new_exons.add(Interval(new_start, new_end))
-        return ExonCoords(exs.chromosome, exs.strand, exs.breakpoint, exs.gene_name, new_exons)
+        new_exons = ExonArray.from_tree(exs.exons).turn_backwards().to_tree()
+        return ExonCoords.ExonCoords(exs.chromosome, exs.strand, exs.breakpoint, exs.gene_name, new_exons)
 
     def print_properties(self):
-        print("5' gene:")
-        print("strand     :", self.prime5.strand)
-        print("breakpoint :", self.prime5.chromosome + ":" + str(self.prime5.breakpoint))
-        exons = self.prime5.exons
-        start = exons.begin()
-        end = exons.end()
-        print("gene coords:", self.prime5.chromosome + ":" + str(start) + "-" + str(end))
-        print("3' gene:")
-        print("strand     :", self.prime3.strand)
-        print("breakpoint :", self.prime3.chromosome + ":" + str(self.prime3.breakpoint))
-        exons = self.prime3.exons
-        start = exons.begin()
-        end = exons.end()
-        print("gene coords:", self.prime3.chromosome + ":" + str(start) + "-" + str(end))
-        self.prime5.print_as_bed()
-        self.prime3.print_as_bed()
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
+        for title, gene in (("5' gene:", self.prime5), ("3' gene:", self.prime3)):
+            logger.debug(title)
+            logger.debug("strand     : %s", gene.strand)
+            logger.debug("breakpoint : %s:%s", gene.chromosome, gene.breakpoint)
+            logger.debug("gene coords: %s:%s-%s", gene.chromosome, gene.exons.begin(), gene.exons.end())
+        self.print_as_bed(self.prime5.chromosome, self.prime5.exons)
+        self.print_as_bed(self.prime3.chromosome, self.prime3.exons)
@@ -0,0 +1,261 @@
+"""
+Memo of the fusions already made: the 5' and 3' exons of a record (keyed by a hash of the annotation they
+come from, the ENSEMBL IDs, the breakpoints, the SV kind and the breakend orientation), and the pictures,
+keyed by a hash of the exons they are showing. Pictures are stored once, and the output files are hard links to them.
+"""
+import errno
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import time
+from collections import OrderedDict
+from intervaltree import Interval, IntervalTree
+from vcffuse import Metrics
+
+logger = logging.getLogger(__name__)
+
+IN_MEMORY = ":memory:"
+DEFAULT_MAX_BYTES = 1 << 30
+# evict only every so many writes, summing up the sizes is not free
+EVICT_EVERY = 256
+
+
+def digest(value):
+    return hashlib.sha1(repr(value).encode("utf-8")).hexdigest()
+
+
+def file_identity(path):
+    """
+    A file by its path, size and modification time, hashing a whole GTF at each start would take longer
+    """
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_size, stat.st_mtime_ns
+
+
+def annotation_source(rest, server=None, gtf=None, index=None):
+    """
+    Where the exons come from, in the order they are looked up: the index, the GTF, then ENSEMBL REST
+    (through the annotation store) or the JSON files in the working directory
+    """
+    source = []
+    if index:
+        source.append(("index",) + file_identity(index))
+    if gtf:
+        source.append(("gtf",) + file_identity(gtf))
+    source.append(("rest", server) if rest else ("json", os.path.abspath(os.curdir)))
+    return tuple(source)
+
+
+def exon_tuples(exons):
+    return tuple((iv.begin, iv.end) for iv in sorted(exons))
+
+
+def picture_digest(fex):
+    """
+    Content address of a picture: the exons are all it depends on
+    """
+    return digest((exon_tuples(fex[0]), exon_tuples(fex[1])))
+
+
+def link_or_copy(source, target):
+    """
+    Hard link if we can, a copy if we can not (like across filesystems)
+    """
+    if os.path.lexists(target):
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+        shutil.copyfile(source, target)
+
+
+class FusionMemo:
+    """
+    In-memory LRU of the fusions of the records, with an optional on-disk (SQLite + picture files) store
+    behind it that is shared by runs and processes. The on-disk store is kept under max_bytes
+    by dropping the least recently used fusions and pictures.
+    :param directory: where the on-disk store is, None or ":memory:" for an in-memory memo only
+    :param annotation: annotation_source() of the run, the exons made from an other one are not taken
+    """
+
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES, lru_size=4096, timeout=60.0, annotation=None):
+        self._directory = None if directory in (None, IN_MEMORY) else directory
+        self._annotation = annotation
+        self._max_bytes = max_bytes
+        self._lru_size = lru_size
+        self._timeout = timeout
+        self._lru = OrderedDict()
+        self._pictures = OrderedDict()  # picture digest -> a file that has it, for the in-memory memo
+        self._conn = None
+        self._pid = None
+        self._writes = 0
+
+    @property
+    def directory(self):
+        return self._directory
+
+    def _connection(self):
+        # connections must not be shared across fork(), so open a new one in each process
+        if self._conn is None or self._pid != os.getpid():
+            os.makedirs(os.path.join(self._directory, "pictures"), exist_ok=True)
+            conn = sqlite3.connect(os.path.join(self._directory, "memo.sqlite"), timeout=self._timeout,
+                                   isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS fusion (key TEXT PRIMARY KEY, fusions TEXT, "
+                         "size INTEGER, used REAL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS picture (digest TEXT PRIMARY KEY, size INTEGER, used REAL)")
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def __getstate__(self):
+        # the connection stays in this process, the other one opens its own
+        state = self.__dict__.copy()
+        state["_conn"] = None
+        state["_pid"] = None
+        return state
+
+    def close(self):
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+
+    def key(self, fusion_key):
+        """
+        :return: key of the exons of a record in this memo, with the annotation they are made from
+        """
+        return digest((self._annotation, fusion_key))
+
+    @staticmethod
+    def _remember(lru, key, value, size):
+        lru[key] = value
+        lru.move_to_end(key)
+        while len(lru) > size:
+            lru.popitem(last=False)
+
+    def get(self, key):
+        """
+        :return: list of (5' name, 3' name, (5' exons, 3' exons)) of the record, or None if it is not made yet
+        """
+        fusions = self._lru.get(key)
+        if fusions is None and self._directory is not None:
+            conn = self._connection()
+            row = conn.execute("SELECT fusions FROM fusion WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                conn.execute("UPDATE fusion SET used = ? WHERE key = ?", (time.time(), key))
+                fusions = tuple((p5, p3, tuple(map(tuple, e5)), tuple(map(tuple, e3)))
+                                for p5, p3, e5, e3 in json.loads(row[0]))
+        if fusions is None:
+            Metrics.count("memo_misses")
+            return None
+        Metrics.count("memo_hits")
+        self._remember(self._lru, key, fusions, self._lru_size)
+        return [(p5, p3, (IntervalTree(Interval(b, e) for b, e in e5), IntervalTree(Interval(b, e) for b, e in e3)))
+                for p5, p3, e5, e3 in fusions]
+
+    def put(self, key, fusions):
+        """
+        :param fusions: list of (5' name, 3' name, (5' exons, 3' exons))
+        """
+        fusions = tuple((p5, p3, exon_tuples(fex[0]), exon_tuples(fex[1])) for p5, p3, fex in fusions)
+        self._remember(self._lru, key, fusions, self._lru_size)
+        if self._directory is not None:
+            value = json.dumps(fusions)
+            self._connection().execute("INSERT OR REPLACE INTO fusion (key, fusions, size, used) VALUES (?, ?, ?, ?)",
+                                       (key, value, len(value), time.time()))
+            self._written()
+
+    def picture_path(self, picture):
+        return os.path.join(self._directory, "pictures", picture[:2], picture + ".svg")
+
+    def link_picture(self, picture, outfile):
+        """
+        Puts the picture with this digest to outfile, if we have it
+        :return: True if we had it
+        """
+        source = self._pictures.get(picture)
+        if source is None and self._directory is not None:
+            conn = self._connection()
+            if conn.execute("SELECT 1 FROM picture WHERE digest = ?", (picture,)).fetchone() is not None:
+                conn.execute("UPDATE picture SET used = ? WHERE digest = ?", (time.time(), picture))
+                source = self.picture_path(picture)
+        if source is not None and os.path.abspath(source) != os.path.abspath(outfile):
+            try:
+                link_or_copy(source, outfile)
+            except FileNotFoundError:
+                # evicted by somebody else in the meantime
+                source = None
+        if source is None:
+            Metrics.count("memo_picture_misses")
+            return False
+        Metrics.count("memo_picture_hits")
+        self._remember(self._pictures, picture, source, self._lru_size)
+        return True
+
+    def add_picture(self, picture, outfile):
+        """
+        Remembers a freshly drawn picture
+        """
+        source = outfile
+        if self._directory is not None:
+            source = self.picture_path(picture)
+            os.makedirs(os.path.dirname(source), exist_ok=True)
+            try:
+                link_or_copy(outfile, source)
+            except FileExistsError:
+                # an other process was faster
+                pass
+            self._connection().execute("INSERT OR REPLACE INTO picture (digest, size, used) VALUES (?, ?, ?)",
+                                       (picture, os.path.getsize(source), time.time()))
+            self._written()
+        self._remember(self._pictures, picture, source, self._lru_size)
+
+    def _written(self):
+        self._writes += 1
+        if self._writes % EVICT_EVERY == 0:
+            self.evict()
+
+    def size(self):
+        conn = self._connection()
+        return sum(conn.execute("SELECT COALESCE(SUM(size), 0) FROM " + table).fetchone()[0]
+                   for table in ("fusion", "picture"))
+
+    def evict(self):
+        """
+        Drops the least recently used fusions and pictures until the store is 90% of max_bytes
+        :return: number of fusions and pictures dropped
+        """
+        if self._directory is None:
+            return 0
+        total = self.size()
+        if total <= self._max_bytes:
+            return 0
+        conn = self._connection()
+        rows = conn.execute("SELECT 'fusion', key, size, used FROM fusion UNION ALL "
+                            "SELECT 'picture', digest, size, used FROM picture ORDER BY 4").fetchall()
+        dropped = 0
+        for table, key, size, _ in rows:
+            if total <= self._max_bytes * 0.9:
+                break
+            if table == "fusion":
+                conn.execute("DELETE FROM fusion WHERE key = ?", (key,))
+                self._lru.pop(key, None)
+            else:
+                conn.execute("DELETE FROM picture WHERE digest = ?", (key,))
+                self._pictures.pop(key, None)
+                try:
+                    # the output files linked to it are still there
+                    os.remove(self.picture_path(key))
+                except FileNotFoundError:
+                    pass
+            total -= size
+            dropped += 1
+        Metrics.count("memo_evictions", dropped)
+        logger.debug("Dropped %d entries from the fusion memo at %s", dropped, self._directory)
+        return dropped
@@ -0,0 +1,114 @@
+"""
+Machine-readable results: one BEDPE line and/or one JSON Lines object for each fusion, written as soon as
+the fusion is made, so downstream tools do not have to scrape the log.
+The exons are in the coordinates of the fused transcript, the same ones the picture is showing.
+"""
+import json
+import sys
+from vcffuse import VCFRecord
+from vcffuse.BreakendPairer import mate_position
+
+BEDPE_COLUMNS = ["chrom1", "start1", "end1", "chrom2", "start2", "end2", "name", "score", "strand1", "strand2",
+                 "sv_type", "gene5", "gene5_ID", "strand5", "gene3", "gene3_ID", "strand3", "exons5", "exons3",
+                 "picture"]
+
+
+def breakpoints(record: VCFRecord.VCFRecord):
+    """
+    [(chromosome, position), (chromosome, position)] of both ends: END of DEL, INV and DUP, the mate of BND
+    """
+    second = None
+    if record.kind == VCFRecord.TRANSLOCATION:
+        second = mate_position(record.alt)
+    elif record.end is not None:
+        second = (record.chrom, record.end)
+    return [(record.chrom, record.pos), second or (record.chrom, record.pos)]
+
+
+def gene(name, ENS_ID=None, coords=None):
+    """
+    :param coords: (chromosome, strand, breakpoint, gene name, exons) of the ENSEMBL ID, see AnnotationStore
+    """
+    return {"name": name, "ID": ENS_ID, "chromosome": coords[0] if coords else None,
+            "strand": coords[1] if coords else None}
+
+
+def make_row(record: VCFRecord.VCFRecord, prime5: dict, prime3: dict, fex, picture=None):
+    """
+    :param prime5: gene() of the 5' partner
+    :param fex: (5' exons, 3' exons) IntervalTrees of the fusion
+    :param picture: path of the picture, None if there is none
+    """
+    return {"record_ID": record.id,
+            "sv_type": record.kind,
+            "breakpoints": [list(point) for point in breakpoints(record)],
+            "prime5": prime5,
+            "prime3": prime3,
+            "exons5": [[iv.begin, iv.end] for iv in sorted(fex[0])],
+            "exons3": [[iv.begin, iv.end] for iv in sorted(fex[1])],
+            "picture": picture}
+
+
+def strand_sign(strand):
+    if strand is None:
+        return "."
+    return "+" if strand > 0 else "-"
+
+
+def exon_list(exons):
+    return ",".join(str(begin) + "-" + str(end) for begin, end in exons) or "."
+
+
+def bedpe_line(row):
+    """
+    BEDPE is 0-based half-open, a breakpoint is a single base. Strand of the breakends is not known (.),
+    the strands of the genes are in strand5 and strand3
+    """
+    (chrom1, pos1), (chrom2, pos2) = row["breakpoints"]
+    prime5, prime3 = row["prime5"], row["prime3"]
+    return "\t".join(str(item) for item in (
+        chrom1, pos1 - 1, pos1, chrom2, pos2 - 1, pos2, row["record_ID"], ".", ".", ".", row["sv_type"],
+        prime5["name"], prime5["ID"] or ".", strand_sign(prime5["strand"]),
+        prime3["name"], prime3["ID"] or ".", strand_sign(prime3["strand"]),
+        exon_list(row["exons5"]), exon_list(row["exons3"]), row["picture"] or ".")) + "\n"
+
+
+class FusionTableWriter:
+    """
+    Writes the rows of make_row() to a BEDPE and/or a JSON Lines file ("-" is stdout) through a large buffer
+    """
+
+    def __init__(self, bedpe=None, jsonl=None, buffer_size=1 << 16):
+        self._outputs = []
+        if bedpe:
+            out = self._open(bedpe, buffer_size)
+            out.write("#" + "\t".join(BEDPE_COLUMNS) + "\n")
+            self._outputs.append((out, bedpe_line))
+        if jsonl:
+            self._outputs.append((self._open(jsonl, buffer_size), lambda row: json.dumps(row) + "\n"))
+        self.rows = 0
+
+    @staticmethod
+    def _open(path, buffer_size):
+        if path == "-":
+            return sys.stdout
+        return open(path, "w", encoding="utf-8", buffering=buffer_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, row):
+        self.rows += 1
+        for out, format_row in self._outputs:
+            out.write(format_row(row))
+
+    def close(self):
+        for out, _ in self._outputs:
+            if out is sys.stdout:
+                out.flush()
+            else:
+                out.close()
+        self._outputs = []
@@ -0,0 +1,202 @@
+import logging
+import re
+from array import array
+from intervaltree import Interval, IntervalTree
+from vcffuse import VCFReader
+
+logger = logging.getLogger(__name__)
+
+gtf_attribute_re = re.compile('\\s*([^\\s"]+)\\s+"([^"]*)"')
+
+
+# features we do not need at all for the exon table
+skipped_features = {"CDS", "five_prime_UTR", "three_prime_UTR", "UTR", "start_codon", "stop_codon",
+                    "Selenocysteine", "chromosome", "scaffold", "supercontig", "biological_region"}
+
+
+version_re = re.compile('\\.[0-9]+')
+
+
+def strip_version(ENS_ID: str):
+    # ENSG00000139083.13 -> ENSG00000139083, ENSG00000182378.14_PAR_Y -> ENSG00000182378_PAR_Y
+    return version_re.sub("", ENS_ID, count=1)
+
+
+def parse_gtf_attributes(attributes: str):
+    """
+    gene_id "ENSG00000139083"; transcript_id "ENST00000396373"; tag "basic"; tag "Ensembl_canonical";
+    Repeated keys (like tag) are collected into a set.
+    """
+    parsed = {}
+    tags = set()
+    for key, value in gtf_attribute_re.findall(attributes):
+        if key == "tag":
+            tags.add(value)
+        else:
+            parsed[key] = value
+    parsed["tag"] = tags
+    return parsed
+
+
+def parse_gff3_attributes(attributes: str):
+    """
+    ID=transcript:ENST00000396373;Parent=gene:ENSG00000139083;Name=ETV6-201;tag=basic,Ensembl_canonical
+    """
+    parsed = {}
+    for item in attributes.split(";"):
+        if "=" in item:
+            key, value = item.split("=", 1)
+            parsed[key] = value
+    parsed["tag"] = set(parsed["tag"].split(",")) if "tag" in parsed else set()
+    return parsed
+
+
+def gff3_id(value: str):
+    # gene:ENSG00000139083 -> ENSG00000139083
+    return strip_version(value.split(":", 1)[-1])
+
+
+class GTFAnnotation:
+    """
+    Annotation backend built from a local ENSEMBL GTF or GFF3 file (can be gzipped).
+    The file is streamed once, keeping only the exons of the transcripts; afterwards looking up a gene
+    gives the exons of its canonical transcript (tagged as Ensembl_canonical, or the one with the most
+    exonic bases if there is no such tag), and looking up a transcript gives its own exons.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._transcripts = {}   # transcript ID -> [chromosome, strand, name, gene ID, starts, ends]
+        self._gene_names = {}    # gene ID -> gene name
+        self._canonical = {}     # gene ID -> transcript ID
+        self._cache = {}         # ID -> already built tuple
+        self.read_annotation(path)
+
+    def __len__(self):
+        return len(self._transcripts)
+
+    def __contains__(self, ENS_ID):
+        ENS_ID = strip_version(ENS_ID)
+        return ENS_ID in self._canonical or ENS_ID in self._transcripts
+
+    def read_annotation(self, path):
+        tagged = {}  # gene ID -> transcript ID tagged as canonical
+        parse_attributes = None
+        with VCFReader.open_text(path) as annotation:
+            for line in annotation:
+                if line.startswith("#"):
+                    continue
+                columns = line.rstrip("\n").split("\t")
+                if len(columns) < 9:
+                    continue
+                feature = columns[2]
+                if feature in skipped_features:
+                    continue
+                if parse_attributes is None:
+                    # GTF attributes are like key "value"; GFF3 ones are like key=value
+                    parse_attributes = parse_gtf_attributes if '"' in columns[8] else parse_gff3_attributes
+                attributes = parse_attributes(columns[8])
+                if parse_attributes is parse_gtf_attributes:
+                    self.add_gtf_feature(feature, columns, attributes, tagged)
+                else:
+                    self.add_gff3_feature(feature, columns, attributes, tagged)
+        self.pick_canonical(tagged)
+
+    def add_transcript(self, transcript_id, gene_id, name, columns):
+        chromosome = columns[0] if columns[0].startswith("chr") else "chr" + columns[0]
+        strand = 1 if columns[6] == "+" else -1
+        if transcript_id not in self._transcripts:
+            self._transcripts[transcript_id] = [chromosome, strand, name, gene_id, array('q'), array('q')]
+
+    def add_exon(self, transcript_id, columns):
+        transcript = self._transcripts.get(transcript_id)
+        if transcript is not None:
+            transcript[4].append(int(columns[3]))
+            transcript[5].append(int(columns[4]))
+
+    def add_gtf_feature(self, feature, columns, attributes, tagged):
+        gene_id = strip_version(attributes.get("gene_id", ""))
+        transcript_id = strip_version(attributes.get("transcript_id", ""))
+        if feature == "gene":
+            self._gene_names[gene_id] = attributes.get("gene_name", gene_id)
+        elif feature == "transcript":
+            self._gene_names.setdefault(gene_id, attributes.get("gene_name", gene_id))
+            self.add_transcript(transcript_id, gene_id, attributes.get("transcript_name", transcript_id), columns)
+            if "Ensembl_canonical" in attributes["tag"]:
+                tagged[gene_id] = transcript_id
+        elif feature == "exon":
+            if transcript_id not in self._transcripts:
+                # some GTFs do not have transcript lines at all
+                self.add_transcript(transcript_id, gene_id, attributes.get("transcript_name", transcript_id),
+                                    columns)
+            self.add_exon(transcript_id, columns)
+
+    def add_gff3_feature(self, feature, columns, attributes, tagged):
+        # ENSEMBL GFF3 IDs are like gene:ENSG00000139083 and transcript:ENST00000396373
+        if feature == "exon":
+            for parent in attributes.get("Parent", "").split(","):
+                self.add_exon(gff3_id(parent), columns)
+        elif attributes.get("ID", "").startswith("gene:"):
+            gene_id = gff3_id(attributes["ID"])
+            self._gene_names[gene_id] = attributes.get("Name", gene_id)
+        elif attributes.get("ID", "").startswith("transcript:"):
+            transcript_id = gff3_id(attributes["ID"])
+            gene_id = gff3_id(attributes.get("Parent", ""))
+            self.add_transcript(transcript_id, gene_id, attributes.get("Name", transcript_id), columns)
+            if "Ensembl_canonical" in attributes["tag"]:
+                tagged[gene_id] = transcript_id
+
+    def pick_canonical(self, tagged: dict):
+        exonic_length = {}
+        for transcript_id, transcript in self._transcripts.items():
+            gene_id = transcript[3]
+            if gene_id in tagged:
+                continue
+            length = sum(transcript[5]) - sum(transcript[4]) + len(transcript[4])
+            best = exonic_length.get(gene_id)
+            if best is None or length > best[0] or (length == best[0] and transcript_id < best[1]):
+                exonic_length[gene_id] = (length, transcript_id)
+        self._canonical = {gene_id: best[1] for gene_id, best in exonic_length.items()}
+        self._canonical.update(tagged)
+
+    def ids(self):
+        """
+        Yields all the gene and transcript IDs we can look up
+        """
+        yield from self._canonical
+        yield from self._transcripts
+
+    def lookup(self, ENS_ID):
+        """
+        :return: (chromosome, strand, 0, display name, IntervalTree) like get_CDS_coords(),
+        or None if the ID is not in the annotation
+        """
+        ENS_ID = strip_version(ENS_ID)
+        if ENS_ID in self._cache:
+            coords = self._cache[ENS_ID]
+            return (coords[0], coords[1], coords[2], coords[3], IntervalTree(coords[4]))
+        coords = self.build(ENS_ID)
+        if coords is None:
+            return None
+        self._cache[ENS_ID] = coords
+        return (coords[0], coords[1], coords[2], coords[3], IntervalTree(coords[4]))
+
+    def build(self, ENS_ID):
+        """
+        Same as lookup(), but the result is not kept in memory
+        """
+        ENS_ID = strip_version(ENS_ID)
+        if ENS_ID in self._canonical:
+            transcript_id = self._canonical[ENS_ID]
+            display_name = self._gene_names.get(ENS_ID, ENS_ID)
+            logger.debug("Using canonical transcript %s / %s", transcript_id, display_name)
+        elif ENS_ID in self._transcripts:
+            transcript_id = ENS_ID
+            display_name = self._transcripts[ENS_ID][2]
+            logger.debug("Using transcript %s / %s", transcript_id, display_name)
+        else:
+            return None
+        chromosome, strand, name, gene_id, starts, ends = self._transcripts[transcript_id]
+        intree = IntervalTree(Interval(s, e) for s, e in zip(starts, ends) if s < e)
+        intree.merge_overlaps()
+        return (chromosome, strand, 0, display_name, IntervalTree(sorted(intree.items())))
@@ -0,0 +1,162 @@
+"""
+All the fusion pictures of a run in a single HTML document, instead of a file for each fusion.
+The exon glyph and the colours are defined only once, each picture is in a <template> that is
+put on the page only when it is scrolled into view, and a JSON index (by gene pair, SV kind and
+record ID) is embedded for looking up pictures in the browser.
+"""
+import html
+import json
+from collections import namedtuple
+from vcffuse import SVGStream
+
+# one picture: the name it would have as a separate file, and where it comes from
+Panel = namedtuple("Panel", ["name", "record_ID", "kind", "prime5", "prime3", "svg"])
+
+HEAD = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>
+body {{ font-family: sans-serif; margin: 1em; }}
+section.panel {{ min-height: 24mm; margin-bottom: 1em; }}
+section.panel h2 {{ font-size: 1em; margin: 0; }}
+svg.fusion {{ height: 20mm; }}
+.p5 {{ fill: blue; stroke: blue; }}
+.p3 {{ fill: red; stroke: red; }}
+use {{ vector-effect: non-scaling-stroke; }}
+</style>
+</head>
+<body>
+<svg width="0" height="0" style="position: absolute"><defs>
+<symbol id="exon" viewBox="0 0 1 1" preserveAspectRatio="none"><rect width="1" height="1" /></symbol>
+</defs></svg>
+<input id="search" type="search" placeholder="gene, gene pair (A-B), SV kind or record ID">
+"""
+
+# puts a picture on the page only when its panel is scrolled into view, and filters by the index
+SCRIPT = """<script>
+(function () {
+  var index = JSON.parse(document.getElementById("gallery-index").textContent);
+  var panels = document.querySelectorAll("section.panel");
+  function show(panel) {
+    var template = panel.querySelector("template");
+    if (template) {
+      panel.appendChild(template.content.cloneNode(true));
+      template.remove();
+    }
+  }
+  var observer = "IntersectionObserver" in window ? new IntersectionObserver(function (entries) {
+    entries.forEach(function (entry) {
+      if (entry.isIntersecting) {
+        show(entry.target);
+        observer.unobserve(entry.target);
+      }
+    });
+  }, {rootMargin: "200px"}) : null;
+  panels.forEach(function (panel) { observer ? observer.observe(panel) : show(panel); });
+  document.getElementById("search").addEventListener("input", function () {
+    var query = this.value.trim();
+    var found = null;
+    if (query) {
+      found = {};
+      [index.by_gene_pair, index.by_gene, index.by_kind, index.by_record].forEach(function (lookup) {
+        (lookup[query] || []).forEach(function (name) { found[name] = true; });
+      });
+    }
+    panels.forEach(function (panel) {
+      panel.style.display = found === null || found[panel.id] ? "" : "none";
+    });
+  });
+})();
+</script>
+"""
+
+FOOT = """</body>
+</html>
+"""
+
+
+def panel_svg(fex):
+    """
+    The picture of a fusion, drawn with the shared exon symbol. Units are mm, like in the single SVG files.
+    """
+    width = max(fex[0].end(), fex[1].end()) / 100 + 1
+    parts = ['<svg class="fusion" viewBox="0 0 ' + str(width) + ' 20" width="' + str(width) + 'mm">']
+    for exons, style in ((fex[0], "p5"), (fex[1], "p3")):
+        for x, exon_width in SVGStream.exon_boxes(exons):
+            parts.append('<use href="#exon" class="' + style + '" x="' + str(x) + '" y="0" width="' +
+                         str(exon_width) + '" height="20" />')
+    for exons, style in ((fex[0], "p5"), (fex[1], "p3")):
+        x, intron_width = SVGStream.intron_box(exons)
+        parts.append('<rect class="' + style + '" x="' + str(x) + '" y="8" width="' + str(intron_width) +
+                     '" height="2" />')
+    parts.append('</svg>')
+    return "".join(parts)
+
+
+def make_panel(fex, name, record_ID, kind, prime5, prime3):
+    return Panel(name, record_ID, kind, prime5, prime3, panel_svg(fex))
+
+
+def gallery_file_name(svg):
+    """
+    fusions.svg -> fusions.html
+    """
+    return (svg[:-4] if svg.lower().endswith(".svg") else svg) + ".html"
+
+
+class GalleryWriter:
+    """
+    Streams the panels into the document as they come, only the index is kept in memory
+    """
+
+    def __init__(self, path, title="vcffuse"):
+        self._path = path
+        self._out = open(path, "w", encoding="utf-8", buffering=1 << 16)
+        self._out.write(HEAD.format(title=html.escape(title)))
+        self._index = {"by_gene_pair": {}, "by_gene": {}, "by_kind": {}, "by_record": {}}
+        self._names = set()
+        self.panels = 0
+
+    @property
+    def path(self):
+        return self._path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add(self, panel: Panel):
+        if panel.name in self._names:
+            return
+        self._names.add(panel.name)
+        self.panels += 1
+        for lookup, key in ((self._index["by_gene_pair"], panel.prime5 + "-" + panel.prime3),
+                            (self._index["by_gene"], panel.prime5),
+                            (self._index["by_gene"], panel.prime3),
+                            (self._index["by_kind"], panel.kind),
+                            (self._index["by_record"], panel.record_ID)):
+            names = lookup.setdefault(key, [])
+            if not names or names[-1] != panel.name:
+                names.append(panel.name)
+        title = panel.record_ID + " " + panel.kind + " " + panel.prime5 + "-" + panel.prime3
+        self._out.write('<section class="panel" id="' + html.escape(panel.name) + '"><h2>' + html.escape(title) +
+                        '</h2><template>' + panel.svg + '</template></section>\n')
+
+    @property
+    def index(self):
+        return self._index
+
+    def close(self):
+        if self._out is None:
+            return
+        # "</" would end the script element early
+        index = json.dumps(self._index, sort_keys=True).replace("</", "<\\/")
+        self._out.write('<script type="application/json" id="gallery-index">' + index + '</script>\n')
+        self._out.write(SCRIPT)
+        self._out.write(FOOT)
+        self._out.close()
+        self._out = None
@@ -0,0 +1,232 @@
+"""
+Wall-time histograms of the pipeline stages, event counters and peak memory.
+Every process has its own registry; workers hand over what they collected with take(),
+and the main process merges it, so the summary covers the whole run.
+"""
+import functools
+import json
+import os
+import time
+import tracemalloc
+from bisect import bisect_left
+
+# upper bounds in seconds, from 100 microseconds to a minute
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one is for everything above the largest bound
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        if other.buckets != self.buckets:
+            raise ValueError("Can not merge histograms with different buckets")
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def cumulative(self):
+        """
+        (upper bound, number of observations not above it) pairs, the last bound is +Inf
+        """
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            yield bound, total
+
+    def as_dict(self):
+        return {"count": self.count, "sum": self.sum, "max": self.max,
+                "mean": self.sum / self.count if self.count else 0.0,
+                "buckets": list(self.buckets), "counts": list(self.counts)}
+
+    @classmethod
+    def from_dict(cls, d):
+        histogram = cls(d["buckets"])
+        histogram.counts = list(d["counts"])
+        histogram.count = d["count"]
+        histogram.sum = d["sum"]
+        histogram.max = d["max"]
+        return histogram
+
+
+class Timer:
+    """
+    Context manager observing the time spent in the block
+    """
+    __slots__ = ("_histogram", "_start")
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._histogram.observe(time.perf_counter() - self._start)
+
+
+class Metrics:
+    def __init__(self):
+        self.stages = {}    # stage name -> Histogram of wall times
+        self.counters = {}  # event name -> count
+        self.peak_memory = {}  # "tracemalloc" / "rss" -> bytes, the max over the processes
+
+    def histogram(self, stage):
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.stages[stage] = Histogram()
+        return histogram
+
+    def timer(self, stage):
+        return Timer(self.histogram(stage))
+
+    def observe(self, stage, seconds):
+        self.histogram(stage).observe(seconds)
+
+    def count(self, event, n=1):
+        self.counters[event] = self.counters.get(event, 0) + n
+
+    def measure_memory(self):
+        if tracemalloc.is_tracing():
+            self.peak_memory["tracemalloc"] = max(self.peak_memory.get("tracemalloc", 0),
+                                                  tracemalloc.get_traced_memory()[1])
+        try:
+            import resource
+            # ru_maxrss is in kilobytes on Linux
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+            self.peak_memory["rss"] = max(self.peak_memory.get("rss", 0), rss)
+        except ImportError:
+            pass
+
+    def merge(self, other):
+        for stage, histogram in other.stages.items():
+            self.histogram(stage).merge(histogram)
+        for event, n in other.counters.items():
+            self.count(event, n)
+        for kind, peak in other.peak_memory.items():
+            self.peak_memory[kind] = max(self.peak_memory.get(kind, 0), peak)
+
+    def reset(self):
+        """
+        Forgets everything, a forked worker should not send back what its parent collected
+        """
+        self.stages = {}
+        self.counters = {}
+        self.peak_memory = {}
+
+    def take(self):
+        """
+        :return: everything collected since the last take(), as a dict that can be sent to another process
+        """
+        self.measure_memory()
+        taken = self.as_dict()
+        self.stages = {}
+        self.counters = {}
+        return taken
+
+    def merge_dict(self, d):
+        self.merge(Metrics.from_dict(d))
+
+    def as_dict(self):
+        return {"stages": {stage: histogram.as_dict() for stage, histogram in sorted(self.stages.items())},
+                "counters": dict(sorted(self.counters.items())),
+                "peak_memory": dict(self.peak_memory)}
+
+    @classmethod
+    def from_dict(cls, d):
+        metrics = cls()
+        metrics.stages = {stage: Histogram.from_dict(h) for stage, h in d["stages"].items()}
+        metrics.counters = dict(d["counters"])
+        metrics.peak_memory = dict(d["peak_memory"])
+        return metrics
+
+    def to_json(self, path):
+        write_atomically(path, json.dumps(self.as_dict(), indent=2, sort_keys=True) + "\n")
+
+    def prometheus_text(self, prefix="vcffuse"):
+        lines = ["# HELP " + prefix + "_stage_seconds Wall time of the pipeline stages",
+                 "# TYPE " + prefix + "_stage_seconds histogram"]
+        for stage, histogram in sorted(self.stages.items()):
+            for bound, count in histogram.cumulative():
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(prefix + '_stage_seconds_bucket{stage="' + stage + '",le="' + le + '"} ' + str(count))
+            lines.append(prefix + '_stage_seconds_sum{stage="' + stage + '"} ' + repr(histogram.sum))
+            lines.append(prefix + '_stage_seconds_count{stage="' + stage + '"} ' + str(histogram.count))
+        lines.append("# HELP " + prefix + "_events_total Records, lookups, cache hits and pictures")
+        lines.append("# TYPE " + prefix + "_events_total counter")
+        for event, n in sorted(self.counters.items()):
+            lines.append(prefix + '_events_total{event="' + event + '"} ' + str(n))
+        lines.append("# HELP " + prefix + "_peak_memory_bytes Peak memory of the largest process")
+        lines.append("# TYPE " + prefix + "_peak_memory_bytes gauge")
+        for kind, peak in sorted(self.peak_memory.items()):
+            lines.append(prefix + '_peak_memory_bytes{kind="' + kind + '"} ' + str(peak))
+        return "\n".join(lines) + "\n"
+
+    def to_prometheus(self, path):
+        write_atomically(path, self.prometheus_text())
+
+
+def write_atomically(path, text):
+    # the node exporter textfile collector must not see half-written files
+    tmp = path + "." + str(os.getpid()) + ".tmp"
+    with open(tmp, "w") as out:
+        out.write(text)
+    os.replace(tmp, path)
+
+
+# the registry of this process
+registry = Metrics()
+
+
+def timer(stage):
+    return registry.timer(stage)
+
+
+def count(event, n=1):
+    registry.count(event, n)
+
+
+def timed(stage):
+    """
+    Decorator observing the wall time of each call in the registry
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with registry.timer(stage):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def timed_iter(iterable, stage):
+    """
+    Observes the time spent on getting each item of an iterable (like parsing the next VCF record)
+    """
+    histogram = registry.histogram(stage)
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        histogram.observe(time.perf_counter() - start)
+        yield item
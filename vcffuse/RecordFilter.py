@@ -0,0 +1,129 @@
+"""
+Keeps only the records of a gene panel, before anything is looked up or computed for them
+"""
+import logging
+import os
+from intervaltree import IntervalTree
+from vcffuse import VCFReader, VCFRecord
+from vcffuse.BreakendPairer import mate_position
+from vcffuse.GTFAnnotation import strip_version
+
+logger = logging.getLogger(__name__)
+
+
+def contig_key(chromosome: str):
+    # chr12, CHR12 and 12 are the same
+    chromosome = chromosome.lower()
+    return chromosome[3:] if chromosome.startswith("chr") else chromosome
+
+
+def read_regions(path):
+    """
+    :param path: BED file, can be gzipped
+    :return: contig key -> IntervalTree of the regions, in 0-based half-open BED coordinates
+    """
+    regions = {}
+    with VCFReader.open_text(path) as bed:
+        for line in bed:
+            if not line.strip() or line.startswith(("#", "track", "browser")):
+                continue
+            columns = line.split("\t", 3)
+            start, end = int(columns[1]), int(columns[2])
+            if end > start:
+                regions.setdefault(contig_key(columns[0]), IntervalTree()).addi(start, end)
+    for tree in regions.values():
+        tree.merge_overlaps()
+    return regions
+
+
+def read_genes(genes):
+    """
+    :param genes: file with gene symbols or ENSEMBL IDs (separated by new lines, spaces or commas),
+    or the list itself like ALK,ETV6,ENSG00000140538
+    :return: set of upper case symbols and unversioned IDs
+    """
+    if os.path.isfile(genes):
+        with VCFReader.open_text(genes) as gene_file:
+            text = "\n".join(line.split("#", 1)[0] for line in gene_file)
+    else:
+        text = genes
+    return set(strip_version(gene).upper() for gene in text.replace(",", " ").split())
+
+
+def fusion_genes(record: VCFRecord.VCFRecord):
+    """
+    Gene symbols and IDs of the gene_fusion annotations of a record, as they are in the ANN field
+    """
+    genes = set()
+    for fusion in record.ann.fusions():
+        genes.update(fusion.get("Gene_Name", "").split("&"))
+        genes.update(fusion.get("Gene_ID", "").split("&"))
+    return genes
+
+
+def breakpoints(record: VCFRecord.VCFRecord):
+    """
+    (contig key, position) of both ends: END of DEL, INV and DUP, the mate of BND
+    """
+    points = [(contig_key(record.chrom), record.pos)]
+    if record.kind == VCFRecord.TRANSLOCATION:
+        mate = mate_position(record.alt)
+        if mate is not None:
+            points.append((contig_key(mate[0]), mate[1]))
+    elif record.end is not None:
+        points.append((points[0][0], record.end))
+    return points
+
+
+class RecordFilter:
+    """
+    A record is kept if any of its breakpoints is in the regions, and any of its fusion genes is in the gene list.
+    The two breakends of a translocation are checked for the same two positions and genes,
+    so either both of them are kept or none.
+    :param regions: contig key -> IntervalTree, see read_regions()
+    :param genes: set of upper case gene symbols and IDs, see read_genes()
+    """
+
+    def __init__(self, regions=None, genes=None):
+        self.regions = regions
+        self.genes = genes
+        self.kept = 0
+        self.dropped = 0
+
+    @classmethod
+    def from_options(cls, regions=None, genes=None):
+        """
+        :return: a RecordFilter for the --regions BED and --genes LIST options, None if there is none of them
+        """
+        if regions is None and genes is None:
+            return None
+        record_filter = cls(read_regions(regions) if regions else None, read_genes(genes) if genes else None)
+        if record_filter.regions is not None:
+            logger.info("Regions: %d intervals from %s",
+                        sum(len(tree) for tree in record_filter.regions.values()), regions)
+        if record_filter.genes is not None:
+            logger.info("Genes: %d symbols and IDs", len(record_filter.genes))
+        return record_filter
+
+    def in_regions(self, record: VCFRecord.VCFRecord):
+        for contig, position in breakpoints(record):
+            tree = self.regions.get(contig)
+            # VCF positions are 1-based
+            if tree is not None and tree.overlaps_point(position - 1):
+                return True
+        return False
+
+    def has_genes(self, record: VCFRecord.VCFRecord):
+        return any(strip_version(gene).upper() in self.genes for gene in fusion_genes(record))
+
+    def accepts(self, record: VCFRecord.VCFRecord):
+        return ((self.regions is None or self.in_regions(record)) and
+                (self.genes is None or self.has_genes(record)))
+
+    def filter(self, records):
+        for record in records:
+            if self.accepts(record):
+                self.kept += 1
+                yield record
+            else:
+                self.dropped += 1
@@ -0,0 +1,114 @@
+"""
+Manifest of the runs on a VCF: for each record (the primary breakend of a translocation pair) a hash of its
+content, whether its fusions were made or it failed, and what came out of it: the pictures (or gallery
+panels) and the BEDPE / JSON Lines rows. A rerun with the same manifest takes the records that did not
+change and whose pictures are still there from the manifest, and makes only the failed and the new ones.
+Each record is written in its own transaction as soon as it is done, so a killed run loses nothing it
+finished. Like the annotation store, it is an SQLite file in WAL mode, all the workers write into it.
+"""
+import json
+import os
+import sqlite3
+import time
+from vcffuse.FusionMemo import digest
+
+DONE = "done"
+FAILED = "failed"
+
+
+def record_digest(record, mate_alt=None):
+    """
+    Hash of everything of a record the fusions depend on (not the FORMAT and sample columns)
+    """
+    return digest((record.chrom, record.pos, record.id, record.ref, record.alt, record.filter, record.info_field,
+                   record.kind, mate_alt))
+
+
+class RunManifest:
+    """
+    :param settings: the settings of the run the outputs depend on, if they are not the ones the manifest
+    was made with, everything in it is forgotten
+    """
+
+    def __init__(self, path, settings=None, timeout=60.0):
+        self._path = path
+        self._timeout = timeout
+        self._conn = None
+        self._pid = None
+        if settings is not None:
+            self.start(settings)
+
+    @property
+    def path(self):
+        return self._path
+
+    def _connection(self):
+        # connections must not be shared across fork(), so open a new one in each process
+        if self._conn is None or self._pid != os.getpid():
+            directory = os.path.dirname(os.path.abspath(self._path))
+            os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self._path, timeout=self._timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS record (record_ID TEXT PRIMARY KEY, hash TEXT, status TEXT, "
+                         "outputs TEXT, rows TEXT, error TEXT, updated REAL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS setting (key TEXT PRIMARY KEY, value TEXT)")
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def __getstate__(self):
+        # the connection stays in this process, the other one opens its own
+        state = self.__dict__.copy()
+        state["_conn"] = None
+        state["_pid"] = None
+        return state
+
+    def close(self):
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+
+    def start(self, settings):
+        """
+        Forgets the records if the settings are not the ones of the earlier runs
+        :return: True if the earlier records are kept
+        """
+        conn = self._connection()
+        value = digest(settings)
+        row = conn.execute("SELECT value FROM setting WHERE key = 'settings'").fetchone()
+        if row is not None and row[0] == value:
+            return True
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM record")
+        conn.execute("INSERT OR REPLACE INTO setting (key, value) VALUES ('settings', ?)", (value,))
+        conn.execute("COMMIT")
+        return row is None
+
+    def get(self, record_ID):
+        """
+        :return: (hash, status, outputs, rows, error) of the record, or None if it is not in the manifest
+        """
+        row = self._connection().execute("SELECT hash, status, outputs, rows, error FROM record WHERE record_ID = ?",
+                                         (record_ID,)).fetchone()
+        if row is None:
+            return None
+        content_hash, status, outputs, rows, error = row
+        return content_hash, status, json.loads(outputs), None if rows is None else json.loads(rows), error
+
+    def put(self, record_ID, content_hash, status, outputs=(), rows=None, error=None):
+        """
+        :param outputs: JSON-able outputs of the record, like the file names of the pictures
+        :param rows: FusionTable rows, None if they were not made
+        """
+        self._connection().execute(
+            "INSERT OR REPLACE INTO record (record_ID, hash, status, outputs, rows, error, updated) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (record_ID, content_hash, status, json.dumps(list(outputs)), None if rows is None else json.dumps(rows),
+             error, time.time()))
+
+    def counts(self):
+        """
+        :return: dict of status -> number of records
+        """
+        return dict(self._connection().execute("SELECT status, COUNT(*) FROM record GROUP BY status").fetchall())
@@ -0,0 +1,71 @@
+"""
+Streaming writer for the fusion pictures. It writes the very same bytes as the svgwrite DOM,
+but straight to a buffered file, without building and validating a tree of elements first.
+"""
+
+HEADER = ('<?xml version="1.0" encoding="utf-8" ?>\n'
+          '<svg baseProfile="full" height="100%" version="1.1" width="100%" '
+          'xmlns="http://www.w3.org/2000/svg" xmlns:ev="http://www.w3.org/2001/xml-events" '
+          'xmlns:xlink="http://www.w3.org/1999/xlink"><defs />'
+          '<rect fill="white" height="100%" stroke="white" width="100%" x="0" y="0" />'
+          '<g fill="red" id="shapes">')
+FOOTER = '</g></svg>'
+
+
+def exon_boxes(exons):
+    """
+    (x, width) in mm of the exons longer than 1 base (breakpoint marks are not drawn), 100 bases per mm
+    """
+    for iv in sorted(exons):
+        if abs(iv.end - iv.begin) > 1:
+            yield iv.begin / 100, int(abs(iv.end - iv.begin + 100) / 100)
+
+
+def intron_box(exons):
+    """
+    (x, width) in mm of the bar under the exons
+    """
+    return exons.begin() / 100, int(abs(exons.end() - exons.begin())) / 100
+
+
+def exon_rects(exons, color):
+    # numbers are formatted by str() like svgwrite units are, so the output is the same
+    for x, width in exon_boxes(exons):
+        yield ('<rect fill="' + color + '" height="2cm" stroke="' + color + '" stroke-width="1" width="' +
+               str(width) + 'mm" x="' + str(x) + 'mm" y="0" />')
+
+
+def intron_rect(exons, color):
+    x, width = intron_box(exons)
+    return '<rect fill="' + color + '" height="2mm" width="' + str(width) + 'mm" x="' + str(x) + 'mm" y="8mm" />'
+
+
+def fusion_elements(fex):
+    """
+    Yields the pieces of the picture inside the shapes group: 5' exons, 3' exons, then the two intron bars
+    """
+    yield from exon_rects(fex[0], 'blue')
+    yield from exon_rects(fex[1], 'red')
+    yield intron_rect(fex[0], 'blue')
+    yield intron_rect(fex[1], 'red')
+
+
+def write_fusion_svg(fex, out):
+    """
+    :param fex: 5' and 3' exon IntervalTrees
+    :param out: text file handle to write into
+    """
+    out.write(HEADER)
+    for element in fusion_elements(fex):
+        out.write(element)
+    out.write(FOOTER)
+
+
+def fusion_svg(fex):
+    return HEADER + "".join(fusion_elements(fex)) + FOOTER
+
+
+def save_fusion_svg(fex, outfile, buffer_size=1 << 16):
+    with open(outfile, "w", encoding="utf-8", buffering=buffer_size) as out:
+        write_fusion_svg(fex, out)
+    return outfile
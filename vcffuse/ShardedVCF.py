@@ -0,0 +1,226 @@
+"""
+Shards of a VCF that workers can read on their own, without a single process reading the whole file:
+
+* a bgzipped VCF with a tabix index (``<VCF>.tbi``) is cut into contigs, or into chunks of contigs
+  (``shard_size`` bases), each one starting at the place the index gives;
+* a plain VCF is cut into byte ranges, each one starting at the first line beginning in it.
+
+The shards are in file order, and each record is in exactly one of them. A gzipped VCF without an index,
+or stdin, can not be sharded. write_tabix_index() makes the index where there is no htslib.
+"""
+import gzip
+import io
+import os
+import struct
+from collections import namedtuple
+from vcffuse import BGZF, VCFReader
+
+TABIX_MAGIC = b"TBI\1"
+# format (VCF), sequence, begin and end columns, meta character, lines to skip, length of the names
+TABIX_HEADER = struct.Struct("<4siiiiiiii")
+# the linear index has an entry for each 16 kb window
+LINEAR_SHIFT = 14
+VCF_FORMAT = 2
+# bin of the statistics htslib adds to each contig, its chunks are counts, not offsets
+PSEUDO_BIN = 37450
+
+# kind is "tabix" or "bytes"; a tabix shard is the records of contig with start <= POS < end (end None: to the end)
+# read from the virtual offset, a bytes shard is the lines starting in [offset, stop)
+Shard = namedtuple("Shard", ["path", "kind", "contig", "start", "end", "offset", "stop"])
+
+
+def read_tabix_index(path):
+    """
+    :return: list of (contig, offset of its first record, linear index) in the order of the index,
+    the offsets are virtual offsets
+    """
+    with gzip.open(path, "rb") as index:
+        data = index.read()
+    magic, n_ref, _, _, _, _, _, _, names_length = TABIX_HEADER.unpack_from(data, 0)
+    if magic != TABIX_MAGIC:
+        raise ValueError(path + " is not a tabix index")
+    position = TABIX_HEADER.size
+    names = data[position:position + names_length].split(b"\0")[:n_ref]
+    position += names_length
+    contigs = []
+    for name in names:
+        n_bin, = struct.unpack_from("<i", data, position)
+        position += 4
+        first = None
+        for _ in range(n_bin):
+            bin_number, n_chunk = struct.unpack_from("<Ii", data, position)
+            position += 8
+            if bin_number != PSEUDO_BIN:
+                for begin, _ in struct.iter_unpack("<QQ", data[position:position + n_chunk * 16]):
+                    first = begin if first is None else min(first, begin)
+            position += n_chunk * 16
+        n_intv, = struct.unpack_from("<i", data, position)
+        position += 4
+        linear = struct.unpack_from("<" + str(n_intv) + "Q", data, position)
+        position += n_intv * 8
+        if first is not None:
+            contigs.append((name.decode("utf-8"), first, linear))
+    return contigs
+
+
+def tabix_shards(path, shard_size=None):
+    shards = []
+    for contig, first, linear in sorted(read_tabix_index(path + ".tbi"), key=lambda contig: contig[1]):
+        if shard_size is None:
+            shards.append(Shard(path, "tabix", contig, 0, None, first, None))
+            continue
+        length = len(linear) << LINEAR_SHIFT
+        for start in range(0, max(length, 1), shard_size):
+            # the index is 0-based, a record at POS == start begins in the window of start - 1
+            window = max(0, start - 1) >> LINEAR_SHIFT
+            # an empty window has no offset, the records of the shard can not be before the first one anyway
+            offset = max(first, linear[window]) if window < len(linear) else first
+            # the last shard takes whatever is past the linear index
+            end = start + shard_size if start + shard_size < length else None
+            shards.append(Shard(path, "tabix", contig, start, end, offset, None))
+    return shards
+
+
+def byte_shards(path, count):
+    size = os.path.getsize(path)
+    step = max(1, -(-size // max(1, count)))
+    return [Shard(path, "bytes", None, 0, None, offset, min(size, offset + step)) for offset in range(0, size, step)]
+
+
+def plan_shards(path, count, shard_size=None):
+    """
+    :param count: number of byte range shards of a plain VCF
+    :param shard_size: bases in a shard of an indexed VCF, None for whole contigs
+    :return: list of Shards in file order, or None if the VCF can not be sharded
+    """
+    if path == "-":
+        return None
+    if os.path.exists(path + ".tbi"):
+        return tabix_shards(path, shard_size)
+    with open(path, "rb") as vcf:
+        if vcf.read(2) == VCFReader.GZIP_MAGIC:
+            return None
+    return byte_shards(path, count)
+
+
+def read_shard(shard: Shard):
+    """
+    Yields the lines of a shard (with the header lines for the first byte range)
+    """
+    if shard.kind == "bytes":
+        yield from read_byte_range(shard.path, shard.offset, shard.stop)
+    else:
+        yield from read_tabix_range(shard)
+
+
+def read_byte_range(path, offset, stop):
+    with open(path, "rb", buffering=VCFReader.BUFFER_SIZE) as vcf:
+        if offset > 0:
+            # the line going on at the offset is in the shard before
+            vcf.seek(offset - 1)
+            vcf.readline()
+        position = vcf.tell()
+        while position < stop:
+            line = vcf.readline()
+            if not line:
+                return
+            position += len(line)
+            yield line.decode("utf-8")
+
+
+def read_tabix_range(shard: Shard):
+    with open(shard.path, "rb") as bgzf:
+        bgzf.seek(shard.offset >> 16)
+        # the blocks are gzip members, GzipFile goes on from one to the next
+        raw = gzip.GzipFile(fileobj=bgzf, mode="rb")
+        raw.read(shard.offset & 0xffff)
+        with io.TextIOWrapper(io.BufferedReader(raw, VCFReader.BUFFER_SIZE), encoding="utf-8") as vcf:
+            for line in vcf:
+                if line[0] == "#":
+                    continue
+                contig, pos, _ = line.split("\t", 2)
+                if contig != shard.contig:
+                    return
+                pos = int(pos)
+                if shard.end is not None and pos >= shard.end:
+                    return
+                if pos >= shard.start:
+                    yield line
+
+
+def reg2bin(begin, end):
+    """
+    Bin of the 0-based [begin, end) interval in the UCSC binning scheme of tabix
+    """
+    end -= 1
+    for shift, offset in ((14, 4681), (17, 585), (20, 73), (23, 9), (26, 1)):
+        if begin >> shift == end >> shift:
+            return offset + (begin >> shift)
+    return 0
+
+
+def record_interval(line: bytes):
+    """
+    0-based [begin, end) of a VCF line the way tabix has it: from POS to the END INFO value, or over REF
+    """
+    columns = line.split(b"\t", 8)
+    begin = int(columns[1]) - 1
+    end = begin + len(columns[3])
+    info = columns[7] if len(columns) > 7 else b""
+    for item in info.split(b";"):
+        if item.startswith(b"END="):
+            try:
+                end = max(end, int(item[4:]))
+            except ValueError:
+                pass
+            break
+    return columns[0].decode("utf-8"), begin, end
+
+
+def write_tabix_index(path):
+    """
+    Writes <path>.tbi for a coordinate-sorted bgzipped VCF, the same index `tabix -p vcf` makes
+    (without the optional statistics pseudo-bin)
+    :return: path of the index
+    """
+    contigs = {}    # contig -> (bins: bin -> list of [begin, end] chunks, linear index)
+    order = []
+    for start, end, line in BGZF.lines(path):
+        if not line or line[:1] == b"#":
+            continue
+        contig, begin, stop = record_interval(line)
+        if contig not in contigs:
+            contigs[contig] = ({}, [])
+            order.append(contig)
+        bins, linear = contigs[contig]
+        chunks = bins.setdefault(reg2bin(begin, max(stop, begin + 1)), [])
+        if chunks and chunks[-1][1] == start:
+            chunks[-1][1] = end
+        else:
+            chunks.append([start, end])
+        last_window = (max(stop, begin + 1) - 1) >> LINEAR_SHIFT
+        if len(linear) <= last_window:
+            linear.extend([None] * (last_window + 1 - len(linear)))
+        for window in range(begin >> LINEAR_SHIFT, last_window + 1):
+            if linear[window] is None:
+                linear[window] = start
+    names = b"".join(contig.encode("utf-8") + b"\0" for contig in order)
+    index = bytearray(TABIX_HEADER.pack(TABIX_MAGIC, len(order), VCF_FORMAT, 1, 2, 0, ord("#"), 0, len(names)))
+    index += names
+    for contig in order:
+        bins, linear = contigs[contig]
+        index += struct.pack("<i", len(bins))
+        for bin_number in sorted(bins):
+            index += struct.pack("<Ii", bin_number, len(bins[bin_number]))
+            for chunk in bins[bin_number]:
+                index += struct.pack("<QQ", *chunk)
+        # an empty window points where the one before it does, like in htslib
+        previous = 0
+        for window, offset in enumerate(linear):
+            if offset is None:
+                linear[window] = previous
+            previous = linear[window]
+        index += struct.pack("<i" + str(len(linear)) + "Q", len(linear), *linear)
+    with BGZF.BGZFWriter(path + ".tbi") as out:
+        out.write_bytes(bytes(index))
+    return path + ".tbi"
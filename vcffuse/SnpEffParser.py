@@ -1,19 +1,145 @@
 import re
 
+# the field layout snpEff writes into the ##INFO=<ID=ANN header line, if the VCF does not tell otherwise
+ANN_KEYS = ("Allele", "Annotation", "Annotation_Impact", "Gene_Name", "Gene_ID", "Feature_Type", "Feature_ID",
+            "Transcript_BioType", "Rank", "HGVS.c", "HGVS.p", "cDNA.pos / cDNA.length", "CDS.pos / CDS.length",
+            "AA.pos / AA.length", "Distance", "ERRORS / WARNINGS / INFO")
+
+
+class AnnEntry:
+    """
+    View of a single ANN entry: the fields are split only when the first one is asked for
+    """
+    __slots__ = ("_text", "_parser", "_fields")
+
+    def __init__(self, text: str, parser):
+        self._text = text
+        self._parser = parser
+        self._fields = None
+
+    def __getitem__(self, key):
+        """
+        :param key: field name from the header (like "Gene_ID") or its index
+        """
+        if self._fields is None:
+            self._fields = self._text.split("|")
+        return self._fields[self._parser.index(key) if isinstance(key, str) else key]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except (IndexError, KeyError):
+            return default
+
+    @property
+    def text(self):
+        return self._text
+
+    def __repr__(self):
+        return "AnnEntry(" + repr(self._text) + ")"
+
+
+class Annotations:
+    """
+    The entries of an ANN value, found by scanning the string, without splitting up the entries we do not need.
+    :param ann: the ANN INFO value, like "<INV>|gene_fusion|HIGH|...,<INV>|inversion|HIGH|..."
+    """
+    __slots__ = ("_ann", "_parser")
+
+    def __init__(self, ann: str, parser):
+        self._ann = ann
+        self._parser = parser
+
+    def spans(self):
+        """
+        Yields the (start, end) of the entries in the ANN value
+        """
+        ann = self._ann
+        start = 0
+        while start < len(ann):
+            end = ann.find(",", start)
+            if end < 0:
+                end = len(ann)
+            yield start, end
+            start = end + 1
+
+    def __iter__(self):
+        for start, end in self.spans():
+            yield AnnEntry(self._ann[start:end], self._parser)
+
+    def __len__(self):
+        return self._ann.count(",") + 1 if self._ann else 0
+
+    def __bool__(self):
+        return bool(self._ann)
+
+    def column(self, key):
+        """
+        :return: list of the values of a field, one for each entry ("" where the entry is too short)
+        """
+        return [entry.get(key, "") for entry in self]
+
+    def select(self, key, value):
+        """
+        Yields the entries having this value in the field. For the fields in the middle (like Annotation)
+        only the places where "|value|" is in the string are looked at, the other entries are skipped.
+        """
+        index = self._parser.index(key)
+        if index == 0 or index >= len(self._parser.ann_keys) - 1:
+            for entry in self:
+                if entry.get(index) == value:
+                    yield entry
+            return
+        ann = self._ann
+        needle = "|" + value + "|"
+        hit = ann.find(needle)
+        while hit >= 0:
+            start = ann.rfind(",", 0, hit) + 1
+            end = ann.find(",", hit)
+            if end < 0:
+                end = len(ann)
+            # the value has to be in the very field, not in an other one of the same entry
+            if ann.count("|", start, hit) == index - 1:
+                yield AnnEntry(ann[start:end], self._parser)
+            hit = ann.find(needle, end)
+
+    def fusions(self):
+        """
+        Yields the gene_fusion entries
+        """
+        return self.select("Annotation", "gene_fusion")
+
+    def first_fusion(self):
+        """
+        :return: the first gene_fusion entry or None
+        """
+        return next(self.fusions(), None)
+
+
 class SnpEffParser:
     """
-        We are processing an snpEff annotation entry (not a VCF line, but the ANN= stuff)
-        and returning with a list of dictionaries
+        We are processing an snpEff annotation entry (not a VCF line, but the ANN= stuff).
+        The field layout is read from the ##INFO=<ID=ANN header line once, and annotations()
+        gives a lazy view of the entries; parse_se_ann() is returning with a list of dictionaries
     """
 
-    def __init__(self):
+    def __init__(self, ann_keys=ANN_KEYS):
         self._ann_list = list()  # list of annotations
         self._ann_keys = list()
+        self._index = {}
+        self.set_ann_keys(ann_keys)
         # storing regex patterns that we need for annotation parsing
         self._ann_regex = {}    # dict of regex patterns matching annotations
         self._ann_regex["comment"] = re.compile("^#.*")
         self._ann_regex["gene_fusion"] = re.compile(".*gene_fusion.*")
 
+    def __reduce__(self):
+        # records are going to the worker processes with their parser, only the layout has to go with them,
+        # and not even that for the default one
+        if tuple(self._ann_keys) == ANN_KEYS:
+            return default, ()
+        return self.__class__, (tuple(self._ann_keys),)
+
     @property
     def ann_keys(self):
         return self._ann_keys
@@ -25,28 +151,49 @@ class SnpEffParser:
     def add_ann_list(self, ann: dict):
         self._ann_list.append(ann)
 
+    def set_ann_keys(self, ann_keys):
+        self._ann_keys = list(ann_keys)
+        self._index = {key: i for i, key in enumerate(self._ann_keys)}
+
     def add_ann_keys(self, ann_line: str):
         """
         Parsing the ##INFO=<ID=ANN line
         """
         entry_list = ann_line.split("'")[1]
-        entries = entry_list.split("|")
-        for item in entries:
-            self._ann_keys.append(item.strip())
+        self.set_ann_keys(item.strip() for item in entry_list.split("|"))
+
+    def index(self, key: str):
+        """
+        :return: position of a field in the entries, KeyError if the header does not have it
+        """
+        return self._index[key]
+
+    def annotations(self, ann: str):
+        """
+        :param ann: the ANN INFO value
+        :return: Annotations view of the entries
+        """
+        return Annotations(ann or "", self)
 
     def parse_se_ann(self, line, regexp):
         """
         Annotation entries are delimited by commas, process each entry, and add to a list if contains gene_fusion
         """
-        ann_dict = {}
         entries = line.split("ANN=")[1]
         entries = entries.split(",")
         for tr_ann in entries:  # get the transcript items
             if regexp.match(tr_ann):
                 # chop up values into a list
                 ann_list = tr_ann.split("|")
-                # add values into a dict
-                for i in range(0, len(self.ann_keys)):
-                    ann_dict[self.ann_keys[i]] = ann_list[i]
+                # add values into a dict, a new one for each entry
+                ann_dict = dict(zip(self.ann_keys, ann_list))
                 # add dict to collection (list)
                 self._ann_list.append(ann_dict)
+
+
+# for records read without the VCF header
+default_parser = SnpEffParser()
+
+
+def default():
+    return default_parser
@@ -0,0 +1,310 @@
+"""
+Synthetic Manta VCFs with snpEff gene_fusion annotations (DEL, INV, DUP:TANDEM and BND mate pairs),
+and the ENSEMBL REST style JSON models of the genes and transcripts they are referring to.
+Everything is derived from the seed, so the same settings are always giving the same files.
+The VCF is coordinate-sorted, and the records are streamed, so even millions of them fit in memory.
+
+    python -m vcffuse.SyntheticData --records 100000 --out synthetic
+"""
+import heapq
+import json
+import os
+import random
+import click
+from vcffuse import AnnotationStore
+
+# numbered contigs only: the driver lowercases the breakend ALT, so CHRX would not match chrX
+CONTIGS = tuple(str(i) for i in range(1, 23))
+# genes are put into slots of this size along the contigs, so they never overlap
+SLOT_SIZE = 400000
+# number of exons of the huge genes (TTN has 363)
+HUGE_EXONS = 363
+# relative frequency of the SV kinds
+KIND_WEIGHTS = (("DEL", 4), ("INV", 2), ("DUP:TANDEM", 2), ("BND", 2))
+# the three ways two breakends can be joined: ALT of the record and ALT of its mate
+BND_JOINS = (("{base}]CHR{contig}:{pos}]", "{base}]CHR{contig}:{pos}]"),
+             ("[CHR{contig}:{pos}[{base}", "[CHR{contig}:{pos}[{base}"),
+             ("{base}[CHR{contig}:{pos}[", "]CHR{contig}:{pos}]{base}"))
+
+ANN_KEYS = ("Allele | Annotation | Annotation_Impact | Gene_Name | Gene_ID | Feature_Type | Feature_ID | "
+            "Transcript_BioType | Rank | HGVS.c | HGVS.p | cDNA.pos / cDNA.length | CDS.pos / CDS.length | "
+            "AA.pos / AA.length | Distance | ERRORS / WARNINGS / INFO")
+HEADER = ["##fileformat=VCFv4.1",
+          "##source=GenerateSVCandidates 1.6.0 (vcffuse synthetic data)",
+          "##reference=file:///synthetic/GRCh38.fasta"] + \
+         ["##contig=<ID=chr" + contig + ">" for contig in CONTIGS] + \
+         ['##INFO=<ID=END,Number=1,Type=Integer,Description="End position of the variant described in this record">',
+          '##INFO=<ID=SVTYPE,Number=1,Type=String,Description="Type of structural variant">',
+          '##INFO=<ID=SVLEN,Number=.,Type=Integer,Description="Difference in length between REF and ALT alleles">',
+          '##INFO=<ID=MATEID,Number=.,Type=String,Description="ID of mate breakend">',
+          '##INFO=<ID=SOMATIC,Number=0,Type=Flag,Description="Somatic mutation">',
+          '##INFO=<ID=SOMATICSCORE,Number=1,Type=Integer,Description="Somatic variant quality score">',
+          '##INFO=<ID=ANN,Number=.,Type=String,Description="Functional annotations: \'' + ANN_KEYS + ' \'">',
+          '##FORMAT=<ID=PR,Number=.,Type=Integer,Description="Spanning paired-read support">',
+          '##FORMAT=<ID=SR,Number=.,Type=Integer,Description="Split reads">',
+          "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tNORMAL\tTUMOR"]
+SAMPLES = "PR:SR\t30,0:41,0\t24,9:33,12"
+
+
+class SyntheticGene:
+    """
+    A gene in a slot of a contig, with its canonical transcript and an other, shorter one
+    """
+    __slots__ = ("number", "contig", "strand", "name", "exons")
+
+    def __init__(self, number, contig, strand, name, exons):
+        self.number = number
+        self.contig = contig
+        self.strand = strand
+        self.name = name
+        self.exons = exons  # sorted (start, end) pairs of the canonical transcript
+
+    @property
+    def gene_ID(self):
+        return "ENSG%011d" % self.number
+
+    @property
+    def transcript_ID(self):
+        return "ENST%011d" % self.number
+
+    @property
+    def start(self):
+        return self.exons[0][0]
+
+    @property
+    def end(self):
+        return self.exons[-1][1]
+
+    def transcript_json(self, number, exons, canonical):
+        return {"object_type": "Transcript", "id": "ENST%011d" % number, "Parent": self.gene_ID,
+                "display_name": self.name + ("-201" if canonical else "-202"), "is_canonical": canonical,
+                "biotype": "protein_coding", "seq_region_name": self.contig, "strand": self.strand,
+                "start": exons[0][0], "end": exons[-1][1],
+                "Exon": [{"object_type": "Exon", "id": "ENSE%08d%03d" % (self.number % 10 ** 8, i),
+                          "seq_region_name": self.contig, "strand": self.strand, "start": start, "end": end}
+                         for i, (start, end) in enumerate(exons)]}
+
+    def gene_json(self):
+        """
+        Like the ENSEMBL REST /lookup/id/ENSG...?expand=1 answer
+        """
+        # the other transcript is missing the first and the last exons
+        transcripts = [self.transcript_json(self.number, self.exons, 1)]
+        if len(self.exons) > 2:
+            transcripts.append(self.transcript_json(self.number + 5 * 10 ** 9, self.exons[1:-1], 0))
+        return {"object_type": "Gene", "id": self.gene_ID, "display_name": self.name, "biotype": "protein_coding",
+                "seq_region_name": self.contig, "strand": self.strand, "start": self.start, "end": self.end,
+                "Transcript": transcripts}
+
+    def canonical_json(self):
+        """
+        Like the ENSEMBL REST /lookup/id/ENST...?expand=1 answer
+        """
+        return self.transcript_json(self.number, self.exons, 1)
+
+
+class SyntheticData:
+    """
+    :param records: number of SV records (a BND mate pair is counted once)
+    :param reuse: number of records sharing the same pair of genes, more is more annotation cache hits
+    :param huge_fraction: fraction of the genes with HUGE_EXONS exons
+    """
+
+    def __init__(self, records=1000, seed=42, reuse=2, huge_fraction=0.01, contigs=CONTIGS):
+        self.records = records
+        self.seed = seed
+        self.reuse = max(1, reuse)
+        self.huge_fraction = huge_fraction
+        self.contigs = tuple(contigs)
+
+    def records_on_contig(self, contig_index):
+        share, remainder = divmod(self.records, len(self.contigs))
+        return share + (1 if contig_index < remainder else 0)
+
+    def pairs_on_contig(self, contig_index):
+        return -(-self.records_on_contig(contig_index) // self.reuse)
+
+    def gene(self, contig_index, slot) -> SyntheticGene:
+        number = (contig_index + 1) * 10 ** 7 + slot
+        rnd = random.Random(self.seed * 1000003 + number)
+        huge = rnd.random() < self.huge_fraction
+        if huge:
+            n_exons, introns = HUGE_EXONS, (50, 500)
+        else:
+            n_exons, introns = rnd.randint(2, 30), (200, 10000)
+        pos = slot * SLOT_SIZE + rnd.randint(1000, 20000)
+        exons = []
+        for _ in range(n_exons):
+            length = rnd.randint(50, 400)
+            exons.append((pos, pos + length))
+            pos += length + rnd.randint(*introns)
+        strand = 1 if rnd.random() < 0.5 else -1
+        return SyntheticGene(number, self.contigs[contig_index], strand, "SYN" + str(number), exons)
+
+    def gene_model(self, ENS_ID):
+        """
+        :return: the JSON object of a gene or canonical transcript of the data, None for other IDs
+        """
+        if len(ENS_ID) != 15 or ENS_ID[:4] not in ("ENSG", "ENST") or not ENS_ID[4:].isdigit():
+            return None
+        contig_index, slot = divmod(int(ENS_ID[4:]), 10 ** 7)
+        contig_index -= 1
+        if not 0 <= contig_index < len(self.contigs) or slot >= 2 * self.pairs_on_contig(contig_index):
+            return None
+        gene = self.gene(contig_index, slot)
+        return gene.gene_json() if ENS_ID[3] == "G" else gene.canonical_json()
+
+    def genes(self):
+        """
+        Yields all the genes the records are referring to, contig by contig
+        """
+        for contig_index in range(len(self.contigs)):
+            for slot in range(2 * self.pairs_on_contig(contig_index)):
+                yield self.gene(contig_index, slot)
+
+    def vcf_lines(self):
+        """
+        Yields the header lines and the records, coordinate-sorted, without line ends
+        """
+        yield from HEADER
+        rnd = random.Random(self.seed)
+        kinds = [kind for kind, _ in KIND_WEIGHTS]
+        weights = [weight for _, weight in KIND_WEIGHTS]
+        counter = 0
+        mates = []  # heap of (position, line) of the BND mates of the current contig
+        for contig_index in range(len(self.contigs)):
+            heapq.heapify(mates)
+            next_mates = []
+            last = contig_index == len(self.contigs) - 1 or self.pairs_on_contig(contig_index + 1) == 0
+            remaining = self.records_on_contig(contig_index)
+            for pair in range(self.pairs_on_contig(contig_index)):
+                genes = (self.gene(contig_index, 2 * pair), self.gene(contig_index, 2 * pair + 1))
+                lines = []
+                for _ in range(min(self.reuse, remaining)):
+                    counter += 1
+                    kind = rnd.choices(kinds, weights)[0]
+                    if kind == "BND" and last:
+                        kind = "DEL"
+                    if kind == "BND":
+                        mate_slot = 2 * rnd.randrange(self.pairs_on_contig(contig_index + 1))
+                        mate_gene = self.gene(contig_index + 1, mate_slot)
+                        (pos, line), mate = self.breakend_pair(rnd, counter, genes[0], mate_gene)
+                        next_mates.append(mate)
+                    else:
+                        pos, line = self.sv_line(rnd, counter, kind, genes)
+                    lines.append((pos, line))
+                remaining -= self.reuse
+                for pos, line in sorted(lines):
+                    while mates and mates[0][0] <= pos:
+                        yield heapq.heappop(mates)[1]
+                    yield line
+            while mates:
+                yield heapq.heappop(mates)[1]
+            mates = next_mates
+
+    @staticmethod
+    def breakpoint(rnd, gene: SyntheticGene):
+        return rnd.randint(gene.start + 1, gene.end - 1)
+
+    def sv_line(self, rnd, counter, kind, genes):
+        pos = self.breakpoint(rnd, genes[0])
+        end = self.breakpoint(rnd, genes[1])
+        ID = "Manta" + kind + ":" + str(counter) + ":0:1:0:0:0"
+        names = genes[0].name + "&" + genes[1].name
+        IDs = genes[0].gene_ID + "&" + genes[1].gene_ID
+        svtype, svlen, hgvs = {"DEL": ("DEL", pos - end, "del"),
+                               "INV": ("INV", end - pos, "inv"),
+                               "DUP:TANDEM": ("DUP", end - pos, "dup")}[kind]
+        feature = genes[0].gene_ID if kind == "DUP:TANDEM" else genes[1].gene_ID
+        ann = ("<" + kind + ">|gene_fusion|HIGH|" + names + "|" + IDs + "|gene_variant|" + feature +
+               "|||n." + str(pos + 1) + "_" + str(end) + hgvs + "||||||")
+        info = ("END=" + str(end) + ";SVTYPE=" + svtype + ";SVLEN=" + str(svlen) + ";SOMATIC;SOMATICSCORE=" +
+                str(rnd.randint(10, 200)) + ";ANN=" + ann)
+        line = "\t".join(("chr" + genes[0].contig, str(pos), ID, rnd.choice("ACGT"), "<" + kind + ">", ".", "PASS",
+                          info, SAMPLES))
+        return pos, line
+
+    def breakend_pair(self, rnd, counter, gene: SyntheticGene, mate_gene: SyntheticGene):
+        """
+        :return: (position, line) of the breakend, and of its mate on the next contig
+        """
+        pos = self.breakpoint(rnd, gene)
+        mate_pos = self.breakpoint(rnd, mate_gene)
+        join, mate_join = rnd.choice(BND_JOINS)
+        base, mate_base = rnd.choice("ACGT"), rnd.choice("ACGT")
+        ID = "MantaBND:" + str(counter) + ":0:1:0:0:0:"
+        translocation = "t(" + gene.contig + "%3B" + mate_gene.contig + ")"
+        lines = []
+        for (contig, position, ref, alt, own, mate) in (
+                (gene.contig, pos, base, join.format(base=base, contig=mate_gene.contig, pos=mate_pos), "0", "1"),
+                (mate_gene.contig, mate_pos, mate_base,
+                 mate_join.format(base=mate_base, contig=gene.contig, pos=pos), "1", "0")):
+            ann = (alt + "|gene_fusion|HIGH|" + gene.name + "&" + mate_gene.name + "|" + gene.gene_ID + "&" +
+                   mate_gene.gene_ID + "|transcript|" + gene.transcript_ID + ".1|protein_coding|1/" +
+                   str(len(gene.exons)) + "|" + translocation + "(p1%3Bq1)(c.1-1)|" + translocation + "(" +
+                   gene.transcript_ID + ":Met1_Ala10%3B" + mate_gene.transcript_ID + ":Gly5_Ter100)|||||")
+            info = ("SVTYPE=BND;MATEID=" + ID + mate + ";SOMATIC;SOMATICSCORE=" + str(rnd.randint(10, 200)) +
+                    ";ANN=" + ann)
+            lines.append((position, "\t".join(("chr" + contig, str(position), ID + own, ref, alt, ".", "PASS", info,
+                                                SAMPLES))))
+        return lines[0], lines[1]
+
+    def write_vcf(self, path):
+        with open(path, "w", buffering=1 << 20) as out:
+            for line in self.vcf_lines():
+                out.write(line)
+                out.write("\n")
+        return path
+
+    def gene_models(self):
+        """
+        Yields (ENSEMBL ID, JSON object) for the genes and the canonical transcripts
+        """
+        for gene in self.genes():
+            yield gene.gene_ID, gene.gene_json()
+            yield gene.transcript_ID, gene.canonical_json()
+
+    def write_gene_models(self, directory):
+        """
+        One <ENSEMBL ID>.json for each gene and transcript, the driver reads these with --no-rest
+        """
+        os.makedirs(directory, exist_ok=True)
+        for ENS_ID, obj in self.gene_models():
+            with open(os.path.join(directory, ENS_ID + ".json"), "w") as json_file:
+                json_file.write(json.dumps(obj))
+
+    def fill_store(self, store: AnnotationStore.AnnotationStore):
+        for ENS_ID, obj in self.gene_models():
+            store.put(ENS_ID, AnnotationStore.coords_from_json(obj))
+        return store
+
+
+def write_dataset(directory, records=1000, seed=42, reuse=2, huge_fraction=0.01, models=True):
+    """
+    Writes synthetic.vcf and the JSON gene models into the directory
+    :return: path of the VCF
+    """
+    data = SyntheticData(records, seed, reuse, huge_fraction)
+    os.makedirs(directory, exist_ok=True)
+    if models:
+        data.write_gene_models(directory)
+    return data.write_vcf(os.path.join(directory, "synthetic.vcf"))
+
+
+@click.command(context_settings=dict(help_option_names=['-h', '--help']))
+@click.option('--records', '-n', type=int, required=False, default=1000, show_default=True,
+              help='Number of SV records, a BND mate pair is one record')
+@click.option('--out', '-o', type=str, required=True, help='Directory for synthetic.vcf and the JSON gene models')
+@click.option('--seed', type=int, required=False, default=42, show_default=True)
+@click.option('--reuse', type=int, required=False, default=2, show_default=True,
+              help='Number of records sharing the same pair of genes')
+@click.option('--huge-fraction', type=float, required=False, default=0.01, show_default=True,
+              help='Fraction of the genes with ' + str(HUGE_EXONS) + ' exons')
+@click.option('--models/--no-models', type=bool, required=False, default=True,
+              help='Write the JSON gene models as well')
+def generate(records, out, seed, reuse, huge_fraction, models):
+    click.echo(write_dataset(out, records, seed, reuse, huge_fraction, models))
+
+
+if __name__ == "__main__":
+    generate()
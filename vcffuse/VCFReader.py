@@ -0,0 +1,22 @@
+import gzip
+import io
+import sys
+
+# big reads are much cheaper on networked filesystems and with gzip
+BUFFER_SIZE = 1 << 20
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def open_text(path, buffer_size=BUFFER_SIZE):
+    """
+    Opens a plain, gzipped or bgzipped (BGZF is just a series of gzip members) text file
+    for streaming; "-" is for stdin. Compression is recognised by the magic bytes,
+    not by the file name, so it works for pipes as well.
+    """
+    if path == "-":
+        raw = io.BufferedReader(sys.stdin.buffer, buffer_size)
+    else:
+        raw = open(path, 'rb', buffering=buffer_size)
+    if raw.peek(2)[:2] == GZIP_MAGIC:
+        raw = io.BufferedReader(gzip.GzipFile(fileobj=raw, mode='rb'), buffer_size)
+    return io.TextIOWrapper(raw, encoding='utf-8')
@@ -0,0 +1,125 @@
+"""
+One-pass tokenizer for the Manta VCF lines we are interested in
+"""
+from vcffuse import SnpEffParser
+
+TANDEM = "DUP:TANDEM"
+TRANSLOCATION = "BND"
+INVERSION = "INV"
+DELETION = "DEL"
+
+# SV kind by the SVTYPE INFO value
+SVTYPE_KINDS = {"DEL": DELETION, "INV": INVERSION, "BND": TRANSLOCATION, "DUP": TANDEM}
+# and by the Manta ID prefix (MantaBND:128962:0:1:0:0:0:0) if there is no SVTYPE
+ID_PREFIX_KINDS = {"MantaDEL": DELETION, "MantaINV": INVERSION, "MantaBND": TRANSLOCATION, "MantaDUP": TANDEM}
+
+
+def info_value(info_field: str, key: str):
+    """
+    Value of a single INFO key without decoding the whole field, None if the key is not there
+    """
+    if info_field.startswith(key + "="):
+        start = len(key) + 1
+    else:
+        start = info_field.find(";" + key + "=")
+        if start < 0:
+            return None
+        start += len(key) + 2
+    end = info_field.find(";", start)
+    return info_field[start:] if end < 0 else info_field[start:end]
+
+
+class VCFRecord:
+    """
+    A VCF line split once into its columns. The INFO column is decoded only when somebody asks for it.
+    """
+    __slots__ = ("chrom", "pos", "id", "ref", "alt", "qual", "filter", "info_field", "rest", "kind", "_info",
+                 "ann_parser")
+
+    def __init__(self, columns: list, kind):
+        self.chrom = columns[0]
+        self.pos = int(columns[1])
+        self.id = columns[2]
+        self.ref = columns[3]
+        self.alt = columns[4]
+        self.qual = columns[5]
+        self.filter = columns[6]
+        self.info_field = columns[7]
+        # FORMAT and the samples, we are not splitting them at all
+        self.rest = columns[8] if len(columns) > 8 else ""
+        self.kind = kind
+        self._info = None
+        # SnpEffParser with the ANN layout of the VCF header, see read_fusion_records()
+        self.ann_parser = SnpEffParser.default_parser
+
+    @classmethod
+    def parse(cls, line: str, fusions_only=True):
+        """
+        :return: a VCFRecord for a PASS SV line (with a gene_fusion annotation if fusions_only)
+        or None for headers, filtered records and things we can not make a fusion of
+        """
+        if not line or line[0] == "#":
+            return None
+        columns = line.rstrip("\r\n").split("\t", 8)
+        if len(columns) < 8 or columns[6] != "PASS":
+            return None
+        if fusions_only and "gene_fusion" not in columns[7]:
+            return None
+        kind = cls.sv_kind(columns)
+        if kind is None:
+            return None
+        return cls(columns, kind)
+
+    @staticmethod
+    def sv_kind(columns: list):
+        svtype = info_value(columns[7], "SVTYPE")
+        if svtype is not None:
+            kind = SVTYPE_KINDS.get(svtype)
+        else:
+            kind = ID_PREFIX_KINDS.get(columns[2].split(":", 1)[0])
+        if kind == TANDEM and "TANDEM" not in columns[4] and "TANDEM" not in columns[2]:
+            # we can deal only with tandem duplications
+            return None
+        return kind
+
+    @property
+    def info(self):
+        if self._info is None:
+            info = {}
+            for item in self.info_field.split(";"):
+                key, _, value = item.partition("=")
+                # flags like SOMATIC or IMPRECISE are just True
+                info[key] = value if _ else True
+            self._info = info
+        return self._info
+
+    def get(self, key, default=None):
+        """
+        Single INFO value, without decoding the whole INFO column if that is not done yet
+        """
+        if self._info is not None:
+            return self._info.get(key, default)
+        value = info_value(self.info_field, key)
+        return default if value is None else value
+
+    @property
+    def ann(self):
+        """
+        Lazy view of the snpEff ANN entries, see SnpEffParser.Annotations
+        """
+        return self.ann_parser.annotations(self.get("ANN"))
+
+    @property
+    def end(self):
+        end = self.get("END")
+        return int(end) if end is not None else None
+
+    @property
+    def columns(self):
+        columns = [self.chrom, str(self.pos), self.id, self.ref, self.alt, self.qual, self.filter, self.info_field]
+        if self.rest:
+            columns.append(self.rest)
+        return columns
+
+    def __str__(self):
+        return "\t".join(self.columns)
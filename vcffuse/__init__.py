@@ -3,5 +3,3 @@ __email__ = 'szilva.juhos@gmail.com'
 __version__ = '0.1.0'
 
 __rest_server__ = "https://rest.ensembl.org"
-
-from intervaltree import Interval, IntervalTree
\ No newline at end of file
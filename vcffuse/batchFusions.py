@@ -0,0 +1,218 @@
+"""
+Fusion pictures for a whole cohort in one go: one worker pool and one warm annotation store for all the VCFs
+of a manifest, and each fusion found in several samples (same genes, SV kind and breakpoints) is made only once.
+
+    python -m vcffuse.batchFusions --manifest cohort.tsv --out cohort
+
+The pictures are in cohort/fusions/, cohort/<sample>.tsv tells which ones belong to a sample,
+and cohort/fusions.tsv lists the samples of each picture.
+"""
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+import click
+from vcffuse import AnnotationStore, BreakendPairer, EnsemblREST, FusionMemo, Metrics, RecordFilter, VCFReader
+from vcffuse.getFusionFromVCF import SnpEffParser, annotation_backends, configure_logging, fusion_ENS_IDs, \
+    fusion_jobs, fusion_key, init_worker, prefetch_CDS_coords, read_fusion_records, run_fusion_job
+
+logger = logging.getLogger("vcffuse")
+
+VCF_SUFFIXES = (".vcf.gz", ".vcf.bgz", ".vcf", ".gz")
+
+
+def sample_name(vcf):
+    name = os.path.basename(vcf)
+    for suffix in VCF_SUFFIXES:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def read_manifest(path):
+    """
+    A line is either "sample<TAB>VCF", or just a VCF named after the sample.
+    Empty lines and lines starting with # are skipped, relative VCF paths are relative to the manifest.
+    :return: list of (sample, VCF path)
+    """
+    samples = []
+    seen = set()
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path, 'r') as manifest:
+        for line in manifest:
+            line = line.strip()
+            if not line or line[0] == "#":
+                continue
+            columns = line.split("\t")
+            vcf = columns[-1] if columns[-1] == "-" else os.path.join(base, columns[-1])
+            sample = columns[0] if len(columns) > 1 else sample_name(vcf)
+            if sample in seen:
+                raise ValueError("Sample " + sample + " is in the manifest more than once")
+            seen.add(sample)
+            samples.append((sample, vcf))
+    return samples
+
+
+def unique_jobs(samples, references, bnd_window=None, record_filter=None):
+    """
+    Yields (fusion key, (record, mate ALT)) for the fusions not seen in an earlier sample or record.
+    :param references: fusion key -> list of (sample, record ID, SV kind), filled up as we go
+    :param record_filter: RecordFilter of a gene panel or None
+    """
+    for sample, vcf in samples:
+        records = 0
+        pairer = BreakendPairer.BreakendPairer(bnd_window)
+        with VCFReader.open_text(vcf) as vcf_file:
+            sample_records = Metrics.timed_iter(read_fusion_records(vcf_file, SnpEffParser()), "parse")
+            if record_filter is not None:
+                sample_records = record_filter.filter(sample_records)
+            for record, mate_alt in fusion_jobs(sample_records, pairer):
+                records += 1
+                key = fusion_key(record)
+                seen = key in references
+                references.setdefault(key, []).append((sample, record.id, record.kind))
+                if seen:
+                    Metrics.count("duplicate_fusions")
+                else:
+                    yield key, (record, mate_alt)
+        for record_ID in pairer.flush():
+            logger.warning("Unpaired breakend in %s: %s", sample, record_ID)
+        Metrics.count("unpaired_breakends", len(pairer.orphans))
+        Metrics.count("samples")
+        logger.info("%s: %d fusion records", sample, records)
+
+
+def collect_outputs(unique, results):
+    """
+    :return: fusion key -> (list of pictures, error or None)
+    """
+    outputs = {}
+    for (key, _), (record_ID, pictures, error, metrics, _) in zip(unique, results):
+        if metrics is not None:
+            Metrics.registry.merge_dict(metrics)
+        if error is not None:
+            logger.warning("Failed record: %s %s", record_ID, error)
+        outputs[key] = (pictures, error)
+    return outputs
+
+
+def write_sample_tables(out, samples, references, results):
+    """
+    <sample>.tsv for each sample: its records, with the (shared) pictures or the reason we could not make any,
+    and fusions.tsv with the samples of each picture
+    :param results: fusion key -> (list of pictures, error or None)
+    """
+    tables = {sample: [] for sample, _ in samples}
+    with open(os.path.join(out, "fusions.tsv"), 'w') as index:
+        index.write("#picture\tsamples\trecords\n")
+        for key, refs in references.items():
+            pictures, error = results[key]
+            pictures = [os.path.relpath(picture, out) for picture in pictures]
+            for sample, record_ID, kind in refs:
+                for picture in pictures or ["."]:
+                    tables[sample].append("\t".join((record_ID, kind, picture, error or ".")))
+            for picture in pictures:
+                index.write(picture + "\t" + ",".join(sorted(set(sample for sample, _, _ in refs))) + "\t" +
+                            ",".join(sample + ":" + record_ID for sample, record_ID, _ in refs) + "\n")
+    for sample, lines in tables.items():
+        with open(os.path.join(out, sample + ".tsv"), 'w') as table:
+            table.write("#record\tkind\tpicture\terror\n")
+            for line in lines:
+                table.write(line + "\n")
+
+
+def make_batch(manifest, out, rest, cache, prefetch, gtf, server, rest_workers, rest_rate, jobs, bnd_window,
+               svg_backend="svgwrite", log_level="INFO", memo=None, record_filter=None, index=None):
+    samples = read_manifest(manifest)
+    pictures = os.path.join(out, "fusions")
+    os.makedirs(pictures, exist_ok=True)
+    store = AnnotationStore.AnnotationStore(cache)
+    backends = annotation_backends(gtf, index)
+    client = EnsemblREST.EnsemblClient(server=server, rate=rest_rate, workers=rest_workers)
+    references = {}
+    unique = list(unique_jobs(samples, references, bnd_window, record_filter))
+    if record_filter is not None:
+        logger.info("%d records kept, %d dropped by the panel filter", record_filter.kept, record_filter.dropped)
+        Metrics.count("filtered_records", record_filter.dropped)
+    if prefetch and rest:
+        # the IDs of the whole cohort at once
+        ENS_IDs = []
+        for _, (record, _) in unique:
+            ENS_IDs.extend(fusion_ENS_IDs(record))
+        prefetch_CDS_coords(ENS_IDs, store, backends, client)
+    logger.info("%d samples, %d fusion records, %d unique fusions", len(samples),
+                sum(len(refs) for refs in references.values()), len(unique))
+    worker_settings = (rest, cache, backends, client.server, rest_rate / max(1, jobs), rest_workers, pictures,
+                       svg_backend, "shared", memo)
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                                 initargs=worker_settings + (log_level, False, True)) as pool:
+            outputs = collect_outputs(unique, pool.map(run_fusion_job, [job for _, job in unique], chunksize=4))
+    else:
+        init_worker(*worker_settings)
+        outputs = collect_outputs(unique, (run_fusion_job(job) for _, job in unique))
+    write_sample_tables(out, samples, references, outputs)
+    logger.info("Pictures are in %s, the tables of the samples in %s", pictures, out)
+
+
+@click.command(context_settings=dict(help_option_names=['-h', '--help']))
+@click.option('--manifest', '-m', type=str, required=True,
+              help='Tab separated sample and VCF on each line, or just the VCFs')
+@click.option('--out', '-o', type=str, required=True, help='Output directory')
+@click.option('--rest/--no-rest', '-r', type=bool, help='Read from ENSEMBL REST or JSON file', required=False,
+              default=True)
+@click.option('--cache', '-c', type=str, help='SQLite annotation store shared between runs',
+              required=False, default=AnnotationStore.default_store_path(), show_default=True)
+@click.option('--prefetch/--no-prefetch', type=bool,
+              help='Look up all ENSEMBL IDs of the cohort in batches before making the fusions',
+              required=False, default=False)
+@click.option('--gtf', '-g', type=str, help='Local ENSEMBL GTF or GFF3 (can be gzipped) to read exons from',
+              required=False, default=None)
+@click.option('--index', '-x', type=str, help='Annotation index made by "index build" to read exons from',
+              required=False, default=None)
+@click.option('--server', type=str, required=False, default=EnsemblREST.DEFAULT_SERVER, show_default=True,
+              envvar="VCFFUSE_ENSEMBL_SERVER", help='Base URL of the ENSEMBL REST server')
+@click.option('--rest-workers', type=int, help='Number of concurrent ENSEMBL REST requests',
+              required=False, default=4, show_default=True)
+@click.option('--rest-rate', type=float, help='Maximum ENSEMBL REST requests per second',
+              required=False, default=EnsemblREST.DEFAULT_RATE, show_default=True)
+@click.option('--jobs', '-j', type=int, help='Number of processes making the fusions',
+              required=False, default=1, show_default=True)
+@click.option('--bnd-window', type=int, required=False, default=None,
+              help='For coordinate-sorted VCFs: drop a breakend once the input is this far past its mate position')
+@click.option('--regions', type=str, required=False, default=None,
+              help='BED file of a panel: only records with a breakpoint (or mate) in these regions are processed')
+@click.option('--genes', type=str, required=False, default=None,
+              help='Only fusions of these genes: a file or a comma separated list of gene symbols and ENSEMBL IDs')
+@click.option('--svg-backend', type=click.Choice(["svgwrite", "stream"]), required=False, default="svgwrite",
+              show_default=True,
+              help='Build the pictures with svgwrite, or stream the same bytes directly to the files')
+@click.option('--memo', type=str, required=False, default=None,
+              help='Directory of the fusion memo shared between runs: fusions and pictures already made '
+                   'are not made again')
+@click.option('--memo-size', type=int, required=False, default=FusionMemo.DEFAULT_MAX_BYTES >> 20, show_default=True,
+              help='The memo directory is kept under this many megabytes')
+@click.option('--log-level', type=click.Choice(["DEBUG", "INFO", "WARNING", "ERROR"], case_sensitive=False),
+              required=False, default="INFO", show_default=True)
+@click.option('--metrics', type=str, required=False, default=None,
+              help='Write stage timings, counters and peak memory to PREFIX.json and PREFIX.prom (Prometheus textfile)')
+def batch(manifest, out, rest, cache, prefetch, gtf, index, server, rest_workers, rest_rate, jobs, bnd_window, regions,
+          genes, svg_backend, memo, memo_size, log_level, metrics):
+    configure_logging(log_level)
+    fusion_memo = FusionMemo.FusionMemo(memo, memo_size << 20,
+                                        annotation=FusionMemo.annotation_source(rest, server, gtf, index)) \
+        if memo else None
+    record_filter = RecordFilter.RecordFilter.from_options(regions, genes)
+    with Metrics.timer("run"):
+        make_batch(manifest, out, rest, cache, prefetch, gtf, server, rest_workers, rest_rate, jobs, bnd_window,
+                   svg_backend, log_level, fusion_memo, record_filter, index)
+    if fusion_memo is not None:
+        fusion_memo.evict()
+    Metrics.registry.measure_memory()
+    if metrics:
+        Metrics.registry.to_json(metrics + ".json")
+        Metrics.registry.to_prometheus(metrics + ".prom")
+        logger.info("Metrics are at %s.json and %s.prom", metrics, metrics)
+
+
+if __name__ == "__main__":
+    batch()
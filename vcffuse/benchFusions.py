@@ -0,0 +1,105 @@
+"""
+Quick benchmark without pytest-benchmark: a run on synthetic data with the stage timings,
+and the startup time of each subcommand of the vcffuse command.
+
+    python -m vcffuse.benchFusions --records 10000 --jobs 4
+    python -m vcffuse.benchFusions --startup --records 0
+"""
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import click
+from vcffuse import AnnotationIndex, AnnotationStore, Metrics, SyntheticData, getFusionFromVCF
+from vcffuse.vcffuse import STARTUP_BUDGET_MS, SUBCOMMANDS
+
+
+def command_time(args, rounds):
+    """
+    :return: median wall time of running the command, in milliseconds
+    """
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        subprocess.run(args, check=True, stdout=subprocess.DEVNULL)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def startup_times(rounds=5, subcommands=tuple(SUBCOMMANDS)):
+    """
+    :return: dict of subcommand -> milliseconds `vcffuse <subcommand> --help` takes over the bare interpreter
+    """
+    bare = command_time([sys.executable, "-c", "pass"], rounds)
+    return {name: command_time([sys.executable, "-m", "vcffuse.vcffuse", name, "--help"], rounds) - bare
+            for name in subcommands}
+
+
+def run_synthetic(directory, records, jobs=1, svg_backend="stream", annotation="index"):
+    """
+    Makes the fusions of a synthetic VCF with the gene models in a store (or in an index made of it)
+    :return: Metrics.registry.as_dict() of the run
+    """
+    data = SyntheticData.SyntheticData(records)
+    vcf = data.write_vcf(os.path.join(directory, "synthetic.vcf"))
+    cache = os.path.join(directory, "annotation.sqlite")
+    data.fill_store(AnnotationStore.AnnotationStore(cache)).close()
+    index = None
+    if annotation == "index":
+        index = os.path.join(directory, "annotation.vfi")
+        AnnotationIndex.build_index([AnnotationIndex.annotation_from_store(cache)], index)
+    Metrics.registry.reset()
+    cwd = os.getcwd()
+    # the pictures are written into the working directory
+    os.chdir(directory)
+    try:
+        with Metrics.timer("run"):
+            getFusionFromVCF.make_fusions(vcf, "bench.svg", False, cache, False, None, 1, 1.0, jobs, None, svg_backend,
+                                          index=index)
+    finally:
+        os.chdir(cwd)
+    Metrics.registry.measure_memory()
+    return Metrics.registry.as_dict()
+
+
+@click.command(context_settings=dict(help_option_names=['-h', '--help']))
+@click.option('--records', '-n', type=int, required=False, default=1000, show_default=True,
+              help='Number of synthetic SV records (0 skips the run)')
+@click.option('--jobs', '-j', type=int, required=False, default=1, show_default=True)
+@click.option('--svg-backend', type=click.Choice(["svgwrite", "stream"]), required=False, default="stream",
+              show_default=True)
+@click.option('--annotation', type=click.Choice(["index", "cache"]), required=False, default="index",
+              show_default=True, help='Read the gene models from an annotation index, or from the SQLite store')
+@click.option('--out', '-o', type=str, required=False, default=None,
+              help='Directory of the data and the pictures (a temporary one is removed afterwards)')
+@click.option('--startup/--no-startup', type=bool, required=False, default=False,
+              help='Measure the startup of each subcommand as well, it fails if one is over its budget')
+@click.option('--rounds', type=int, required=False, default=5, show_default=True,
+              help='Rounds of each startup measurement, the median is taken')
+def bench(records, jobs, svg_backend, annotation, out, startup, rounds):
+    logging.basicConfig(level="WARNING", format="%(message)s")
+    over_budget = []
+    if startup:
+        for name, ms in startup_times(rounds).items():
+            click.echo("startup %-10s %7.1f ms (budget %d ms)" % (name, ms, STARTUP_BUDGET_MS[name]))
+            if ms > STARTUP_BUDGET_MS[name]:
+                over_budget.append(name)
+    if records > 0:
+        with tempfile.TemporaryDirectory() as temporary:
+            directory = out or temporary
+            os.makedirs(directory, exist_ok=True)
+            metrics = run_synthetic(directory, records, jobs, svg_backend, annotation)
+        for stage, histogram in metrics["stages"].items():
+            click.echo("%-24s %6d calls %10.3f s (max %.4f s)" % (stage, histogram["count"], histogram["sum"],
+                                                                  histogram["max"]))
+        for event, n in metrics["counters"].items():
+            click.echo("%-24s %6d" % (event, n))
+    if over_budget:
+        raise click.ClickException("Over the startup budget: " + ", ".join(over_budget))
+
+
+if __name__ == "__main__":
+    bench()
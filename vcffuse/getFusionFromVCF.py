@@ -1,777 +1,910 @@
+import cProfile
+import functools
+import hashlib
 import json
-import requests, sys
-from intervaltree import Interval, IntervalTree
+import logging
+import os
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from intervaltree import IntervalTree
 import click
-import svgwrite
-from svgwrite import cm, mm, rgb
 import re
 
-import pdb
-
-server = "https://rest.ensembl.org"
-
-
-class SnpEffParser:
-    """
-        We are processing an snpEff annotation entry (not a VCF line, but the ANN= stuff)
-        and returning with a list of dictionaries
-    """
-
-    def __init__(self):
-        self._ann_list = list()  # list of annotations
-        self._ann_keys = list()
-
-    @property
-    def ann_keys(self):
-        return self._ann_keys
-
-    @property
-    def ann_list(self):
-        return self._ann_list
-
-    def add_ann_list(self, ann: dict):
-        self._ann_list.append(ann)
-
-    def add_ann_keys(self, ann_line: str):
-        """
-        Parsing the ##INFO=<ID=ANN line
-        """
-        entry_list = ann_line.split("'")[1]
-        entries = entry_list.split("|")
-        for item in entries:
-            self._ann_keys.append(item.strip())
+from vcffuse import AnnotationIndex, AnnotationStore, BreakendPairer, EnsemblREST, FusionMemo, FusionTable, Gallery, \
+    GTFAnnotation, Metrics, RecordFilter, RunManifest, ShardedVCF, SVGStream, VCFReader, VCFRecord
+from vcffuse.ExonCoords import ExonCoords
+from vcffuse.FusionMaker import FusionMaker
+from vcffuse.SnpEffParser import SnpEffParser
 
-    def parse_se_ann(self, line, regexp):
-        """
-        Annotation entries are delimited by commas, process each entry, and add to a list if contains gene_fusion
-        """
-        ann_dict = {}
-        entries = line.split("ANN=")[1]
-        entries = entries.split(",")
-        for tr_ann in entries:  # get the transcript items
-            if regexp.match(tr_ann):
-                # chop up values into a list
-                ann_list = tr_ann.split("|")
-                # add values into a dict
-                for i in range(0, len(self.ann_keys)):
-                    ann_dict[self.ann_keys[i]] = ann_list[i]
-                # add dict to collection (list)
-                self._ann_list.append(ann_dict)
-
-
-class ExonCoords:
-    def __init__(self, chromosome, strand, breakpoint, gene_name, exons: IntervalTree):
-        self.chromosome = chromosome
-        self.strand = strand
-        self.breakpoint = breakpoint
-        self.gene_name = gene_name
-        self.exons = IntervalTree(exons)
-
-    @classmethod
-    def fromTuple(cls, a_tuple):
-        return cls(a_tuple[0], a_tuple[1], a_tuple[2], a_tuple[3], a_tuple[4])
-
-    @classmethod
-    def copy_without_exons(cls, exc):
-        return cls(exc.chromosome, exc.strand, exc.breakpoint, exc.gene_name, IntervalTree())
-
-    @classmethod
-    def empty(cls):
-        return cls("", 0, -1, "", IntervalTree())
-
-    def print_properties(self):
-        print("#########################################")
-        print("coordinates :", self.chromosome + ":" + str(self.exons.begin()) + "-" + str(self.exons.end()))
-        print("gene        :", self.gene_name)
-        print("strand      :", self._strand)
-        print("breakpoint  :", self._breakpoint)
-        print("exons       :", self._exons)
-        print("#########################################")
-
-    def print_as_bed(self):
-        chromosome = self.chromosome
-        for ex in sorted(self.exons):
-            print(chromosome + "\t" + str(ex.begin) + "\t" + str(ex.end))
-
-    @property
-    def gene_name(self):
-        return self._gene_name
-
-    @gene_name.setter
-    def gene_name(self, value):
-        self._gene_name = value
-
-    @property
-    def chromosome(self):
-        return self._chromosome
-
-    @chromosome.setter
-    def chromosome(self, value):
-        self._chromosome = value
-
-    @property
-    def strand(self):
-        return self._strand
-
-    @strand.setter
-    def strand(self, value):
-        self._strand = value
-
-    @property
-    def breakpoint(self):  # int
-        return self._breakpoint
-
-    @breakpoint.setter
-    def breakpoint(self, value):
-        self._breakpoint = value
-
-    @property
-    def exons(self):  # IntervalTree()
-        return self._exons
-
-    @exons.setter
-    def exons(self, exons):
-        self._exons = exons
-
-    def begin(self):
-        return self.exons.begin()
-
-
-class SV_Maker:
-    """
-    Joins coordinates of exons for two genes
-    """
-    # directions from the breakpoint
-    DIR_LEFT = True
-    DIR_RIGHT = False
-
-    def __init__(self, p5, p3, start, end, chrom):
-        """
-        :param chrom: chromosome of the call (first col in the VCF)
-        """
-        self.prime5 = ExonCoords(p5.chromosome, p5.strand, 0, p5.gene_name, p5.exons)
-        self.prime3 = ExonCoords(p3.chromosome, p3.strand, 0, p3.gene_name, p3.exons)
-
-        # now assign breakpoints to genes:
-        # since using the Manta VCF line it is not yet clear
-        # which gene contain which endpoint, we have to assign
-        # them separately - only if they are meaningful values
-        if start is not None and end is not None and start > 0 and end > 0:
-            self.assign_breakpoint(start, chrom)
-            self.assign_breakpoint(end, chrom)
-
-    def assign_breakpoint(self, bp, chrom):
-        for gene in [self.prime5, self.prime3]:
-            gene_coords = gene.exons
-            gene_ends = IntervalTree()
-            gene_ends.add(Interval(gene_coords.begin(), gene_coords.end()))
-            if gene_ends.at(bp):
-                gene.breakpoint = bp
-                print("Breakpoint", bp, "assigned to", gene.gene_name)
-                break;
-            else:
-                print("Breakpoint", bp, "is outside gene", gene.gene_name)
-        # there can be a chance that the breakpoint is outside of both genes, assign it to the closest one
-        for gene in [self.prime5, self.prime3]:
-            if gene.breakpoint == 0 and gene.chromosome == chrom and (
-                    abs(gene.exons.begin() - bp) < 20000 or abs(gene.exons.end() - bp) < 20000):
-                gene.breakpoint = bp
-                print("Breakpoint", bp, "assigned to", gene.gene_name)
-
-    def assign_breakpoint_to_genes(self, bp: tuple):
-        chromosome = bp[0]
-        for gene in [self.prime5, self.prime3]:
-            if chromosome == gene.chromosome:
-                gene_extremes = IntervalTree()
-                gene_extremes.add(Interval(gene.exons.begin(), gene.exons.end()))
-                if gene_extremes.at(bp[1]):
-                    gene.breakpoint = bp[1]
-
-    def get_left_part(self, gene: ExonCoords):
-        # |-->---!->-->-->--|
-        # xxxxxxxx
-        # if the breakpoint is in an intron, we have to add a 1-base long interval at the breakpoint
-        breakpoint_in_exon = True if len(gene.exons.at(gene.breakpoint)) > 0 else False
-        if not breakpoint_in_exon:
-            print("**** intron breakpoint at -> ", gene.chromosome + ":" + str(gene.breakpoint - 1))
-            gene.exons.add(Interval(gene.breakpoint - 1, gene.breakpoint))
-        # when the breakpoint is in an exon, we have to shorten that one
-        # by chopping out the unneeded part
-        # TODO check it for tandem repeats as looks it was a bug
-        # it is still a bug actually
-        gene.exons.chop(gene.breakpoint, gene.exons.end())
-
-        return gene.exons
-
-    def get_right_part(self, gene: ExonCoords):
-        # |--<---!-<--<--<--|
-        #        xxxxxxxxxxxx
-        tr_exons = gene.exons
-        tr_exons = tr_exons.overlap(gene.breakpoint, gene.exons.end())
-        tr_exons.add(Interval(gene.breakpoint, gene.breakpoint + 1))
-        return tr_exons
-
-    def print_as_bed(self, chromosome, exs):
-        for e in sorted(exs):
-            print(chromosome + "\t" + str(e.begin) + "\t" + str(e.end))
-
-    def getFusedPart(self, gene: ExonCoords, direction) -> ExonCoords:
-        """
-        Breaks the gene coordinates at the breakpoint
-        and returs with the left or right truncated part
-        """
-        tr_exons = None
-        if direction == 5:
-            if gene.strand > 0:
-                tr_exons = self.get_left_part(gene)
-            else:
-                tr_exons = self.get_right_part(gene)
-        else:  # assuming prime 3 - the other way around
-            if gene.strand < 0:
-                tr_exons = self.get_right_part(gene)
-            else:
-                tr_exons = self.get_left_part(gene)
-        return ExonCoords(gene.chromosome, gene.strand, gene.breakpoint, gene.gene_name, tr_exons)
-
-    def fuse_deletion(self):
-        prime5part = None
-        prime3part = None
-        if self.prime5.strand < 0:
-            # |<-<-<-<-|     |<-<-<-<-|
-            #     |-------------|
-            # we need right part for 5' and left part for 3'
-            prime5part = ExonCoords(self.prime5.chromosome,
-                                    self.prime5.strand,
-                                    self.prime5.breakpoint,
-                                    self.prime5.gene_name,
-                                    self.get_right_part(self.prime5))
-            prime3part = ExonCoords(self.prime3.chromosome,
-                                    self.prime3.strand,
-                                    self.prime3.breakpoint,
-                                    self.prime3.gene_name,
-                                    self.get_left_part(self.prime3))
-        else:
-            # |->->->->|     |->->->->|
-            #     |-------------|
-            # we need left part for 5' and right part for 3'
-            prime5part = ExonCoords(self.prime5.chromosome,
-                                    self.prime5.strand,
-                                    self.prime5.breakpoint,
-                                    self.prime5.gene_name,
-                                    self.get_left_part(self.prime5))
-            prime3part = ExonCoords(self.prime3.chromosome,
-                                    self.prime3.strand,
-                                    self.prime3.breakpoint,
-                                    self.prime3.gene_name,
-                                    self.get_right_part(self.prime3))
-        prime5part.print_as_bed()
-        prime3part.print_as_bed()
-        # now move the 3' part to the 5' part
-        p5borders = (prime5part.exons.begin(), prime5part.exons.end())
-        p3borders = (prime3part.exons.begin(), prime3part.exons.end())
-        shift = 0
-        if prime5part.strand > 0:
-            shift = prime5part.breakpoint - prime3part.exons.begin() + 1
-        else:
-            shift = prime5part.exons.begin() - prime3part.exons.end()
-        # we have to shift 3' only
-        shifted3p = IntervalTree()
-        for iv in prime3part.exons:
-            shifted3p.add(Interval(iv.begin + shift, iv.end + shift))
-        shifted5p = prime5part.exons
-        # and now shift down the stuff to 0 for SVG
-        left_shift = (shifted5p | shifted3p).begin()
-        # TODO: DRY it out
-        based05p = IntervalTree()
-        for iv in shifted5p:
-            based05p.add(Interval(iv.begin - left_shift, iv.end - left_shift))
-        based03p = IntervalTree()
-        for iv in shifted3p:
-            based03p.add(Interval(iv.begin - left_shift, iv.end - left_shift))
-        return based05p, based03p
-
-    def fuse_tandem_genes(self):
-        # dealing with tandem repeats:
-        # first we have to get parts by strand
-        # - strand means we want to have the
-        #       right part from the breakpoint for 5'
-        #       left part from the breakpoint for 3'
-        #       join them by starting with the 5' part,
-        #       add the 3' part to its left
-        # + strand means we want to have the
-        #       left part from the breakpoint for 5'
-        #       right part from the breakpoint for 3'
-        #       join them by starting with the 5' part
-        #       add the 3' part to its right
-        prime5part = None
-        prime3part = None
-        if (self.prime5.strand < 0):
-            prime5part = ExonCoords(self.prime5.chromosome,
-                                    self.prime5.strand,
-                                    self.prime5.breakpoint,
-                                    self.prime5.gene_name,
-                                    self.get_right_part(self.prime5))
-            prime3part = ExonCoords(self.prime3.chromosome,
-                                    self.prime3.strand,
-                                    self.prime3.breakpoint,
-                                    self.prime3.gene_name,
-                                    self.get_left_part(self.prime3))
-        else:
-            prime5part = ExonCoords(self.prime5.chromosome,
-                                    self.prime5.strand,
-                                    self.prime5.breakpoint,
-                                    self.prime5.gene_name,
-                                    self.get_left_part(self.prime5))
-            prime3part = ExonCoords(self.prime3.chromosome,
-                                    self.prime3.strand,
-                                    self.prime3.breakpoint,
-                                    self.prime3.gene_name,
-                                    self.get_right_part(self.prime3))
-        prime5part.print_as_bed()
-        prime3part.print_as_bed()
-        # now move the 3' part to the 5' part
-        p5borders = (prime5part.exons.begin(), prime5part.exons.end())
-        p3borders = (prime3part.exons.begin(), prime3part.exons.end())
-        # |------5------|
-        #                   |------3------|
-        # |------5------|
-        #           |------3------|
-        #
-        #                   |------5------|
-        #           |------3------|
-        #                   |------5------|
-        # |------3------|
-        # shift = (5'start - 3'start)
-        # 3'start = 3'start + shift
-        shift = 0
-        if prime5part.strand > 0:
-            shift = prime5part.breakpoint - prime3part.exons.begin() + 1
-        else:
-            shift = prime5part.exons.begin() - prime3part.exons.end()
-        # we have to shift 3' only
-        shifted3p = IntervalTree()
-        for iv in prime3part.exons:
-            shifted3p.add(Interval(iv.begin + shift, iv.end + shift))
-        shifted5p = prime5part.exons
-        # and now shift down the stuff to 0 for SVG
-        left_shift = (shifted5p | shifted3p).begin()
-        # TODO: DRY it out
-        based05p = IntervalTree()
-        for iv in shifted5p:
-            based05p.add(Interval(iv.begin - left_shift, iv.end - left_shift))
-        based03p = IntervalTree()
-        for iv in shifted3p:
-            based03p.add(Interval(iv.begin - left_shift, iv.end - left_shift))
-        return based05p, based03p
-
-    def fuse_inversion(self):
-        based05p = None
-        based03p = None
-        if self.prime5.strand > 0:  # forward 5'
-            print("Forward 5' inversion")
-            prime5part = ExonCoords(self.prime5.chromosome, self.prime5.strand,
-                                    self.prime5.breakpoint, self.prime5.gene_name,
-                                    self.get_left_part(self.prime5))
-            prime3part = ExonCoords(self.prime3.chromosome, self.prime3.strand,
-                                    self.prime3.breakpoint, self.prime3.gene_name,
-                                    self.get_left_part(self.prime3))
-            # we have to turn around the 3' part
-            # -->  <--
-            prime3part = self.turn_backwards(prime3part)
-            # -->  -->
-        else:
-            print("Reverse 5' inversion")
-            prime5part = ExonCoords(self.prime5.chromosome, self.prime5.strand,
-                                    self.prime5.breakpoint, self.prime5.gene_name,
-                                    self.get_right_part(self.prime5))
-            prime3part = ExonCoords(self.prime3.chromosome, self.prime3.strand,
-                                    self.prime3.breakpoint, self.prime3.gene_name,
-                                    self.get_right_part(self.prime3))
-            # now the inversion is like
-            # <--  -->
-            prime5part = self.turn_backwards(prime5part)
-            # -->  -->
-        based05p = self.shift_left_to(0, prime5part)
-        based03p = self.shift_left_to(based05p.end(), prime3part)
-        print(based05p)
-        print(based03p)
-        return based05p, based03p
-
-    def fuse_translocations(self, p5dir, p3dir):
-        prime5part = None
-        prime3part = None
-        # TODO: DRY it out
-        if p5dir == self.DIR_LEFT:
-            prime5part = ExonCoords(self.prime5.chromosome, self.prime5.strand,
-                                    self.prime5.breakpoint, self.prime5.gene_name,
-                                    self.get_left_part(self.prime5))
-        else: # DIR_RIGHT
-            prime5part = ExonCoords(self.prime5.chromosome, self.prime5.strand,
-                                    self.prime5.breakpoint, self.prime5.gene_name,
-                                    self.get_right_part(self.prime5))
-        if p3dir == self.DIR_LEFT:
-            prime3part = ExonCoords(self.prime3.chromosome, self.prime3.strand,
-                                    self.prime3.breakpoint, self.prime3.gene_name,
-                                    self.get_left_part(self.prime3))
-        else: # DIR_RIGHT
-            prime3part = ExonCoords(self.prime3.chromosome, self.prime3.strand,
-                                    self.prime3.breakpoint, self.prime3.gene_name,
-                                    self.get_right_part(self.prime3))
-
-        # TODO: DRY it out
-        if p5dir == self.DIR_LEFT and p3dir == self.DIR_LEFT:
-            # forward antiparallel or reverse parallel
-            # we have to turn the reverse strand 3' gene backwards
-            prime3part = self.turn_backwards(prime3part)
-            # and have to stick it to the 5' part
-            # we are ignoring chromosomes this time
-        elif p5dir == self.DIR_RIGHT and p3dir == self.DIR_LEFT:
-            prime5part = self.turn_backwards(prime5part)
-
-        based05p = self.shift_left_to(0, prime5part)
-        based03p = self.shift_left_to(based05p.end(), prime3part)
-        print(based05p)
-        print(based03p)
-
-        return (based05p, based03p)
-            
-
-    def shift_left_to(self, new_base: int, exs: ExonCoords):
-        rebased = IntervalTree()
-        shift = exs.exons.begin() - new_base
-        for item in exs.exons:
-            rebased.add(Interval(item.begin - shift, item.end - shift))
-        return rebased
-
-    def turn_backwards(self, exs: ExonCoords):
-        """
-        We have coords like:
-        |###|----|####|--|#|
-        and want to have something like:
-        |#|--|####|----|###|
-        :param exs:
-        ExonCoords that we want to turn backwards
-        :return:
-        new IntervalTree() with backwards coordinates
-        """
-        gene_start = exs.exons.begin()
-        gene_end = exs.exons.end()
-        new_exons = IntervalTree()
-        for item in sorted(exs.exons):
-            new_end = gene_end - (item.begin - gene_start)
-            new_start = gene_end + gene_start - item.end
-            # print(exs.chromosome + "\t" + str(new_start) + "\t" + str(new_end) + "\t"+ exs.gene_name)
-            new_exons.add(Interval(new_start, new_end))
-        return ExonCoords(exs.chromosome, exs.strand, exs.breakpoint, exs.gene_name, new_exons)
-
-    def print_properties(self):
-        print("5' gene:")
-        print("strand     :", self.prime5.strand)
-        print("breakpoint :", self.prime5.chromosome + ":" + str(self.prime5.breakpoint))
-        exons = self.prime5.exons
-        start = exons.begin()
-        end = exons.end()
-        print("gene coords:", self.prime5.chromosome + ":" + str(start) + "-" + str(end))
-        print("3' gene:")
-        print("strand     :", self.prime3.strand)
-        print("breakpoint :", self.prime3.chromosome + ":" + str(self.prime3.breakpoint))
-        exons = self.prime3.exons
-        start = exons.begin()
-        end = exons.end()
-        print("gene coords:", self.prime3.chromosome + ":" + str(start) + "-" + str(end))
-        self.prime5.print_as_bed()
-        self.prime3.print_as_bed()
-
-
-def reverse_fusion(iv_tuple):
-    """
-    Now we have a fusion, but depicted as from 3'-5', so we want to rotate the whole picture with 180 degrees
-    :param iv_tuple: tuple with 0 shifted 5' and 3' choords
-    :return: two interval trees as 5' and 3' still, but rotated with 180 degrees
-    """
-    # we are assuming they are right to left
-    start = iv_tuple[1].begin()
-    end = iv_tuple[0].end()
-    length = end - start
-    p5 = IntervalTree()
-    for exon in iv_tuple[0]:
-        e_start = end - (exon.end - start)
-        e_end = end - (exon.begin - start)
-        p5.add(Interval(e_start, e_end))
-    p3 = IntervalTree()
-    for exon in iv_tuple[1]:
-        e_start = end - (exon.end - start)
-        e_end = end - (exon.begin - start)
-        p3.add(Interval(e_start, e_end))
-
-    return p5, p3
-
-
-def get_CDS_coords(ENS_ID, rest):
+logger = logging.getLogger("vcffuse")
+
+
+@Metrics.timed("lookup")
+def get_CDS_coords(ENS_ID, rest, store=None, backends=(), client=None):
     # look docs at https://rest.ensembl.org/
     obj = None
-    print("Looking up " + ENS_ID)
+    logger.debug("Looking up %s", ENS_ID)
+    Metrics.count("lookups")
+    # local annotation (like a GTF) comes first, these are all in memory
+    for backend in backends:
+        coords = backend.lookup(ENS_ID)
+        if coords is not None:
+            Metrics.count("lookup_backend_hits")
+            return coords
+    if store is not None:
+        # raises AnnotationNotFound for IDs that are already known to be missing
+        try:
+            coords = store.get(ENS_ID)
+        except AnnotationStore.AnnotationNotFound:
+            Metrics.count("lookup_cache_hits")
+            raise
+        if coords is not None:
+            Metrics.count("lookup_cache_hits")
+            return coords
+        Metrics.count("lookup_cache_misses")
     if rest:
-        ext = "/lookup/id/" + ENS_ID + "?expand=1"
-        r = requests.get(server + ext, headers={"Content-Type": "application/json"})
-        if not r.ok:
-            r.raise_for_status()
-            sys.exit()
-        obj = r.json()
-        json_file = open(ENS_ID + '.json', 'w')
-        json_file.write(r.content.decode('utf-8'))
-        json_file.close()
+        Metrics.count("lookup_rest_requests")
+        if client is None:
+            client = EnsemblREST.default_client()
+        # raises EnsemblLookupError if ENSEMBL does not answer even after retrying
+        obj = client.lookup(ENS_ID)
+        if obj is None:
+            if store is not None:
+                store.put_missing(ENS_ID)
+            raise AnnotationStore.AnnotationNotFound(ENS_ID)
+        if store is None:
+            with open(ENS_ID + '.json', 'w') as json_file:
+                json_file.write(json.dumps(obj))
     else:  # we are reading from file
         with open(ENS_ID + '.json', 'r') as myfile:
             data = myfile.read()
         obj = json.loads(data)
 
-    chromosome = "chr" + str(obj['seq_region_name'])
-    exon_intervals = read_from_json(obj)
-    # print("exons from ENSEMBL JSON:")
-    # print_exons_as_bed(chromosome, IntervalTree(sorted(exon_intervals.items())), obj['display_name'])
-    return (chromosome, obj['strand'], 0, obj['display_name'], IntervalTree(sorted(exon_intervals.items())))
-
-
-def read_from_json(obj):
-    intree = IntervalTree()
-    chromosome = "chr" + str(obj['seq_region_name'])
-    # if we have a whole gene with many transcripts,
-    # find the canonical one:
-    if 'Transcript' in obj.keys():
-        transcripts = obj['Transcript']
-        for trs in obj['Transcript']:
-            # go only for the canonical one
-            if trs['is_canonical'] > 0:
-                print("Using canonical transcript", trs['id'], "/", trs['display_name'])
-                for exon in trs['Exon']:
-                    intree.add(Interval(exon['start'], exon['end']))
+    coords = AnnotationStore.coords_from_json(obj)
+    if store is not None:
+        store.put(ENS_ID, coords)
+    return coords
+
+
+def fusion_ENS_IDs(record: VCFRecord.VCFRecord):
+    """
+    Digs out the ENSEMBL IDs from a PASS gene_fusion VCF record the same way the process_* functions do,
+    so we can look them up in advance
+    """
+    ENS_IDs = []
+    if record.kind == VCFRecord.TANDEM:
+        fusion = record.ann.first_fusion()
+        if fusion is not None:
+            ENS_IDs = fusion["Gene_ID"].split("&")
+    elif record.kind == VCFRecord.TRANSLOCATION:
+        fusion = record.ann.first_fusion()
+        try:
+            ENS_IDs = get_transcript_IDs(fusion["HGVS.p"]) if fusion is not None else []
+        except IndexError:
+            logger.warning("No transcript IDs for %s", record.id)
     else:
-        # it is a single transcript only
-        print("Using transcript", obj['id'], "/", obj['display_name'])
-        for exon in obj['Exon']:
-            intree.add(Interval(exon['start'], exon['end']))
+        for fusion in record.ann.fusions():
+            ENS_IDs.extend(fusion["Gene_ID"].split("&"))
+    return ENS_IDs
 
-    intree.merge_overlaps()
-    return intree
+
+def first_fusion(record: VCFRecord.VCFRecord):
+    """
+    Tandem duplications and translocations are made of the first gene_fusion entry of the ANN field
+    :return: SnpEffParser.AnnEntry or None
+    """
+    fusion = record.ann.first_fusion()
+    if fusion is None:
+        logger.warning("No gene_fusion annotation for %s", record.id)
+    return fusion
+
+
+@Metrics.timed("prefetch")
+def prefetch_CDS_coords(ENS_IDs, store, backends=(), client=None):
+    """
+    Resolves all the IDs that are not in the annotation store (or in a local backend) yet
+    with batched POST requests
+    """
+    ENS_IDs = sorted(ENS_ID for ENS_ID in set(ENS_IDs)
+                     if not any(ENS_ID in backend for backend in backends))
+    # keep all of them in memory for the fusion stage
+    store.lru_size = max(store.lru_size, len(ENS_IDs))
+    to_lookup = [ENS_ID for ENS_ID in ENS_IDs if ENS_ID not in store]
+    logger.info("Prefetching %d of %d ENSEMBL IDs", len(to_lookup), len(ENS_IDs))
+    Metrics.count("prefetched_IDs", len(to_lookup))
+    if client is None:
+        client = EnsemblREST.default_client()
+    found, failed = client.lookup_batch(to_lookup)
+    if failed:
+        # give the IDs of the failed chunks another go one by one
+        logger.warning("Batch lookup failed for %d IDs, retrying them one by one", len(failed))
+        found_again, failed = client.lookup_many(list(failed.keys()))
+        found.update(found_again)
+    for ENS_ID, reason in failed.items():
+        logger.warning("Could not prefetch %s %s", ENS_ID, reason)
+    for ENS_ID, obj in found.items():
+        if obj is None:
+            store.put_missing(ENS_ID)
+        else:
+            store.put(ENS_ID, AnnotationStore.coords_from_json(obj))
 
 
 def print_exons_as_bed(chrom, exons, gene_name):
     for item in exons:
-        print(chrom + "\t" + str(item.begin) + "\t" + str(item.end) + "\t" + gene_name)
+        logger.debug("%s\t%s\t%s\t%s", chrom, item.begin, item.end, gene_name)
+
+
+def genes_for_IDs(ENS_IDs, lookup):
+    return [ExonCoords.fromTuple(lookup(ENS_IDs[0])), ExonCoords.fromTuple(lookup(ENS_IDs[1]))]
+
+
+@Metrics.timed("render")
+def makeSVG(fex, outfile, backend="svgwrite"):
+    """
+    :param backend: "svgwrite" builds and validates an svgwrite DOM,
+    "stream" writes the same bytes straight to the file, see SVGStream
+    """
+    # the old file could be a hard link to a picture of the fusion memo, writing into it would change that too
+    if os.path.lexists(outfile):
+        os.remove(outfile)
+    if backend == "stream":
+        SVGStream.save_fusion_svg(fex, outfile)
+        logger.info("Fusion picture is at %s", outfile)
+        return outfile
+    # svgwrite takes longer to import than most runs of a single fusion, only this backend needs it
+    import svgwrite
+    from svgwrite import mm
+    w, h = '100%', '100%'
+    dwg = svgwrite.Drawing(filename=outfile, size=(w, h), debug=True)
+    # background
+    dwg.add(dwg.rect(insert=(0, 0), size=(w, h), fill='white', stroke='white'))
+    # exons
+    shapes = dwg.add(dwg.g(id='shapes', fill='red'))
+    # 5' part of exons
+    shapes = shape_intervals(dwg, shapes, fex[0], 'blue')
+    # 3' part of exons
+    shapes = shape_intervals(dwg, shapes, fex[1], 'red')
+    # introns
+    shapes.add(dwg.rect(insert=(fex[0].begin() / 100 * mm, 8 * mm),
+                        size=(int(abs(fex[0].begin() - fex[0].end())) / 100 * mm, 2 * mm), fill='blue'))
+    shapes.add(dwg.rect(insert=(fex[1].begin() / 100 * mm, 8 * mm),
+                        size=(int(abs(fex[1].end() - fex[1].begin())) / 100 * mm, 2 * mm), fill='red'))
+    dwg.save()
+    logger.info("Fusion picture is at %s", outfile)
+    return outfile
+
+
+def save_picture(fex, record: VCFRecord.VCFRecord, prime5name, prime3name, svg, backend="svgwrite"):
+    """
+    Renderer writing each fusion picture into its own SVG file
+    :return: the file name
+    """
+    return draw_picture(fex, fusion_file_name(record.id, prime5name, prime3name, svg), backend)
+
+
+def save_shared_picture(fex, record: VCFRecord.VCFRecord, prime5name, prime3name, directory, backend="svgwrite"):
+    """
+    Renderer for batches: the picture is named after the fusion, not after the record,
+    so the same fusion of several samples is one file
+    :return: the file name
+    """
+    return draw_picture(fex, os.path.join(directory, shared_file_name(record, prime5name, prime3name)), backend)
+
+
+def draw_picture(fex, outfile, backend="svgwrite"):
+    """
+    makeSVG(), unless the fusion memo of the worker already has the very same picture
+    """
+    memo = _worker.get("memo")
+    if memo is None:
+        return makeSVG(fex, outfile, backend)
+    picture = FusionMemo.picture_digest(fex)
+    if memo.link_picture(picture, outfile):
+        logger.info("Fusion picture is at %s", outfile)
+        return outfile
+    makeSVG(fex, outfile, backend)
+    memo.add_picture(picture, outfile)
+    return outfile
+
+
+@Metrics.timed("render")
+def gallery_panel(fex, record: VCFRecord.VCFRecord, prime5name, prime3name, svg):
+    """
+    Renderer for the gallery: the picture goes back to the main process, that writes the single document
+    :return: Gallery.Panel
+    """
+    return Gallery.make_panel(fex, fusion_file_name(record.id, prime5name, prime3name, svg), record.id, record.kind,
+                              prime5name, prime3name)
 
 
-# we are storing pairs of translocations in this dictionary. It is like when we are searching for
-# the breakpoint for MantaBND:75600:3:7:0:0:0:1      A       A]CHR6:108561001], it should be
-# {"MantaBND:75600:3:7:0:0:0:0":"G]CHR11:65662561]"}
-BND_dict = {}
+def no_picture(fex, record: VCFRecord.VCFRecord, prime5name, prime3name):
+    """
+    Renderer for --no-svg: only the BEDPE / JSON Lines rows are made
+    """
+    return None
+
+
+def shape_intervals(dwg, shapes, itv: ExonCoords, color):
+    from svgwrite import cm, mm
+    height = 2 * cm
+    for iv in sorted(itv):
+        if abs(iv.end - iv.begin) > 1:
+            s = iv.begin / 100
+            width = int(abs(iv.end - iv.begin + 100) / 100)
+            # print("SVG:", s*mm, 0, width*mm, height)
+            shapes.add(dwg.rect(insert=(s * mm, 0), size=(width * mm, height),
+                                fill=color, stroke=color, stroke_width=1))
+    return shapes
+
+
+def process_tandem(record: VCFRecord.VCFRecord, lookup, render, mate_alt=None):
+    outputs = []
+    logger.info("######################## processing tandem duplication ####################### %s", record.id)
+    # column 2 is the SV starting point in the call - just we do not know yet the name of the gene
+    start = record.pos
+    end = record.end
+    fusion_ann = first_fusion(record)
+    if fusion_ann is None:
+        return outputs
+    ENS_IDs = fusion_ann["Gene_ID"].split("&")
+
+    # for forward strand pairs the 5' end is the gene with higher coordinates
+    # for reverse strand pairs it is the gene with lower coordinates
+    # for tandem duplication fusions the strands should be the same
+    genes_to_join = genes_for_IDs(ENS_IDs, lookup)
+    # forward strand cases
+    if genes_to_join[0].strand > 0 and genes_to_join[1].strand > 0:
+        if genes_to_join[0].begin() < genes_to_join[1].begin():  # we have to swap them as the first is the 3'
+            genes_to_join = [genes_to_join[1], genes_to_join[0]]
+    else:  # negative strand
+        if genes_to_join[0].begin() > genes_to_join[1].begin():  # note the relation sign >
+            genes_to_join = [genes_to_join[1], genes_to_join[0]]
+
+    # now we should have the 5' as the first in the list
+    prime_5 = genes_to_join[0]
+    prime_3 = genes_to_join[1]
+    fusion = FusionMaker(prime_5, prime_3, start, end, record.chrom)
+    # have to reverse for reverse genes
+    (p5, p3) = fusion.fuse_tandem_genes(reverse=True)
+    outputs.append(render((p5, p3), record, genes_to_join[0].gene_name, genes_to_join[1].gene_name))
+    return outputs
+
+
+def process_translocation(record: VCFRecord.VCFRecord, lookup, render, mate_alt=None):
+    """
+    Makes the fusion for a translocation whose mate is already seen, see BreakendPairer
+    :param mate_alt: ALT column of the mate breakend
+    """
+    outputs = []
+    logger.info("----------------- processing translocation ---------------------- %s %s %s",
+                record.chrom, record.pos, record.id)
+    mate_ID = record.get("MATEID")
+    # instead of gene IDs we should go for transcript IDs
+    # that are a bit more complicated to get
+    fusion_ann = first_fusion(record)
+    if fusion_ann is None:
+        return outputs
+    try:
+        ENS_IDs = get_transcript_IDs(fusion_ann["HGVS.p"])
+    except IndexError:
+        logger.warning("No transcript IDs for %s", record.id)
+        return outputs
+    genes_to_join = genes_for_IDs(ENS_IDs, lookup)
+    # we can have meaningful fusions only for cases like (B is for 'base')
+    # a) genes are parallel (FF or RR), and the chromosome join is B[mate[ - ]mate]B
+    # b) genes are FR, join is B]mate] - B]mate]
+    # c) genes are RF, join is [mate[B - [mate[B
+    # see VCF documentation "5.4 Specifying complex rearrangements with breakends"
+    if genes_to_join[0].strand == genes_to_join[1].strand:
+        # like case ALK&DUSP3|ENSG00000171094&ENSG00000108861
+        # chr2    29256656        MantaBND:1:9840:9841:0:0:0:1    G       G[CHR17:43768837[
+        # chr17   43768837        MantaBND:1:9840:9841:0:0:0:0    T       ]CHR2:29256656]T
+        # bnd_U and bnd_V in VCF example
+        logger.debug("Parallel strand mates %s %s with mate ID %s %s", record.id, record.alt, mate_ID, mate_alt)
+        # we have to process reverse-reverse and forward-forward cases separate
+        if genes_to_join[0].strand > 0:
+            logger.debug("Forward-forward genes")
+        else:
+            logger.debug("Reverse-reverse genes with a ]mate]B - B[mate[ fusion")
+            # we have to have the right of the starting reverse gene (DUSP3 in case)
+            # and the left of the second reverse
+            (prime_5, prime_3) = (genes_to_join[0], genes_to_join[1])
+            fusion = FusionMaker(prime_5, prime_3, None, None, record.chrom)
+            fusion.assign_breakpoint_to_genes((record.chrom, record.pos))
+            # this is for the mate
+            breakpoint = extract_breakpoint(record.alt)
+            fusion.assign_breakpoint_to_genes(breakpoint)
+            svg_coords = fusion.fuse_translocations(fusion.DIR_RIGHT, fusion.DIR_LEFT)
+            outputs.append(render(svg_coords, record, genes_to_join[0].gene_name, genes_to_join[1].gene_name))
+            fusion.print_properties()
+    else:
+        # find out whether it is B]mate]-B]mate] or [mate[B-[mate[B
+        rev_mate_re = re.compile(".*]CHR.*:[0-9].*]")
+        # for B]mate]-B]mate] we want left for both
+        if rev_mate_re.match(record.alt):
+            logger.debug("forward antiparallel strand mates %s %s with mate ID %s %s", record.id, record.alt,
+                         mate_ID, mate_alt)
+            # the 5' will be the forward gene
+            if genes_to_join[0].strand > 0:
+                (prime_5, prime_3) = (genes_to_join[0], genes_to_join[1])
+            else:
+                (prime_5, prime_3) = (genes_to_join[1], genes_to_join[0])
+            fusion = FusionMaker(prime_5, prime_3, None, None, record.chrom)
+            # have to find out how the breakpoints are assigned
+            # this is for the one in the VCF line
+            fusion.assign_breakpoint_to_genes((record.chrom, record.pos))
+            # this is for the mate
+            breakpoint = extract_breakpoint(record.alt)
+            fusion.assign_breakpoint_to_genes(breakpoint)
+            svg_coords = fusion.fuse_translocations(fusion.DIR_LEFT, fusion.DIR_LEFT)
+            outputs.append(render(svg_coords, record, genes_to_join[0].gene_name, genes_to_join[1].gene_name))
+            fusion.print_properties()
+        else:
+            # for [mate[B-[mate[B we want right for both
+            logger.debug("reverse antiparallel strand mates %s %s with mate ID %s %s", record.id, record.alt,
+                         mate_ID, mate_alt)
+    return outputs
+
+
+def process_inversion(record: VCFRecord.VCFRecord, lookup, render, mate_alt=None):
+    outputs = []
+    logger.info("######################## processing INVERSION ####################### %s", record.id)
+    start = record.pos
+    end = record.end
+    # for inversions we do not have a given transcript
+    # (why? and why do we have for translocations? would be nice to understand)
+    # we can have more than one gene_fusion in the annotation list
+    for fusion_ann in record.ann.fusions():
+        ENS_IDs = fusion_ann["Gene_ID"].split("&")
+        genes_to_join = genes_for_IDs(ENS_IDs, lookup)
+        # we can have two 5' fusions, so we have to print out both
+        # find_5prime_for_inversion will return with a list that contains two tuples.
+        for fusion_tuples in [genes_to_join, [genes_to_join[1], genes_to_join[0]]]:
+            (prime_5, prime_3) = fusion_tuples
+            fusion = FusionMaker(prime_5, prime_3, start, end, record.chrom)
+            # fusions at inversions can be either
+            # <--  --> or -->  <--
+            svg_coords = fusion.fuse_inversion()
+            outputs.append(render(svg_coords, record, prime_5.gene_name, prime_3.gene_name))
+            fusion.print_properties()
+    return outputs
+
+
+def process_deletion(record: VCFRecord.VCFRecord, lookup, render, mate_alt=None):
+    outputs = []
+    logger.info("######################## processing DELETION ####################### %s", record.id)
+    start = record.pos
+    end = record.end
+    for fusion_ann in record.ann.fusions():
+        ENS_IDs = fusion_ann["Gene_ID"].split("&")
+        genes_to_join = genes_for_IDs(ENS_IDs, lookup)
+        # forward strands
+        if genes_to_join[0].strand > 0 and genes_to_join[1].strand > 0:
+            # order them by coordinates
+            if genes_to_join[0].begin() > genes_to_join[1].begin():
+                genes_to_join = [genes_to_join[1], genes_to_join[0]]
+        else:  # negative strand
+            if genes_to_join[0].begin() < genes_to_join[1].begin():  # note the relation sign <
+                genes_to_join = [genes_to_join[1], genes_to_join[0]]
+        fusion = FusionMaker(genes_to_join[0], genes_to_join[1], start, end, record.chrom)
+        # have to reverse for reverse genes
+        (p5, p3) = fusion.fuse_deletion(reverse=True)
+        outputs.append(render((p5, p3), record, genes_to_join[0].gene_name, genes_to_join[1].gene_name))
+        fusion.print_properties()
+    return outputs
+
+
+# what to do with each kind of SV
+SV_handlers = {VCFRecord.TANDEM: process_tandem,
+               VCFRecord.TRANSLOCATION: process_translocation,
+               VCFRecord.INVERSION: process_inversion,
+               VCFRecord.DELETION: process_deletion}
+
+
+def fusion_jobs(records, pairer: BreakendPairer.BreakendPairer):
+    """
+    Yields (record, mate ALT) pairs that can be processed independently of each other.
+    Translocations are yielded only when both breakends are seen.
+    """
+    for record in records:
+        mate_alt = None
+        if record.kind == VCFRecord.TRANSLOCATION:
+            pair = pairer.add(record)
+            if pair is None:
+                continue
+            (record, mate) = pair
+            mate_alt = mate.alt
+        yield record, mate_alt
+
+
+# annotation lookup and settings of the worker (or of the single process if we are not running in parallel)
+_worker = {}
+
+
+def init_worker(rest, cache, backends, server, rest_rate, rest_workers, svg, svg_backend="svgwrite",
+                output_mode="files", memo=None, log_level=None, trace_memory=False, remote=False, rows=False,
+                manifest=None):
+    """
+    Sets up each worker process with its own annotation store connection and REST client.
+    The backends (like a GTF) are built only once, in the parent process.
+    :param output_mode: "files", "gallery", "shared" (svg is the directory) or "none"
+    :param memo: FusionMemo or None
+    :param remote: True in the pool processes, these are sending their metrics back with each result
+    :param rows: True if the results should carry the BEDPE / JSON Lines rows of the fusions
+    :param manifest: RunManifest or None, records done in an earlier run are taken from it
+    """
+    if log_level is not None:
+        configure_logging(log_level)
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _worker["remote"] = remote
+    _worker["memo"] = memo
+    _worker["manifest"] = manifest
+    _worker["rows"] = rows
+    _worker["gallery"] = Gallery.gallery_file_name(svg) if output_mode == "gallery" else None
+    if remote:
+        Metrics.registry.reset()
+    store = AnnotationStore.AnnotationStore(cache)
+    client = EnsemblREST.EnsemblClient(server=server, rate=rest_rate, workers=rest_workers)
+    _worker["lookup"] = functools.partial(get_CDS_coords, rest=rest, store=store, backends=backends, client=client)
+    _worker["prefetch"] = functools.partial(prefetch_CDS_coords, store=store, backends=backends, client=client)
+    if output_mode == "gallery":
+        _worker["render"] = functools.partial(gallery_panel, svg=svg)
+    elif output_mode == "shared":
+        # svg is the directory of the pictures
+        _worker["render"] = functools.partial(save_shared_picture, directory=svg, backend=svg_backend)
+    elif output_mode == "none":
+        _worker["render"] = no_picture
+    else:
+        _worker["render"] = functools.partial(save_picture, svg=svg, backend=svg_backend)
+
+
+def run_fusion_job(job):
+    """
+    :param job: (record, mate ALT) from fusion_jobs()
+    :return: (record ID, list of pictures, error message or None, metrics of a pool process or None,
+    list of FusionTable rows or None)
+    """
+    record, mate_alt = job
+    manifest = _worker.get("manifest")
+    if manifest is not None:
+        content_hash = RunManifest.record_digest(record, mate_alt)
+        resumed = resumed_result(manifest, record, content_hash)
+        if resumed is not None:
+            return resumed
+    outputs = []
+    error = None
+    rows = [] if _worker.get("rows") else None
+    lookup, render = _worker["lookup"], _worker["render"]
+    if rows is not None:
+        genes, fusions = {}, []
+        lookup, render = recording_lookup(lookup, genes), recording_render(render, fusions)
+    Metrics.count("records")
+    with Metrics.timer("record"):
+        # a failed lookup should cost us this record only, not the whole run
+        try:
+            if _worker.get("memo") is None:
+                outputs = SV_handlers[record.kind](record, lookup, render, mate_alt)
+            else:
+                outputs = memoized_fusions(_worker["memo"], record, lookup, render, mate_alt)
+            if rows is not None:
+                rows = fusion_rows(record, fusions, genes, lookup)
+        except (AnnotationStore.AnnotationNotFound, EnsemblREST.EnsemblLookupError) as e:
+            logger.warning("Skipping %s - could not look up %s", record.id, e)
+            Metrics.count("failed_records")
+            error = str(e)
+            rows = [] if rows is not None else None
+        except (IndexError, KeyError, ValueError) as e:
+            # like a Gene_ID without the & between the two genes
+            logger.warning("Skipping %s - malformed annotation: %s %s", record.id, type(e).__name__, e)
+            Metrics.count("failed_records")
+            error = "malformed annotation: " + type(e).__name__ + " " + str(e)
+            rows = [] if rows is not None else None
+    # no pictures with --no-svg
+    outputs = [output for output in outputs if output is not None]
+    Metrics.count("pictures", len(outputs))
+    if manifest is not None:
+        manifest.put(record.id, content_hash, RunManifest.DONE if error is None else RunManifest.FAILED, outputs,
+                     rows, error)
+    metrics = Metrics.registry.take() if _worker.get("remote") else None
+    return record.id, outputs, error, metrics, rows
+
+
+def resumed_result(manifest: RunManifest.RunManifest, record: VCFRecord.VCFRecord, content_hash):
+    """
+    :return: the run_fusion_job() result of an earlier run, if the record is the same, it was done,
+    and its pictures (and rows, if we want them) are still there; None otherwise
+    """
+    entry = manifest.get(record.id)
+    if entry is None:
+        return None
+    stored_hash, status, outputs, rows, _ = entry
+    if stored_hash != content_hash or status != RunManifest.DONE or (_worker.get("rows") and rows is None):
+        return None
+    if _worker.get("gallery") is not None:
+        outputs = [Gallery.Panel(*panel) for panel in outputs]
+    elif not all(os.path.exists(output) for output in outputs):
+        return None
+    Metrics.count("resumed_records")
+    metrics = Metrics.registry.take() if _worker.get("remote") else None
+    return record.id, outputs, None, metrics, rows if _worker.get("rows") else None
+
+
+def recording_lookup(lookup, genes):
+    """
+    Lookup that remembers the annotation of the IDs, so the rows do not have to look them up again
+    :param genes: ENSEMBL ID -> (chromosome, strand, breakpoint, gene name, exons), filled up as we go
+    """
+    def lookup_and_record(ENS_ID):
+        genes[ENS_ID] = lookup(ENS_ID)
+        return genes[ENS_ID]
+    return lookup_and_record
+
+
+def recording_render(render, fusions):
+    """
+    Renderer that remembers the fusions it has drawn
+    :param fusions: list of (5' name, 3' name, (5' exons, 3' exons), picture), filled up as we go
+    """
+    def render_and_record(fex, record, prime5name, prime3name):
+        picture = render(fex, record, prime5name, prime3name)
+        fusions.append((prime5name, prime3name, fex, picture))
+        return picture
+    return render_and_record
+
+
+def fusion_rows(record: VCFRecord.VCFRecord, fusions, genes, lookup):
+    """
+    :return: FusionTable rows of the fusions of a record
+    """
+    by_name = {}
+    for ENS_ID in fusion_ENS_IDs(record):
+        # the memo does not look up anything
+        coords = genes[ENS_ID] if ENS_ID in genes else lookup(ENS_ID)
+        by_name.setdefault(coords[3], FusionTable.gene(coords[3], ENS_ID, coords))
+    rows = []
+    for prime5name, prime3name, fex, picture in fusions:
+        if isinstance(picture, Gallery.Panel):
+            picture = _worker["gallery"] + "#" + picture.name
+        rows.append(FusionTable.make_row(record, by_name.get(prime5name) or FusionTable.gene(prime5name),
+                                         by_name.get(prime3name) or FusionTable.gene(prime3name), fex, picture))
+    return rows
+
+
+def memoized_fusions(memo: FusionMemo.FusionMemo, record: VCFRecord.VCFRecord, lookup, render, mate_alt=None):
+    """
+    Like the SV handlers, but the exons are made only if the memo does not have them yet
+    """
+    key = memo.key(fusion_key(record))
+    fusions = memo.get(key)
+    if fusions is None:
+        fusions = []
+        SV_handlers[record.kind](record, lookup, lambda fex, _, prime5name, prime3name:
+                                 fusions.append((prime5name, prime3name, fex)), mate_alt)
+        memo.put(key, fusions)
+    return [render(fex, record, prime5name, prime3name) for prime5name, prime3name, fex in fusions]
+
+
+def collect_results(results, failed_records, gallery=None, table=None):
+    """
+    Goes through the (record ID, outputs, error, metrics, rows) results in input order,
+    the gallery gets the panels and the FusionTableWriter the rows
+    """
+    for record_ID, outputs, error, metrics, rows in results:
+        if metrics is not None:
+            Metrics.registry.merge_dict(metrics)
+        if error is not None:
+            failed_records[record_ID] = error
+        if gallery is not None:
+            for panel in outputs:
+                gallery.add(panel)
+        if table is not None:
+            for row in rows:
+                table.write(row)
+
+
+def run_shard(task):
+    """
+    Sharded mode, in a worker: reads, filters and pairs the records of a shard, and makes the fusions of all
+    of them but the translocations whose mate is not in the shard, those go back to reduce_shards()
+    :param task: (Shard, SnpEffParser with the ANN layout of the VCF, RecordFilter or None, prefetch)
+    :return: (list of (index, run_fusion_job() result), list of (index, unpaired breakend), records kept and
+    dropped by the filter, metrics), the index is the place of the record in the shard
+    """
+    shard, sep, record_filter, prefetch = task
+    records = Metrics.timed_iter(read_fusion_records(ShardedVCF.read_shard(shard), sep), "parse")
+    if record_filter is not None:
+        # the counters of the copy we got are not necessarily zero
+        counted = record_filter.kept, record_filter.dropped
+        records = record_filter.filter(records)
+    if prefetch:
+        records = list(records)
+        _worker["prefetch"]([ENS_ID for record in records for ENS_ID in fusion_ENS_IDs(record)])
+    pairer = BreakendPairer.BreakendPairer()
+    results, unpaired, places = [], [], {}
+    for index, record in enumerate(records):
+        mate_alt = None
+        if record.kind == VCFRecord.TRANSLOCATION:
+            if record.get("MATEID") is None and record.get("EVENT") is None:
+                # the reducer makes an orphan of it, at the same place as the serial run
+                unpaired.append((index, record))
+                continue
+            places[id(record)] = index
+            pair = pairer.add(record)
+            if pair is None:
+                continue
+            (record, mate) = pair
+            mate_alt = mate.alt
+        results.append((index, run_fusion_job((record, mate_alt))))
+    unpaired.extend((places[id(record)], record) for record in pairer.pending())
+    unpaired.sort(key=lambda item: item[0])
+    kept, dropped = 0, 0
+    if record_filter is not None:
+        kept, dropped = record_filter.kept - counted[0], record_filter.dropped - counted[1]
+    return results, unpaired, kept, dropped, Metrics.registry.take()
+
+
+def reduce_shards(shard_results, record_filter, failed_records, gallery=None, table=None):
+    """
+    Sharded mode, in the main process: goes through the results of the shards in file order, pairs the
+    translocations whose breakends are in different shards (and makes their fusions here), and collects
+    everything in the order of a serial run
+    :return: the BreakendPairer of the breakends left unpaired by the shards
+    """
+    pairer = BreakendPairer.BreakendPairer()
+    for results, unpaired, kept, dropped, metrics in shard_results:
+        Metrics.registry.merge_dict(metrics)
+        if record_filter is not None:
+            record_filter.kept += kept
+            record_filter.dropped += dropped
+        for index, record in unpaired:
+            pair = pairer.add(record)
+            if pair is not None:
+                results.append((index, run_fusion_job((pair[0], pair[1].alt))))
+        # a pair is made at its second breakend, like in the serial run
+        results.sort(key=lambda result: result[0])
+        collect_results((result for _, result in results), failed_records, gallery, table)
+    return pairer
+
+
+def read_ann_header(vcf_file, sep):
+    """
+    Feeds the snpEff ANN header line to the parser, reading only the header of the VCF
+    """
+    for line in vcf_file:
+        if line[0] != "#":
+            return
+        if line.startswith("##INFO=<ID=ANN"):
+            sep.add_ann_keys(line)
+
+
+def read_fusion_records(vcf_file, sep):
+    """
+    Yields the PASS gene_fusion records of the VCF, and feeds the snpEff ANN header line to the parser,
+    so the ANN fields of the records are read with the layout of this VCF
+    """
+    for line in vcf_file:
+        if line[0] == "#":
+            # if it is contains the snpEff "ANN" line
+            if line.startswith("##INFO=<ID=ANN"):
+                sep.add_ann_keys(line)
+            continue
+        record = VCFRecord.VCFRecord.parse(line)
+        if record is not None:
+            record.ann_parser = sep
+            yield record
 
 
 # This is the surrogate for main(): everything happens here
 
 @click.command(context_settings=dict(help_option_names=['-h', '--help']))
-@click.option('--vcf', '-v', type=str, help='VCF file to get SVs generated by Manta', required=True)
-@click.option('--svg', '-s', type=str, help='The output SVG file name', required=True)
+@click.option('--vcf', '-v', type=str, required=True,
+              help='VCF file to get SVs generated by Manta, can be gzipped or bgzipped, "-" is for stdin')
+@click.option('--svg', '-s', type=str, help='The output SVG file name', required=False, default=None)
+@click.option('--no-svg', is_flag=True, default=False,
+              help='Do not draw any pictures, only write the fusions to --bedpe and/or --jsonl')
+@click.option('--bedpe', type=str, required=False, default=None,
+              help='Write a BEDPE line for each fusion to this file ("-" is stdout)')
+@click.option('--jsonl', type=str, required=False, default=None,
+              help='Write a JSON object for each fusion to this JSON Lines file ("-" is stdout)')
 @click.option('--rest/--no-rest', '-r', type=bool, help='Read from ENSEMBL REST or JSON file', required=False,
               default=True)
-def print_SV(vcf, svg, rest):
-    # comment regexp
-    comment_re = re.compile("^#.*")
-    # further regexps to dig out fusions
-    fusion_re = re.compile(".*gene_fusion.*")
-    tandem_re = re.compile(".*DUP:TANDEM.*")
-    transloc_re = re.compile(".*MantaBND.*")
-    inversion_re = re.compile(".*INV.*")
-    deletion_re = re.compile(".*MantaDEL.*")
-    ann_re = re.compile(".*ID=ANN.*")
-    # we are dealing with PASS only
-    filter_re = re.compile(".*PASS.*")
-
-    # count of pictures (as there can be more)
-    pic_count = 0
-    # read the VCF file:
-    vcf_file = open(vcf, 'r')
+@click.option('--cache', '-c', type=str, help='SQLite annotation store shared between runs',
+              required=False, default=AnnotationStore.default_store_path(), show_default=True)
+@click.option('--prefetch/--no-prefetch', type=bool,
+              help='Look up all ENSEMBL IDs of the VCF in batches before making the fusions',
+              required=False, default=False)
+@click.option('--gtf', '-g', type=str, help='Local ENSEMBL GTF or GFF3 (can be gzipped) to read exons from',
+              required=False, default=None)
+@click.option('--index', '-x', type=str, help='Annotation index made by "index build" to read exons from',
+              required=False, default=None)
+@click.option('--server', type=str, required=False, default=EnsemblREST.DEFAULT_SERVER, show_default=True,
+              envvar="VCFFUSE_ENSEMBL_SERVER",
+              help='Base URL of the ENSEMBL REST server, like a local EnsemblStandIn ($VCFFUSE_ENSEMBL_SERVER)')
+@click.option('--rest-workers', type=int, help='Number of concurrent ENSEMBL REST requests',
+              required=False, default=4, show_default=True)
+@click.option('--rest-rate', type=float, help='Maximum ENSEMBL REST requests per second',
+              required=False, default=EnsemblREST.DEFAULT_RATE, show_default=True)
+@click.option('--jobs', '-j', type=int, help='Number of processes making the fusions',
+              required=False, default=1, show_default=True)
+@click.option('--bnd-window', type=int, required=False, default=None,
+              help='For coordinate-sorted VCFs: drop a breakend once the input is this far past its mate position')
+@click.option('--shard/--no-shard', type=bool, required=False, default=False,
+              help='With --jobs: each process reads its own part of the VCF (contigs of a bgzipped VCF with a '
+                   'tabix index, byte ranges of a plain VCF), the results are the same as without. '
+                   '--bnd-window is not used then')
+@click.option('--shard-size', type=int, required=False, default=None,
+              help='Bases in a shard of an indexed VCF, whole contigs by default')
+@click.option('--regions', type=str, required=False, default=None,
+              help='BED file of a panel: only records with a breakpoint (or mate) in these regions are processed')
+@click.option('--genes', type=str, required=False, default=None,
+              help='Only fusions of these genes: a file or a comma separated list of gene symbols and ENSEMBL IDs')
+@click.option('--svg-backend', type=click.Choice(["svgwrite", "stream"]), required=False, default="svgwrite",
+              show_default=True,
+              help='Build the pictures with svgwrite, or stream the same bytes directly to the files')
+@click.option('--output-mode', type=click.Choice(["files", "gallery"]), required=False, default="files",
+              show_default=True,
+              help='A separate SVG file for each fusion, or a single HTML gallery (named after --svg) for the run')
+@click.option('--memo', type=str, required=False, default=None,
+              help='Directory of the fusion memo shared between runs (":memory:" for this run only): '
+                   'fusions and pictures already made are not made again')
+@click.option('--memo-size', type=int, required=False, default=FusionMemo.DEFAULT_MAX_BYTES >> 20, show_default=True,
+              help='The memo directory is kept under this many megabytes')
+@click.option('--log-level', type=click.Choice(["DEBUG", "INFO", "WARNING", "ERROR"], case_sensitive=False),
+              required=False, default="INFO", show_default=True,
+              help='DEBUG shows breakpoints and exons as BED, WARNING only the records we could not make a fusion of')
+@click.option('--metrics', type=str, required=False, default=None,
+              help='Write stage timings, counters and peak memory to PREFIX.json and PREFIX.prom (Prometheus textfile)')
+@click.option('--trace-memory/--no-trace-memory', type=bool, required=False, default=False,
+              help='Measure the peak Python memory with tracemalloc (slows the run down)')
+@click.option('--profile', type=str, required=False, default=None,
+              help='Dump cProfile statistics of the main process to this file')
+@click.option('--manifest', type=str, required=False, default=None,
+              help='Run manifest (SQLite): a rerun takes the unchanged records done before from it, '
+                   'and makes only the new and the failed ones')
+def print_SV(vcf, svg, no_svg, bedpe, jsonl, rest, cache, prefetch, gtf, index, server, rest_workers, rest_rate, jobs,
+             bnd_window, shard, shard_size, regions, genes, svg_backend, output_mode, memo, memo_size, log_level,
+             metrics, trace_memory, profile, manifest):
+    if no_svg:
+        if not (bedpe or jsonl):
+            raise click.UsageError("--no-svg needs --bedpe or --jsonl, otherwise there is no output at all")
+        output_mode = "none"
+    elif svg is None:
+        raise click.UsageError("Missing option '--svg' (or --no-svg)")
+    configure_logging(log_level)
+    if trace_memory:
+        tracemalloc.start()
+    profiler = None
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    fusion_memo = FusionMemo.FusionMemo(memo, memo_size << 20,
+                                        annotation=FusionMemo.annotation_source(rest, server, gtf, index)) \
+        if memo else None
+    record_filter = RecordFilter.RecordFilter.from_options(regions, genes)
+    table = FusionTable.FusionTableWriter(bedpe, jsonl) if bedpe or jsonl else None
+    # the pictures depend on these, the records of a run with other ones are not taken
+    run_manifest = RunManifest.RunManifest(manifest, (svg, output_mode, svg_backend,
+                                                      FusionMemo.annotation_source(rest, server, gtf, index))) \
+        if manifest else None
+    with Metrics.timer("run"):
+        make_fusions(vcf, svg, rest, cache, prefetch, gtf, rest_workers, rest_rate, jobs, bnd_window, svg_backend,
+                     output_mode, log_level, trace_memory, server, fusion_memo, record_filter, table, index, shard,
+                     shard_size, run_manifest)
+    if table is not None:
+        table.close()
+        logger.info("%d fusions are in %s", table.rows, " and ".join(path for path in (bedpe, jsonl) if path))
+    if fusion_memo is not None:
+        fusion_memo.evict()
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(profile)
+        logger.info("Profile is at %s", profile)
+    Metrics.registry.measure_memory()
+    if metrics:
+        Metrics.registry.to_json(metrics + ".json")
+        Metrics.registry.to_prometheus(metrics + ".prom")
+        logger.info("Metrics are at %s.json and %s.prom", metrics, metrics)
+
+
+def annotation_backends(gtf=None, index=None):
+    """
+    The local annotation, in the order we are asking them: the memory-mapped index, then the GTF
+    """
+    backends = []
+    if index:
+        backends.append(AnnotationIndex.AnnotationIndex(index))
+    if gtf:
+        backends.append(GTFAnnotation.GTFAnnotation(gtf))
+    return backends
+
+
+def configure_logging(level):
+    logging.basicConfig(level=level.upper(), format="%(message)s")
+
+
+def make_fusions(vcf, svg, rest, cache, prefetch, gtf, rest_workers, rest_rate, jobs, bnd_window,
+                 svg_backend="svgwrite", output_mode="files", log_level="INFO", trace_memory=False,
+                 server=EnsemblREST.DEFAULT_SERVER, memo=None, record_filter=None, table=None, index=None, shard=False,
+                 shard_size=None, manifest=None):
+    """
+    :param output_mode: "files", "gallery" or "none" (no pictures)
+    :param table: FusionTableWriter for the BEDPE / JSON Lines rows, or None
+    :param index: path of an AnnotationIndex, it comes before the GTF
+    :param shard: with more jobs each one reads its own shards of the VCF, see ShardedVCF
+    :param shard_size: bases in a shard of an indexed VCF, None for whole contigs
+    :param manifest: RunManifest, the records done in an earlier run are taken from it
+    """
+    # read the VCF file (or stdin), decompressing on the fly:
+    vcf_file = VCFReader.open_text(vcf)
+    # already parsed exons for the ENSEMBL IDs, we are looking up each ID only once
+    store = AnnotationStore.AnnotationStore(cache)
+    backends = annotation_backends(gtf, index)
+    client = EnsemblREST.EnsemblClient(server=server, rate=rest_rate, workers=rest_workers)
+    # records we could not make a fusion for, with the reason
+    failed_records = {}
     sep = SnpEffParser()
-    for line in vcf_file:
-        line = line.rstrip()
-        # if it is contains the snpEff "ANN" line
-        if ann_re.match(line):
-            sep.add_ann_keys(line)
-            # print("Keys:", sep.ann_keys)
-        # it is PASS, has the annotation "gene_fusion" and certainly not a comment
-        if filter_re.match(line) and fusion_re.match(line) and not comment_re.match(line):
-            sv_call = line.split("\t")
-            start_chrom = sv_call[0]
-            # process tandem duplications
-            if tandem_re.match(line):
-                # parse snpEff annotations, and store fusions
-                # sep.parse_se_ann(sv_call[7],fusion_re)
-                print("######################## processing tandem duplication ####################### ", sv_call[2])
-                # column 2 is the SV starting point in the call - just we do not know yet the name of the gene
-                start = int(sv_call[1])
-                snpEff_ann = sv_call[7].split("|")
-                # Munching through the "END=140789598;SVTYPE=DUP;SVLEN=1932669;CIPOS=0,1;CIEND=0,1;HOMLEN=1;HOMSEQ=G;SOMATIC;SOMATICSCORE=85;ANN=<DUP:TANDEM>" string to get 140789598
-                end = int(snpEff_ann[0].split(";")[0].replace("END=", ""))
-                ENS_IDs = snpEff_ann[4].split("&")
-
-                # for forward strand pairs the 5' end is the gene with higher coordinates
-                # for reverse strand pairs it is the gene with lower coordinates
-                # for tandem duplication fusions the strands should be the same
-                genes_to_join = [ExonCoords.fromTuple(get_CDS_coords(ENS_IDs[0], rest)),
-                                 ExonCoords.fromTuple(get_CDS_coords(ENS_IDs[1], rest))]
-                # forward strand cases
-                if genes_to_join[0].strand > 0 and genes_to_join[1].strand > 0:
-                    if genes_to_join[0].begin() < genes_to_join[1].begin():  # we have to swap them as the first is the 3'
-                        genes_to_join = [genes_to_join[1], genes_to_join[0]]
-                else:  # negative strand
-                    if genes_to_join[0].begin() > genes_to_join[1].begin():  # note the relation sign >
-                        genes_to_join = [genes_to_join[1], genes_to_join[0]]
-
-                # now we should have the 5' as the first in the list
-                prime_5 = genes_to_join[0]
-                prime_3 = genes_to_join[1]
-                fusion = SV_Maker(prime_5, prime_3, start, end, start_chrom)
-                fused_genes = fusion.fuse_tandem_genes()
-                (p5, p3) = reverse_fusion(fused_genes)
-                pic_count = makeSVG((p5, p3),
-                                    svg,
-                                    pic_count,
-                                    genes_to_join[0].gene_name,
-                                    genes_to_join[1].gene_name)
-                print("###############################################################################")
-            elif transloc_re.match(line):  # translocations
-                print("----------------- processing translocation ---------------------- ",
-                      sv_call[0], sv_call[1], sv_call[2])
-                # get the annotation part
-                snpEff_ann = sv_call[7].split("|")
-                # look up whether the other end of the translocation is already stored
-                mate_ID = snpEff_ann[0].split(";")[1].replace("MATEID=", "")
-                print("Searching ", mate_ID)
-                if mate_ID in BND_dict.keys():
-                    # instead of gene IDs we should go for transcript IDs
-                    # that are a bit more complicated to get
-                    ENS_IDs = get_transcript_IDs(snpEff_ann[10])
-                    genes_to_join = [ExonCoords.fromTuple(get_CDS_coords(ENS_IDs[0], rest)),
-                                     ExonCoords.fromTuple(get_CDS_coords(ENS_IDs[1], rest))]
-                    # we can have meaningful fusions only for cases like (B is for 'base')
-                    # a) genes are parallel (FF or RR), and the chromosome join is B[mate[ - ]mate]B
-                    # b) genes are FR, join is B]mate] - B]mate]
-                    # c) genes are RF, join is [mate[B - [mate[B
-                    # see VCF documentation "5.4 Specifying complex rearrangements with breakends"
-                    if genes_to_join[0].strand == genes_to_join[1].strand:
-                        # like case ALK&DUSP3|ENSG00000171094&ENSG00000108861
-                        # chr2    29256656        MantaBND:1:9840:9841:0:0:0:1    G       G[CHR17:43768837[ 
-                        # chr17   43768837        MantaBND:1:9840:9841:0:0:0:0    T       ]CHR2:29256656]T
-                        # bnd_U and bnd_V in VCF example
-                        print("Parallel strand mates", sv_call[2], sv_call[4], "with mate ID", mate_ID, BND_dict[mate_ID])
-                        # we have to process reverse-reverse and forward-forward cases separate
-                        if genes_to_join[0].strand > 0:
-                            print("Forward-forward genes")
-                        else:
-                            print("Reverse-reverse genes with a ]mate]B - B[mate[ fusion")
-                            # we have to have the right of the starting reverse gene (DUSP3 in case)
-                            # and the left of the second reverse
-                            (prime_5,prime_3) = (genes_to_join[0], genes_to_join[1])
-                            fusion = SV_Maker(prime_5, prime_3, None, None, start_chrom)
-                            fusion.assign_breakpoint_to_genes((sv_call[0], int(sv_call[1])))
-                            # this is for the mate
-                            breakpoint = extract_breakpoint(sv_call[4])
-                            fusion.assign_breakpoint_to_genes(breakpoint)
-                            svg_coords = fusion.fuse_translocations(fusion.DIR_RIGHT, fusion.DIR_LEFT)
-                            pic_count = makeSVG(svg_coords,
-                                                svg,
-                                                pic_count,
-                                                genes_to_join[0].gene_name,
-                                                genes_to_join[1].gene_name)
-                            fusion.print_properties()
-                    else:
-                        # find out whether it is B]mate]-B]mate] or [mate[B-[mate[B
-                        rev_mate_re = re.compile(".*]CHR.*:[0-9].*]")
-                        # for B]mate]-B]mate] we want left for both
-                        if rev_mate_re.match(sv_call[4]):
-                            print("forward antiparallel strand mates", sv_call[2], sv_call[4],
-                                  "with mate ID", mate_ID, BND_dict[mate_ID])
-                            # the 5' will be the forward gene
-                            if genes_to_join[0].strand > 0:
-                                (prime_5, prime_3) = (genes_to_join[0], genes_to_join[1])
-                            else:
-                                (prime_5, prime_3) = (genes_to_join[1], genes_to_join[0])
-                            fusion = SV_Maker(prime_5, prime_3, None, None, start_chrom)
-                            # have to find out how the breakpoints are assigned
-                            # this is for the one in the VCF line
-                            fusion.assign_breakpoint_to_genes((sv_call[0], int(sv_call[1])))
-                            # this is for the mate
-                            breakpoint = extract_breakpoint(sv_call[4])
-                            fusion.assign_breakpoint_to_genes(breakpoint)
-                            svg_coords = fusion.fuse_translocations(fusion.DIR_LEFT, fusion.DIR_LEFT)
-                            pic_count = makeSVG(svg_coords,
-                                                svg,
-                                                pic_count,
-                                                genes_to_join[0].gene_name,
-                                                genes_to_join[1].gene_name)
-                            fusion.print_properties()
-                        else:
-                            # for [mate[B-[mate[B we want right for both
-                            print("reverse antiparallel strand mates", sv_call[2], sv_call[4],
-                                  "with mate ID", mate_ID, BND_dict[mate_ID])
-
-                else:
-                    BND_dict[sv_call[2]] = sv_call[4]
-            elif inversion_re.match(line):
-                print("######################## processing INVERSION ####################### ", sv_call[2])
-                start = int(sv_call[1])
-                # for inversions we do not have a given transcript
-                # (why? and why do we have for translocations? would be nice to understand)
-                annotations = sv_call[7].split("<INV>")
-                end = int(annotations[0].split(";")[0].replace("END=", ""))
-                # we can have more than one gene_fusion in the annotation list
-                for ann in annotations[1::]:
-                    ann_items = ann.split('|')
-                    # this nasty below is to get the gene IDs from the first entry of
-                    # annotations
-                    if ann_items[1] == 'gene_fusion':
-                        ENS_IDs = ann_items[4].split("&")
-                        genes_to_join = [ExonCoords.fromTuple(get_CDS_coords(ENS_IDs[0], rest)),
-                                         ExonCoords.fromTuple(get_CDS_coords(ENS_IDs[1], rest))]
-                        # we can have two 5' fusions, so we have to print out both
-                        # find_5prime_for_inversion will return with a list that contains two tuples.
-                        for fusion_tuples in [genes_to_join, [genes_to_join[1], genes_to_join[0]]]:
-                            (prime_5, prime_3) = fusion_tuples
-                            fusion = SV_Maker(prime_5, prime_3, start, end, start_chrom)
-                            # fusions at inversions can be either
-                            # <--  --> or -->  <--
-                            svg_coords = fusion.fuse_inversion()
-                            pic_count = makeSVG(svg_coords, svg, pic_count, prime_5.gene_name, prime_3.gene_name)
-                            fusion.print_properties()
-            elif deletion_re.match(line):
-                print("######################## processing DELETION ####################### ", sv_call[2])
-                start = int(sv_call[1])
-                annotations = sv_call[7].split("<DEL>")
-                end = int(annotations[0].split(";")[0].replace("END=", ""))
-                for ann in annotations[1::]:
-                    ann_items = ann.split('|')
-                    if ann_items[1] == 'gene_fusion':
-                        ENS_IDs = ann_items[4].split("&")
-                        genes_to_join = [ExonCoords.fromTuple(get_CDS_coords(ENS_IDs[0], rest)),
-                                         ExonCoords.fromTuple(get_CDS_coords(ENS_IDs[1], rest))]
-                        # forward strands
-                        if genes_to_join[0].strand > 0 and genes_to_join[1].strand > 0:
-                            # order them by coordinates
-                            if genes_to_join[0].begin() > genes_to_join[1].begin():
-                                genes_to_join = [genes_to_join[1], genes_to_join[0]]
-                        else:  # negative strand
-                            if genes_to_join[0].begin() < genes_to_join[1].begin():  # note the relation sign <
-                                genes_to_join = [genes_to_join[1], genes_to_join[0]]
-                        fusion = SV_Maker(genes_to_join[0], genes_to_join[1], start, end, start_chrom)
-                        svg_coords = fusion.fuse_deletion()
-                        # have to reverse for reverse genes
-                        (p5, p3) = reverse_fusion(svg_coords)
-                        pic_count = makeSVG((p5, p3),
-                                            svg,
-                                            pic_count,
-                                            genes_to_join[0].gene_name,
-                                            genes_to_join[1].gene_name)
-                        fusion.print_properties()
+    shards = ShardedVCF.plan_shards(vcf, jobs * 4, shard_size) if shard and jobs > 1 else None
+    if shard and jobs > 1 and shards is None:
+        logger.warning("%s can not be sharded (stdin, or gzipped without a tabix index), reading it in one go", vcf)
+    records = []
+    if shards is not None:
+        # the workers are reading the records, we need only the ANN layout for them
+        read_ann_header(vcf_file, sep)
+    else:
+        records = Metrics.timed_iter(read_fusion_records(vcf_file, sep), "parse")
+        if record_filter is not None:
+            # before any lookup
+            records = record_filter.filter(records)
+    if prefetch and rest and shards is None:
+        # first pass: keep the few records we are interested in, and resolve all their IDs at once
+        records = list(records)
+        ENS_IDs = []
+        for record in records:
+            ENS_IDs.extend(fusion_ENS_IDs(record))
+        prefetch_CDS_coords(ENS_IDs, store, backends, client)
+    pairer = BreakendPairer.BreakendPairer(bnd_window)
+    # the rate limit is for all of us together
+    worker_settings = (rest, cache, backends, client.server, rest_rate / max(1, jobs), rest_workers, svg,
+                       svg_backend, output_mode, memo)
+    gallery = Gallery.GalleryWriter(Gallery.gallery_file_name(svg), title=vcf) if output_mode == "gallery" else None
+    if shards is not None:
+        logger.info("Reading %s in %d shards", vcf, len(shards))
+        if bnd_window is not None:
+            # the pairers of the shards and the reducer keep each breakend until its mate comes
+            logger.warning("--bnd-window is not used with --shard, the breakends are kept until the end of a shard")
+        # the translocations with breakends in two shards are made here
+        init_worker(*worker_settings, rows=table is not None, manifest=manifest)
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                                 initargs=worker_settings + (log_level, trace_memory, True, table is not None,
+                                                             manifest)) as pool:
+            tasks = ((vcf_shard, sep, record_filter, prefetch and rest) for vcf_shard in shards)
+            pairer = reduce_shards(pool.map(run_shard, tasks), record_filter, failed_records, gallery, table)
+    elif jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                                 initargs=worker_settings + (log_level, trace_memory, True, table is not None,
+                                                             manifest)) as pool:
+            collect_results(pool.map(run_fusion_job, fusion_jobs(records, pairer), chunksize=4),
+                            failed_records, gallery, table)
+    else:
+        init_worker(*worker_settings, rows=table is not None, manifest=manifest)
+        collect_results((run_fusion_job(job) for job in fusion_jobs(records, pairer)), failed_records, gallery,
+                        table)
+    vcf_file.close()
+    if gallery is not None:
+        gallery.close()
+        logger.info("Gallery of %d fusion pictures is at %s", gallery.panels, gallery.path)
+    for record_ID, reason in failed_records.items():
+        logger.warning("Failed record: %s %s", record_ID, reason)
+    for record_ID in pairer.flush():
+        logger.warning("Unpaired breakend: %s", record_ID)
+    Metrics.count("unpaired_breakends", len(pairer.orphans))
+    if manifest is not None:
+        logger.info("%d records were taken from the manifest %s", Metrics.registry.counters.get("resumed_records", 0),
+                    manifest.path)
+    if record_filter is not None:
+        logger.info("%d records kept, %d dropped by the panel filter", record_filter.kept, record_filter.dropped)
+        Metrics.count("filtered_records", record_filter.dropped)
 
 
 def find_5prime_for_inversion(start, end, gtj: list):
@@ -807,38 +940,36 @@ def get_transcript_IDs(ann):
     return [transcripts[4], transcripts[6]]
 
 
-def makeSVG(fex, svg, pic_count, prime5name, prime3name):
-    w, h = '100%', '100%'
-    outfile = str(pic_count) + "_" + prime5name + "_" + prime3name + "-" + svg
-    dwg = svgwrite.Drawing(filename=outfile, size=(w, h), debug=True)
-    # background
-    dwg.add(dwg.rect(insert=(0, 0), size=(w, h), fill='white', stroke='white'))
-    # exons
-    shapes = dwg.add(dwg.g(id='shapes', fill='red'))
-    # 5' part of exons
-    shapes = shape_intervals(dwg, shapes, fex[0], 'blue')
-    # 3' part of exons
-    shapes = shape_intervals(dwg, shapes, fex[1], 'red')
-    # introns
-    shapes.add(dwg.rect(insert=(fex[0].begin() / 100 * mm, 8 * mm),
-                        size=(int(abs(fex[0].begin() - fex[0].end())) / 100 * mm, 2 * mm), fill='blue'))
-    shapes.add(dwg.rect(insert=(fex[1].begin() / 100 * mm, 8 * mm),
-                        size=(int(abs(fex[1].end() - fex[1].begin())) / 100 * mm, 2 * mm), fill='red'))
-    dwg.save()
-    print("Fusion picture is at", outfile)
-    return pic_count + 1
+file_name_re = re.compile("[^A-Za-z0-9._-]")
 
 
-def shape_intervals(dwg, shapes, itv: ExonCoords, color):
-    height = 2 * cm
-    for iv in itv:
-        if abs(iv.end - iv.begin) > 1:
-            s = iv.begin / 100
-            width = int(abs(iv.end - iv.begin + 100) / 100)
-            # print("SVG:", s*mm, 0, width*mm, height)
-            shapes.add(dwg.rect(insert=(s * mm, 0), size=(width * mm, height),
-                                fill=color, stroke=color, stroke_width=1))
-    return shapes
+def fusion_file_name(record_ID, prime5name, prime3name, svg):
+    """
+    Picture names depend only on the record and the gene order, so we get the same files
+    regardless of the order (or the number of processes) we are making them in
+    """
+    prefix = file_name_re.sub("_", record_ID + "_" + prime5name + "_" + prime3name)
+    return prefix + "-" + svg
+
+
+def fusion_key(record: VCFRecord.VCFRecord):
+    """
+    Everything the pictures of a record depend on: the same key in two samples gives the same pictures
+    """
+    return (record.kind, record.chrom.lower(), record.pos, record.get("END"), record.alt,
+            tuple(fusion_ENS_IDs(record)))
+
+
+def shared_file_name(record: VCFRecord.VCFRecord, prime5name, prime3name):
+    """
+    Picture name made of the breakpoints and the genes, with a hash of the fusion key, so records
+    that differ only in something not shown in the name (like the breakend orientation) do not clash
+    """
+    digest = hashlib.sha1(repr(fusion_key(record)).encode("utf-8")).hexdigest()[:10]
+    second = record.get("END") or "_".join(str(item) for item in BreakendPairer.mate_position(record.alt) or ())
+    prefix = file_name_re.sub("_", "_".join((record.kind, record.chrom, str(record.pos), str(second),
+                                             prime5name, prime3name)))
+    return prefix + "-" + digest + ".svg"
 
 
 def extract_breakpoint(a_bp: str):
@@ -847,7 +978,7 @@ def extract_breakpoint(a_bp: str):
     chrom = ""
     coords = 0
     if a_bp.startswith("["):  # it is like "[CHR8:108561001[T"
-        print("bugger [CHR8:108561001[T")
+        logger.debug("bugger [CHR8:108561001[T")
     else:
         mate_list = re.split(':|]', a_bp)  # will be ['A', 'CHR6', '108561001', '']
         chrom = mate_list[1].lower()
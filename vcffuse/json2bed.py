@@ -1,52 +1,268 @@
+"""
+BED of ENSEMBL transcripts, to load into IGV next to the fusion pictures.
+
+    python -m vcffuse.json2bed --id ENSG00000139083
+writes a BED file for each transcript of a gene (C_ is for the canonical one), and
+
+    python -m vcffuse.json2bed --ids genes.txt --out genes.bed.gz --bgzip --sort --jobs 8
+    python -m vcffuse.json2bed --from-cache ~/.cache/vcffuse/annotation.sqlite --out cached.bed
+streams all the transcripts into a single BED12 file, a line for each transcript.
+"""
 import json
-import requests, sys
+import logging
+import os
+import sys
+from itertools import islice
 import click
+from vcffuse import AnnotationIndex, AnnotationStore, BGZF, EnsemblREST
+from vcffuse.EnsemblREST import chunks
+
+logger = logging.getLogger(__name__)
+
+# IDs looked up and written at once: the REST batches go in parallel, and only this many objects are in memory
+BULK_CHUNK_SIZE = 500
+
+
+def transcripts_from_json(obj):
+    """
+    Yields (ID, display name, chromosome, strand, canonical, exons) for the transcripts of an ENSEMBL lookup object,
+    that is a gene with all its transcripts, or a single transcript. The exons are sorted (start, end) pairs.
+    """
+    transcripts = obj['Transcript'] if 'Transcript' in obj.keys() else [obj]
+    for trs in transcripts:
+        chromosome = "chr" + str(trs.get('seq_region_name', obj['seq_region_name']))
+        exons = sorted((exon['start'], exon['end']) for exon in trs['Exon'])
+        yield (trs['id'], trs['display_name'], chromosome, trs.get('strand', obj['strand']),
+               trs.get('is_canonical', 0) > 0, exons)
+
 
 def print_coords_from_json(obj):
-    chromosome = "chr" + str(obj['seq_region_name'])
-    if 'Transcript' in obj.keys():
-        for trs in obj['Transcript']:
-            display_name = trs['display_name']
-            file_suffix = display_name+"_"+trs['id']+'.bed'
-            print("writing ",display_name,trs['id'])
-            if trs['is_canonical'] > 0: # canonical transcript
-                # if canonical, insert C_ prefix
-                fh = open("C_"+file_suffix, 'w')
+    for ENS_ID, display_name, chromosome, _, canonical, exons in transcripts_from_json(obj):
+        file_suffix = display_name + "_" + ENS_ID + '.bed'
+        logger.info("writing %s %s", display_name, ENS_ID)
+        # if canonical, insert C_ prefix
+        with open(("C_" if canonical else "") + file_suffix, 'w') as fh:
+            for start, end in exons:
+                fh.write(chromosome + "\t" + str(start) + "\t" + str(end) + "\t" + display_name + "\n")
+
+
+def bed12_line(ENS_ID, display_name, chromosome, strand, canonical, exons):
+    """
+    A transcript as a BED12 line, the 1-based ENSEMBL coordinates are turned into 0-based BED ones
+    """
+    start = exons[0][0] - 1
+    end = max(exon_end for _, exon_end in exons)
+    name = ("C_" if canonical else "") + display_name + "_" + ENS_ID
+    sizes = "".join(str(exon_end - exon_start + 1) + "," for exon_start, exon_end in exons)
+    starts = "".join(str(exon_start - 1 - start) + "," for exon_start, _ in exons)
+    return "\t".join((chromosome, str(start), str(end), name, "0", "+" if strand > 0 else "-", str(start),
+                      str(end), "0", str(len(exons)), sizes, starts)) + "\n"
+
+
+def read_ids(ids):
+    """
+    :param ids: file of ENSEMBL IDs (separated by new lines, spaces or commas, # starts a comment),
+    or a comma separated list of them
+    :return: list of the IDs in the order they are given, each one once
+    """
+    if os.path.isfile(ids):
+        with open(ids, 'r') as id_file:
+            text = "\n".join(line.split("#", 1)[0] for line in id_file)
+    else:
+        text = ids
+    return list(dict.fromkeys(text.replace(",", " ").split()))
+
+
+def json_bed_lines(ENS_IDs):
+    """
+    BED12 lines of the transcripts of the IDs from the <ID>.json files in the working directory
+    :return: (list of lines, list of the IDs we could not read)
+    """
+    lines, failed = [], []
+    for ENS_ID in ENS_IDs:
+        try:
+            with open(ENS_ID + '.json', 'r') as json_file:
+                obj = json.loads(json_file.read())
+        except (OSError, ValueError) as e:
+            logger.warning("Could not read %s.json: %s", ENS_ID, e)
+            failed.append(ENS_ID)
+            continue
+        lines.extend(bed12_line(*transcript) for transcript in transcripts_from_json(obj))
+    return lines, failed
+
+
+def rest_bed_lines(ENS_IDs, client):
+    """
+    BED12 lines of the transcripts of the IDs, looked up with batched (and concurrent) POST requests
+    """
+    lines, failed = [], []
+    found, failures = client.lookup_batch(ENS_IDs)
+    for ENS_ID in ENS_IDs:
+        obj = found.get(ENS_ID)
+        if obj is None:
+            logger.warning("Could not look up %s %s", ENS_ID, failures.get(ENS_ID, "not known by ENSEMBL"))
+            failed.append(ENS_ID)
+        else:
+            lines.extend(bed12_line(*transcript) for transcript in transcripts_from_json(obj))
+    return lines, failed
+
+
+def id_bed_lines(ENS_IDs, rest, client, jobs):
+    """
+    Yields the (lines, failed IDs) of the IDs chunk by chunk, in the order of the IDs
+    """
+    id_chunks = chunks(ENS_IDs, BULK_CHUNK_SIZE)
+    if rest:
+        for chunk in id_chunks:
+            yield rest_bed_lines(chunk, client)
+    elif jobs > 1:
+        # parsing the JSON files is the work here, it goes to other processes
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            yield from pool.map(json_bed_lines, chunks(ENS_IDs, max(1, min(BULK_CHUNK_SIZE, len(ENS_IDs) // jobs))))
+    else:
+        for chunk in id_chunks:
+            yield json_bed_lines(chunk)
+
+
+def annotation_bed_lines(annotation):
+    """
+    BED12 lines of the IDs of an AnnotationStore or AnnotationIndex: the exons a lookup of each ID gives
+    """
+    for ENS_ID, (chromosome, strand, name, exons) in annotation:
+        if exons:
+            yield bed12_line(ENS_ID, name, chromosome, strand, False, sorted(exons))
+
+
+def index_items(index: AnnotationIndex.AnnotationIndex):
+    for ENS_ID in index.ids():
+        chromosome, strand, name, starts, ends = index.exons(ENS_ID)
+        yield ENS_ID, (chromosome, strand, name, tuple(zip(starts, ends)))
+
+
+def batched(lines, size=BULK_CHUNK_SIZE):
+    lines = iter(lines)
+    batch = list(islice(lines, size))
+    while batch:
+        yield batch
+        batch = list(islice(lines, size))
+
+
+def bed_sort_key(line: str):
+    # like sort -k1,1 -k2,2n, what tabix wants
+    columns = line.split("\t", 3)
+    return columns[0], int(columns[1]), int(columns[2])
+
+
+def open_bed(path, bgzip):
+    if bgzip:
+        return BGZF.BGZFWriter(path)
+    if path == "-":
+        return sys.stdout
+    return open(path, 'w', buffering=1 << 20)
+
+
+def write_bed(out, bgzip, batches, sort=False):
+    """
+    :param batches: iterable of lists of BED lines, written as they come (or all at once at the end if sorting)
+    :return: number of lines
+    """
+    bed = open_bed(out, bgzip)
+    count = 0
+    kept = []
+    try:
+        for lines in batches:
+            count += len(lines)
+            if sort:
+                kept.extend(lines)
             else:
-                fh = open(file_suffix, 'w')
-            for exon in trs['Exon']:
-                fh.write(chromosome +
-                         "\t" + str(exon['start']) +
-                         "\t" + str(exon['end']) +
-                         "\t" + display_name +
-                         "\n")
+                bed.write("".join(lines))
+        if sort:
+            kept.sort(key=bed_sort_key)
+            bed.write("".join(kept))
+    finally:
+        if bed is sys.stdout:
+            bed.flush()
+        else:
+            bed.close()
+    return count
+
+
+def make_bulk_bed(out, ENS_IDs=None, from_cache=None, from_index=None, rest=True, server=EnsemblREST.DEFAULT_SERVER,
+                  jobs=1, bgzip=False, sort=False):
+    """
+    :return: (number of BED lines, list of IDs we could not make any of)
+    """
+    failed = []
+    if from_cache:
+        batches = batched(annotation_bed_lines(AnnotationStore.AnnotationStore(from_cache).items()))
+    elif from_index:
+        batches = batched(annotation_bed_lines(index_items(AnnotationIndex.AnnotationIndex(from_index))))
     else:
-        # it is a single transcript only
-        for exon in obj['Exon']:
-            intree.add(Interval(exon['start'], exon['end']))
+        client = EnsemblREST.EnsemblClient(server=server, workers=max(1, jobs)) if rest else None
+
+        def collect(results):
+            for lines, failed_IDs in results:
+                failed.extend(failed_IDs)
+                yield lines
+        batches = collect(id_bed_lines(ENS_IDs, rest, client, jobs))
+    count = write_bed(out, bgzip, batches, sort)
+    logger.info("%d transcripts are in %s", count, out)
+    return count, failed
+
 
 @click.command(context_settings=dict(help_option_names=['-h', '--help']))
-@click.option('--id', '-i', type=str, help='ENSEMBL ID to print out', required=True)
+@click.option('--id', '-i', type=str, help='ENSEMBL ID to print out', required=False, default=None)
+@click.option('--ids', type=str, required=False, default=None,
+              help='File or comma separated list of ENSEMBL IDs, all their transcripts go to --out')
+@click.option('--from-cache', type=str, required=False, default=None,
+              help='Write all the IDs of this SQLite annotation store to --out')
+@click.option('--from-index', type=str, required=False, default=None,
+              help='Write all the IDs of this annotation index to --out')
+@click.option('--out', '-o', type=str, required=False, default=None,
+              help='BED12 file of the bulk modes ("-" is stdout), a line for each transcript')
+@click.option('--bgzip/--no-bgzip', type=bool, required=False, default=False,
+              help='Compress --out with BGZF, tabix can index it if it is sorted as well')
+@click.option('--sort/--no-sort', type=bool, required=False, default=False,
+              help='Sort --out by chromosome and position (it is in the order of the IDs otherwise)')
+@click.option('--jobs', '-j', type=int, required=False, default=1, show_default=True,
+              help='Concurrent REST requests, or processes reading the JSON files with --no-rest')
 @click.option('--rest/--no-rest', '-r', type=bool, help='Read from ENSEMBL REST or JSON file',
               required=False, default=True)
-def printJSON(id, rest):
+@click.option('--server', type=str, required=False, default=EnsemblREST.DEFAULT_SERVER, show_default=True,
+              envvar="VCFFUSE_ENSEMBL_SERVER", help='Base URL of the ENSEMBL REST server')
+def printJSON(id, ids, from_cache, from_index, out, bgzip, sort, jobs, rest, server):
+    logging.basicConfig(level="INFO", format="%(message)s")
+    if ids or from_cache or from_index:
+        if not out:
+            raise click.UsageError("--ids, --from-cache and --from-index write to --out")
+        if bgzip and out == "-":
+            raise click.UsageError("--bgzip needs a file")
+        _, failed = make_bulk_bed(out, read_ids(ids) if ids else None, from_cache, from_index, rest, server, jobs,
+                                  bgzip, sort)
+        if failed:
+            logger.warning("%d IDs are missing from %s", len(failed), out)
+        return
+    if not id:
+        raise click.UsageError("Give an --id, or --ids, --from-cache or --from-index with --out")
     obj = None  # the JSON object we are playing with
     if rest:
-        server = "https://rest.ensembl.org"
-        ext = "/lookup/id/" + id + "?expand=1"
-        r = requests.get(server + ext, headers={"Content-Type": "application/json"})
-        if not r.ok:
-            r.raise_for_status()
-            sys.exit()
-        obj = r.json()
-        json_file = open(id + '.json', 'w')
-        json_file.write(r.content.decode('utf-8'))
-        json_file.close()
+        try:
+            obj = EnsemblREST.EnsemblClient(server=server).lookup(id)
+        except EnsemblREST.EnsemblLookupError as e:
+            logger.error("Could not look up %s", e)
+            sys.exit(1)
+        if obj is None:
+            logger.error("%s is not known by ENSEMBL", id)
+            sys.exit(1)
+        with open(id + '.json', 'w') as json_file:
+            json_file.write(json.dumps(obj))
     else:   # we are reading from file
         with open(id + '.json', 'r') as myfile:
             data = myfile.read()
         obj = json.loads(data)
     print_coords_from_json(obj)
 
+
 if __name__ == "__main__":
-    printJSON()
\ No newline at end of file
+    printJSON()
@@ -0,0 +1,61 @@
+"""
+The vcffuse command: a subcommand for each tool of the package.
+
+    vcffuse fuse --vcf sample.vcf --svg sample.svg
+    vcffuse index build --gtf Homo_sapiens.GRCh38.110.gtf.gz -o GRCh38.vfi
+
+Only this module and click are imported at startup, the module of a subcommand (and requests, svgwrite,
+intervaltree behind it) when the subcommand is run, so workflow managers calling it thousands of times
+do not pay for what a call does not use. `vcffuse bench --startup` measures it against STARTUP_BUDGET_MS.
+"""
+import importlib
+import click
+from vcffuse import __version__
+
+# subcommand -> (module, click command in the module, short help)
+SUBCOMMANDS = {
+    "fuse": ("vcffuse.getFusionFromVCF", "print_SV", "Draw the gene fusions of a VCF"),
+    "batch": ("vcffuse.batchFusions", "batch", "Draw the gene fusions of a cohort of VCFs"),
+    "index": ("vcffuse.AnnotationIndex", "index", "Build and query memory-mapped annotation indexes"),
+    "json2bed": ("vcffuse.json2bed", "printJSON", "BED of ENSEMBL transcripts, for IGV"),
+    "dump": ("vcffuse.dumpJSON", "ppjson", "Pretty-print a JSON file"),
+    "bench": ("vcffuse.benchFusions", "bench", "Time a run on synthetic data, and the startup of the subcommands"),
+    "synth": ("vcffuse.SyntheticData", "generate", "Write a synthetic VCF and its gene models"),
+    "standin": ("vcffuse.EnsemblStandIn", "serve", "Local ENSEMBL REST stand-in serving JSON files"),
+}
+
+# milliseconds a subcommand may take to start (--help) over the bare interpreter
+STARTUP_BUDGET_MS = {"fuse": 150, "batch": 150, "index": 100, "json2bed": 100, "dump": 60, "bench": 150,
+                     "synth": 100, "standin": 100}
+
+
+class LazyGroup(click.Group):
+    """
+    Group importing the module of a subcommand only when that subcommand is asked for
+    """
+
+    def list_commands(self, ctx):
+        return list(SUBCOMMANDS)
+
+    def get_command(self, ctx, name):
+        if name not in SUBCOMMANDS:
+            return None
+        module, command, _ = SUBCOMMANDS[name]
+        return getattr(importlib.import_module(module), command)
+
+    def format_commands(self, ctx, formatter):
+        # the listing would import everything if it asked the commands for their help
+        with formatter.section("Commands"):
+            formatter.write_dl([(name, short_help) for name, (_, _, short_help) in SUBCOMMANDS.items()])
+
+
+@click.group(cls=LazyGroup, context_settings=dict(help_option_names=['-h', '--help']))
+@click.version_option(__version__)
+def main():
+    """
+    Visualising gene fusions in VCFs
+    """
+
+
+if __name__ == "__main__":
+    main()